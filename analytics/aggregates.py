@@ -0,0 +1,323 @@
+from collections import Counter
+from typing import List, Dict, Any
+from .engine import TrackFrame, KEY_NAMES, TEMPO_BOUNDS, TEMPO_MAX, TEMPO_RANGES
+from .features import FEATURE_FIELDS
+from .sketches import QuantileSketch, percentiles
+from .taxonomy import genre_taxonomy
+import numpy as np
+
+# Tempo is kept as a histogram of 10 BPM bins so any range can be derived
+TEMPO_BIN_WIDTH = 10
+TEMPO_BINS = TEMPO_MAX // TEMPO_BIN_WIDTH
+
+# Continuous audio features summarised with quantile sketches
+SKETCH_FIELDS = [
+    'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+    'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms'
+]
+
+def _most_common(counts: Dict[str, int]) -> List:
+    """
+    Sort (key, count) pairs by count, then key, dropping empty entries.
+    Counter.most_common() breaks ties by first occurrence, which a merged
+    state no longer knows, so ties are broken by key instead.
+    """
+    return sorted(
+        ((key, count) for key, count in counts.items() if count > 0),
+        key=lambda item: (-item[1], item[0])
+    )
+
+class AnalysisState:
+    """
+    Mergeable aggregate state behind a playlist analysis.
+
+    Only sums, counts and histogram bins are kept, so tracks can be added
+    or removed (sign=-1) and states of several playlists can be merged
+    without revisiting individual tracks. to_analysis() renders the same
+    sections and values analyze_playlist() did before states existed, but
+    not always in the same order: entries with equal counts (genres,
+    artists, decades, keys) are ordered by name rather than by first
+    occurrence in the playlist, and tempo ranges always come slow, medium,
+    fast instead of in the order the tracks first hit them. Consumers
+    should treat these sections as mappings, not as ordered lists.
+
+    Artists carry macro-genres (see taxonomy.py) and genre counts are the
+    track counts of the artists per macro-genre. States stored under an
+    older taxonomy, or with raw Spotify genres, are rolled up on load.
+
+    Quantile sketches can't have tracks removed: after a removal, or for
+    states stored before sketches existed, they are marked stale and left
+    out until rebuild_sketches() is called with every current track.
+    """
+
+    def __init__(self, data: Dict[str, Any] = None):
+        data = data or {}
+        self.track_count = data.get('track_count', 0)
+        self.total_duration_ms = data.get('total_duration_ms', 0)
+        self.feature_sums = np.array(data.get('feature_sums', [0.0] * len(FEATURE_FIELDS)), dtype=float)
+        self.feature_counts = np.array(data.get('feature_counts', [0] * len(FEATURE_FIELDS)), dtype=np.int64)
+        self.popularity_sum = data.get('popularity_sum', 0.0)
+        # Track counts for high (>= 70), medium and low (< 30) popularity
+        self.popularity_bins = np.array(data.get('popularity_bins', [0, 0, 0]), dtype=np.int64)
+        # Track counts per key * 2 + major
+        self.keys = np.array(data.get('keys', [0] * 24), dtype=np.int64)
+        self.tempo_hist = np.array(data.get('tempo_hist', [0] * TEMPO_BINS), dtype=np.int64)
+        self.decades = Counter(data.get('decades', {}))
+        self.genres = Counter(data.get('genres', {}))
+        self.artists = {artist_id: dict(info) for artist_id, info in data.get('artists', {}).items()}
+        self.sketches = {field: QuantileSketch.from_dict(sketch) for field, sketch in data.get('sketches', {}).items()}
+        self.sketches_stale = bool(self.track_count) and 'sketches' not in data
+        if data.get('genre_taxonomy') != genre_taxonomy.version:
+            self.rollup_genres()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the state for a JSONField."""
+        return {
+            'track_count': int(self.track_count),
+            'total_duration_ms': int(self.total_duration_ms),
+            'feature_sums': self.feature_sums.tolist(),
+            'feature_counts': self.feature_counts.tolist(),
+            'popularity_sum': float(self.popularity_sum),
+            'popularity_bins': self.popularity_bins.tolist(),
+            'keys': self.keys.tolist(),
+            'tempo_hist': self.tempo_hist.tolist(),
+            'decades': {decade: count for decade, count in self.decades.items() if count > 0},
+            'genres': {genre: count for genre, count in self.genres.items() if count > 0},
+            'artists': self.artists,
+            'genre_taxonomy': genre_taxonomy.version,
+            **({} if self.sketches_stale else {
+                'sketches': {field: sketch.to_dict() for field, sketch in self.sketches.items() if sketch.count}
+            }),
+        }
+
+    def add_tracks(self, tracks: List[Dict], artists: Dict[str, Dict], sign: int = 1):
+        """Add (or with sign=-1 remove) tracks that carry 'audio_features'."""
+        if not tracks:
+            return
+        self.add_frame(TrackFrame.from_tracks(tracks), sign)
+        self.add_artists(tracks, artists, sign)
+
+    def add_frame(self, frame: TrackFrame, sign: int = 1):
+        """Add the numeric contributions of a TrackFrame."""
+        features = frame.features
+        present = ~np.isnan(features)
+        self.feature_sums += sign * np.where(present, features, 0).sum(axis=0)
+        self.feature_counts += sign * present.sum(axis=0)
+
+        popularity = frame.popularity
+        self.popularity_sum += sign * float(popularity.sum())
+        self.popularity_bins += sign * np.array([
+            (popularity >= 70).sum(),
+            ((popularity >= 30) & (popularity < 70)).sum(),
+            (popularity < 30).sum(),
+        ])
+
+        keys = frame.column('key')
+        modes = frame.column('mode')
+        known = ~np.isnan(keys) & ~np.isnan(modes)
+        codes = (keys[known].astype(int) % 12) * 2 + (modes[known] != 0)
+        self.keys += sign * np.bincount(codes, minlength=24)
+
+        tempos = np.nan_to_num(frame.column('tempo'), nan=0)
+        tempos = tempos[(tempos >= 0) & (tempos < TEMPO_MAX)]
+        bins = (tempos // TEMPO_BIN_WIDTH).astype(int)
+        self.tempo_hist += sign * np.bincount(bins, minlength=TEMPO_BINS)
+
+        decades, counts = np.unique(frame.years[frame.years >= 0] // 10 * 10, return_counts=True)
+        for decade, count in zip(decades, counts):
+            self.decades[str(decade)] += sign * int(count)
+
+        if sign < 0:
+            self.sketches_stale = True
+        elif not self.sketches_stale:
+            for field in SKETCH_FIELDS:
+                self.sketches.setdefault(field, QuantileSketch()).add(frame.column(field))
+
+        self.track_count += sign * len(frame)
+
+    def rebuild_sketches(self, frame: TrackFrame):
+        """Rebuild the quantile sketches from a frame holding every current track."""
+        self.sketches = {field: QuantileSketch().add(frame.column(field)) for field in SKETCH_FIELDS}
+        self.sketches_stale = False
+
+    def add_artists(self, tracks: List[Dict], artists: Dict[str, Dict], sign: int = 1):
+        """Add artist track counts and the genres they contribute."""
+        for track in tracks:
+            for artist in track.get('artists', []):
+                artist_id = artist.get('id')
+                if not artist_id:
+                    continue
+                entry = self.artists.get(artist_id)
+                if sign > 0:
+                    if entry is None:
+                        artist_data = artists.get(artist_id, {})
+                        entry = self.artists[artist_id] = {
+                            'name': artist.get('name') or artist_data.get('name'),
+                            'popularity': artist_data.get('popularity', 0),
+                            'genres': genre_taxonomy.macro_genres(artist_data.get('genres', [])),
+                            'track_count': 0,
+                        }
+                    entry['track_count'] += 1
+                elif entry is None:
+                    continue
+                else:
+                    entry['track_count'] -= 1
+                    if entry['track_count'] <= 0:
+                        del self.artists[artist_id]
+                # Genres are taken from the stored entry so removals cancel additions
+                for genre in entry['genres']:
+                    self.genres[genre] += sign
+
+    def rollup_genres(self):
+        """Map the genres of every artist onto macro-genres and recount them."""
+        self.genres = Counter()
+        for entry in self.artists.values():
+            entry['genres'] = genre_taxonomy.macro_genres(entry.get('genres', []))
+            for genre in entry['genres']:
+                self.genres[genre] += entry['track_count']
+
+    def add_duration(self, duration_ms: int):
+        self.total_duration_ms += duration_ms
+
+    def merge(self, other: 'AnalysisState') -> 'AnalysisState':
+        """Fold another state into this one and return self."""
+        self.track_count += other.track_count
+        self.total_duration_ms += other.total_duration_ms
+        self.feature_sums += other.feature_sums
+        self.feature_counts += other.feature_counts
+        self.popularity_sum += other.popularity_sum
+        self.popularity_bins += other.popularity_bins
+        self.keys += other.keys
+        self.tempo_hist += other.tempo_hist
+        self.decades.update(other.decades)
+        self.genres.update(other.genres)
+        # Only states carrying sketches contribute to the merged percentiles
+        for field, sketch in other.sketches.items():
+            self.sketches.setdefault(field, QuantileSketch()).merge(sketch)
+        for artist_id, info in other.artists.items():
+            entry = self.artists.get(artist_id)
+            if entry is None:
+                self.artists[artist_id] = dict(info)
+            else:
+                entry['track_count'] += info['track_count']
+        return self
+
+    def audio_feature_means(self) -> Dict[str, float]:
+        return {
+            field: float(self.feature_sums[i] / self.feature_counts[i])
+            for i, field in enumerate(FEATURE_FIELDS)
+            if self.feature_counts[i] > 0
+        }
+
+    def feature_percentiles(self, points=(10, 25, 50, 75, 90)) -> Dict[str, Dict[str, float]]:
+        if self.sketches_stale:
+            return {}
+        return percentiles(self.sketches, points)
+
+    def tempo_distribution(self) -> Dict[str, int]:
+        """Track counts per tempo range, in range order (see TEMPO_RANGES)."""
+        edges = [0] + [bound // TEMPO_BIN_WIDTH for bound in TEMPO_BOUNDS] + [TEMPO_BINS]
+        counts = {
+            name: int(self.tempo_hist[edges[i]:edges[i + 1]].sum())
+            for i, name in enumerate(TEMPO_RANGES)
+        }
+        return {name: count for name, count in counts.items() if count}
+
+    def key_distribution(self) -> Dict[str, int]:
+        key_counts = {
+            f"{KEY_NAMES[code // 2]} {'major' if code % 2 else 'minor'}": int(count)
+            for code, count in enumerate(self.keys)
+        }
+        return dict(_most_common(key_counts))
+
+    def to_analysis(self) -> Dict[str, Any]:
+        """Render the analysis sections stored in PlaylistAnalysis.analysis_data."""
+        genre_total = sum(count for count in self.genres.values() if count > 0)
+        artist_counts = {artist_id: info['track_count'] for artist_id, info in self.artists.items()}
+
+        return {
+            'genre_distribution': {
+                genre: {'count': count, 'percentage': (count / genre_total) * 100}
+                for genre, count in _most_common(self.genres)
+            },
+            'audio_features': self.audio_feature_means(),
+            'feature_percentiles': self.feature_percentiles(),
+            'artists': {
+                'artist_distribution': {
+                    artist_id: {
+                        **self.artists[artist_id],
+                        'percentage': (count / self.track_count) * 100
+                    }
+                    for artist_id, count in _most_common(artist_counts)
+                }
+            },
+            'popularity': {
+                'average_popularity': self.popularity_sum / self.track_count if self.track_count else 0,
+                'popularity_distribution': dict(zip(['high', 'medium', 'low'], self.popularity_bins.tolist()))
+            },
+            'decades': {f"{decade}s": count for decade, count in _most_common(self.decades)},
+            'key_distribution': self.key_distribution(),
+            'tempo_distribution': self.tempo_distribution(),
+        }
+
+    @classmethod
+    def from_analysis_data(cls, analysis_data: Dict[str, Any]) -> 'AnalysisState':
+        """
+        Approximate state for analyses stored before aggregate state existed.
+        Means are weighted by track count and tempo ranges land in one bin each.
+        """
+        state = cls()
+        analysis = analysis_data.get('analysis', {})
+        track_count = analysis_data.get('track_count', 0)
+        state.track_count = track_count
+        state.sketches_stale = bool(track_count)
+        state.total_duration_ms = analysis_data.get('total_duration_ms', 0)
+
+        for i, field in enumerate(FEATURE_FIELDS):
+            mean = analysis.get('audio_features', {}).get(field)
+            if mean is not None:
+                state.feature_sums[i] = mean * track_count
+                state.feature_counts[i] = track_count
+
+        popularity = analysis.get('popularity', {})
+        state.popularity_sum = popularity.get('average_popularity', 0) * track_count
+        distribution = popularity.get('popularity_distribution', {})
+        state.popularity_bins = np.array([distribution.get(b, 0) for b in ('high', 'medium', 'low')], dtype=np.int64)
+
+        for label, count in analysis.get('key_distribution', {}).items():
+            name, mode = label.split(' ')
+            state.keys[KEY_NAMES.index(name) * 2 + (mode == 'major')] += count
+
+        lower_bounds = [0] + TEMPO_BOUNDS
+        for name, count in analysis.get('tempo_distribution', {}).items():
+            state.tempo_hist[lower_bounds[TEMPO_RANGES.index(name)] // TEMPO_BIN_WIDTH] += count
+
+        for decade, count in analysis.get('decades', {}).items():
+            state.decades[decade.rstrip('s')] += count
+        for artist_id, data in analysis.get('artists', {}).get('artist_distribution', {}).items():
+            state.artists[artist_id] = {
+                'name': data.get('name'),
+                'popularity': data.get('popularity', 0),
+                'genres': data.get('genres', []),
+                'track_count': data.get('track_count', 0),
+            }
+        # Genre counts are derived from the artists, every artist is listed
+        state.rollup_genres()
+        return state
+
+def state_for(analysis) -> AnalysisState:
+    """Return the aggregate state of a PlaylistAnalysis, legacy rows included."""
+    if analysis.aggregate_state:
+        return AnalysisState(analysis.aggregate_state)
+    return AnalysisState.from_analysis_data(analysis.analysis_data)
+
+def merge_states(states) -> AnalysisState:
+    """
+    Merge any number of states into a new one.
+    Merging is associative, so shards can be merged separately and the
+    partial results merged again.
+    """
+    merged = AnalysisState()
+    for state in states:
+        merged.merge(state)
+    return merged
@@ -0,0 +1,163 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from django.conf import settings
+from .aggregates import AnalysisState, TEMPO_BIN_WIDTH, merge_states
+from .models import PlaylistAnalysis
+from core.cache import metadata_cache
+import django
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+# A chunk row is (aggregate_state, None) or, for legacy rows, (None, analysis_data)
+Row = Tuple[Optional[Dict], Optional[Dict]]
+
+# Tempo ranges shown on the trends page: (label, lower bound in BPM)
+TREND_TEMPO_RANGES = [
+    ('60-80 BPM', 0), ('80-100 BPM', 80), ('100-120 BPM', 100),
+    ('120-140 BPM', 120), ('140-160 BPM', 140), ('160+ BPM', 160),
+]
+
+# Features shown on the trends page, all on a 0-1 scale
+TREND_FEATURES = ['danceability', 'energy', 'speechiness', 'acousticness',
+                  'instrumentalness', 'liveness', 'valence']
+
+def merge_chunk(rows: List[Row]) -> Dict[str, Any]:
+    """Merge one chunk of stored states, runs in a worker process."""
+    return merge_states(
+        AnalysisState(state) if state else AnalysisState.from_analysis_data(analysis_data)
+        for state, analysis_data in rows
+    ).to_dict()
+
+def _percentages(counts: Dict[str, int], limit: int = None, digits: int = 1) -> Dict[str, float]:
+    total = sum(counts.values())
+    if not total:
+        return {}
+    top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return {name: round(count / total * 100, digits) for name, count in top if count > 0}
+
+class CorpusTrendEngine:
+    """
+    Builds public trends from the stored analyses of public playlists.
+
+    Only the aggregate state of each analysis is read, in chunks through
+    values_list().iterator(), so no model instances or tracks are loaded.
+    Chunks are merged in worker processes once the corpus is large enough
+    to make that worthwhile, but only when `processes` is passed: the
+    default of one process keeps web workers from spawning a pool, only
+    the refresh_trends command asks for more. No Spotify calls are made.
+    """
+
+    CHUNK_SIZE = 500
+    DEFAULT_PARALLEL_THRESHOLD = 5000
+    DEFAULT_MIN_TRACKS = 1000
+
+    def __init__(self, queryset=None, processes: int = None, chunk_size: int = None):
+        self.queryset = queryset if queryset is not None else PlaylistAnalysis.objects.filter(is_public=True)
+        # Never more worker processes than CPUs, whatever was asked for
+        self.processes = max(1, min(processes or 1, os.cpu_count() or 1))
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.parallel_threshold = getattr(settings, 'CORPUS_PARALLEL_THRESHOLD', self.DEFAULT_PARALLEL_THRESHOLD)
+
+    def chunks(self) -> Iterator[List[Row]]:
+        """Yield the stored states of the corpus in chunks."""
+        rows = self.queryset.exclude(aggregate_state={}).values_list('aggregate_state', flat=True)
+        legacy = self.queryset.filter(aggregate_state={}).values_list('analysis_data', flat=True)
+
+        chunk = []
+        for state in rows.iterator(chunk_size=self.chunk_size):
+            chunk.append((state, None))
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        for analysis_data in legacy.iterator(chunk_size=self.chunk_size):
+            chunk.append((None, analysis_data))
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def compute_state(self) -> AnalysisState:
+        """Merge the aggregate state of every analysis in the corpus."""
+        count = self.queryset.count()
+        if self.processes <= 1 or count < self.parallel_threshold:
+            return merge_states(AnalysisState(merge_chunk(chunk)) for chunk in self.chunks())
+
+        logger.info(f"Merging {count} analyses with {self.processes} processes")
+        merged = AnalysisState()
+        # Workers import the models, so they set Django up before merging
+        with ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup
+        ) as executor:
+            pending = []
+            for chunk in self.chunks():
+                pending.append(executor.submit(merge_chunk, chunk))
+                # Bound the chunks held in memory while workers catch up
+                if len(pending) >= 2 * self.processes:
+                    merged.merge(AnalysisState(pending.pop(0).result()))
+            for future in pending:
+                merged.merge(AnalysisState(future.result()))
+        return merged
+
+    def trends(self, min_tracks: int = None) -> Dict[str, Any]:
+        """
+        Trend sections built from the corpus, in the format of
+        generate_public_trends(). Empty while the corpus has fewer than
+        `min_tracks` tracks.
+        """
+        min_tracks = min_tracks if min_tracks is not None else getattr(
+            settings, 'PUBLIC_TRENDS_MIN_CORPUS_TRACKS', self.DEFAULT_MIN_TRACKS
+        )
+        state = self.compute_state()
+        if not state.track_count or state.track_count < min_tracks:
+            logger.info(f"Corpus has {state.track_count} tracks, too few for trends")
+            return {}
+
+        means = state.audio_feature_means()
+        trends = {
+            'genre_distribution': _percentages(dict(state.genres), limit=10),
+            'audio_features': {field: means[field] for field in TREND_FEATURES if field in means},
+            'tempo_distribution': self.tempo_distribution(state),
+            'key_distribution': _percentages(state.key_distribution(), limit=12),
+            'feature_percentiles': state.feature_percentiles(),
+            'corpus': {'track_count': int(state.track_count)},
+        }
+        trending_artists = self.trending_artists(state)
+        if trending_artists:
+            trends['trending_artists'] = trending_artists
+        return {section: data for section, data in trends.items() if data}
+
+    def tempo_distribution(self, state: AnalysisState) -> Dict[str, int]:
+        """Share of tracks per BPM range, from the 10 BPM tempo histogram."""
+        bounds = [lower // TEMPO_BIN_WIDTH for _, lower in TREND_TEMPO_RANGES] + [len(state.tempo_hist)]
+        counts = {
+            label: int(state.tempo_hist[bounds[i]:bounds[i + 1]].sum())
+            for i, (label, _) in enumerate(TREND_TEMPO_RANGES)
+        }
+        total = sum(counts.values())
+        if not total:
+            return {}
+        return {label: round(count / total * 100) for label, count in counts.items()}
+
+    def trending_artists(self, state: AnalysisState, limit: int = 4) -> List[Dict[str, Any]]:
+        """Artists appearing on the most tracks; images come from the metadata cache only."""
+        top = sorted(
+            state.artists.items(),
+            key=lambda item: (item[1]['track_count'], item[1]['popularity']),
+            reverse=True
+        )[:limit]
+        cached = metadata_cache.get_many('artist', [artist_id for artist_id, _ in top])
+        return [
+            {
+                'name': info['name'],
+                'image': (cached.get(artist_id, {}).get('images') or [{}])[0].get('url') or '/static/img/default-artist.png',
+                'genres': info['genres'][:3],
+                'popularity': info['popularity'],
+            }
+            for artist_id, info in top
+        ]
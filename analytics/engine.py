@@ -0,0 +1,55 @@
+from typing import List, Dict
+from .features import FEATURE_FIELDS
+import numpy as np
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Tempo bucket names and their upper bounds (BPM), the lower bound is 0
+TEMPO_RANGES = ['slow', 'medium', 'fast']
+TEMPO_BOUNDS = [90, 120]
+TEMPO_MAX = 1000
+
+class TrackFrame:
+    """
+    Columnar view of a list of tracks for vectorized analysis.
+
+    Holds one row per track: the audio features in FEATURE_FIELDS order
+    (NaN where missing), the popularity and the release year (-1 if unknown).
+    AnalysisState.add_frame() does all binning and counting on it.
+    """
+
+    def __init__(self, features: np.ndarray, popularity: np.ndarray, years: np.ndarray):
+        self.features = features
+        self.popularity = popularity
+        self.years = years
+
+    def __len__(self):
+        return len(self.popularity)
+
+    @classmethod
+    def from_tracks(cls, tracks: List[Dict]) -> 'TrackFrame':
+        """Build a frame from track dicts carrying an 'audio_features' entry."""
+        count = len(tracks)
+        features = np.full((count, len(FEATURE_FIELDS)), np.nan)
+        popularity = np.zeros(count)
+        years = np.full(count, -1, dtype=np.int32)
+
+        for i, track in enumerate(tracks):
+            audio_features = track.get('audio_features') or {}
+            features[i] = [
+                value if isinstance(value, (int, float)) else np.nan
+                for value in (audio_features.get(field) for field in FEATURE_FIELDS)
+            ]
+            popularity[i] = track.get('popularity', 0)
+            release_date = (track.get('album') or {}).get('release_date')
+            if release_date:
+                try:
+                    years[i] = int(release_date[:4])
+                except ValueError:
+                    pass
+
+        return cls(features, popularity, years)
+
+    def column(self, field: str) -> np.ndarray:
+        """Return the values of one audio feature."""
+        return self.features[:, FEATURE_FIELDS.index(field)]
@@ -0,0 +1,80 @@
+from typing import List, Dict, Any
+from .models import TrackFeatures
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Audio feature fields persisted on TrackFeatures
+FEATURE_FIELDS = [
+    'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness',
+    'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo',
+    'duration_ms', 'time_signature'
+]
+
+class TrackFeatureStore:
+    """
+    Read-through store for track audio features.
+
+    Known tracks are served from the TrackFeatures table; only the misses
+    are fetched from Spotify and then written back in bulk.
+    """
+
+    def __init__(self, spotify_client=None):
+        self.spotify_client = spotify_client
+
+    def get_features(self, tracks: List[Dict]) -> Dict[str, Dict[str, Any]]:
+        """Return audio features keyed by track ID for the given track objects."""
+        tracks_by_id = {track['id']: track for track in tracks if track and track.get('id')}
+        if not tracks_by_id:
+            return {}
+
+        features = self.load(list(tracks_by_id))
+        missing_ids = [track_id for track_id in tracks_by_id if track_id not in features]
+
+        if missing_ids and self.spotify_client:
+            logger.debug(f"Fetching audio features for {len(missing_ids)} tracks "
+                         f"({len(features)} found in database)")
+            fetched = self.spotify_client.get_tracks_features_map(missing_ids)
+            self._save(fetched, tracks_by_id)
+            features.update(fetched)
+
+        return features
+
+    def load(self, track_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Load stored features for the given track IDs in a single query."""
+        rows = TrackFeatures.objects.filter(track_id__in=track_ids).values('track_id', *FEATURE_FIELDS)
+        return {
+            row['track_id']: {'id': row.pop('track_id'), **row}
+            for row in rows
+        }
+
+    def _save(self, features: Dict[str, Dict], tracks_by_id: Dict[str, Dict]):
+        """Bulk-upsert fetched features into TrackFeatures."""
+        objects = []
+        for track_id, feature in features.items():
+            # Skip incomplete feature objects, every column is required
+            if any(feature.get(field) is None for field in FEATURE_FIELDS):
+                continue
+            track = tracks_by_id.get(track_id, {})
+            artists = track.get('artists') or [{}]
+            objects.append(TrackFeatures(
+                track_id=track_id,
+                name=(track.get('name') or '')[:255],
+                artist_name=(artists[0].get('name') or '')[:255],
+                **{field: feature[field] for field in FEATURE_FIELDS}
+            ))
+
+        if not objects:
+            return
+
+        try:
+            TrackFeatures.objects.bulk_create(
+                objects,
+                update_conflicts=True,
+                unique_fields=['track_id'],
+                update_fields=['name', 'artist_name', 'last_updated', *FEATURE_FIELDS],
+                batch_size=500
+            )
+        except Exception as e:
+            # Persisting is an optimisation, never fail the analysis over it
+            logger.error(f"Error storing track features: {str(e)}")
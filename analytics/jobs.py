@@ -0,0 +1,104 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import AnalysisJob
+from core.spotify import SpotifyClient
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Stored on failed jobs in place of the exception, which may leak internals
+JOB_ERROR = 'Analysis failed. Please try again later.'
+
+def enqueue_analysis(user, playlist_id):
+    """
+    Queue an analysis of a playlist for a user.
+    Returns (job, created); an identical pending or running job is reused.
+    """
+    job = AnalysisJob.objects.filter(
+        user=user, playlist_id=playlist_id, status__in=AnalysisJob.ACTIVE_STATUSES
+    ).first()
+    if job:
+        return job, False
+
+    try:
+        with transaction.atomic():
+            return AnalysisJob.objects.create(user=user, playlist_id=playlist_id), True
+    except IntegrityError:
+        # Another request queued the same job concurrently
+        job = AnalysisJob.objects.filter(
+            user=user, playlist_id=playlist_id, status__in=AnalysisJob.ACTIVE_STATUSES
+        ).first()
+        if job:
+            return job, False
+        raise
+
+def enqueue_library_analysis(user):
+    """Queue an analysis of every playlist of a user, see enqueue_analysis()."""
+    return enqueue_analysis(user, AnalysisJob.LIBRARY)
+
+def enqueue_listening_sync(user):
+    """Queue a sync of a user's listening history, see enqueue_analysis()."""
+    return enqueue_analysis(user, AnalysisJob.LISTENING_HISTORY)
+
+def claim_next_job():
+    """Atomically mark the oldest pending job as running and return it."""
+    candidates = AnalysisJob.objects.filter(status=AnalysisJob.STATUS_PENDING).order_by('created_at')
+    for job_id in candidates.values_list('id', flat=True)[:10]:
+        claimed = AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.STATUS_PENDING).update(
+            status=AnalysisJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+            message='Starting analysis'
+        )
+        if claimed:
+            return AnalysisJob.objects.select_related('user').get(id=job_id)
+    return None
+
+def requeue_stale_jobs():
+    """Put jobs back in the queue whose worker died while running them."""
+    timeout = getattr(settings, 'ANALYSIS_JOB_TIMEOUT', 30 * 60)
+    count = AnalysisJob.objects.filter(
+        status=AnalysisJob.STATUS_RUNNING,
+        started_at__lt=timezone.now() - timedelta(seconds=timeout)
+    ).update(status=AnalysisJob.STATUS_PENDING, progress=0, message='Requeued')
+    if count:
+        logger.warning(f"Requeued {count} stale analysis jobs")
+    return count
+
+def run_job(job):
+    """Run a claimed job to completion, recording progress and the outcome."""
+    # Imported here, analytics.services imports the models this module uses
+    from .services import AnalyticsService
+    from .listening import ListeningHistorySync
+
+    def report(percent, message):
+        AnalysisJob.objects.filter(id=job.id).update(progress=percent, message=message[:255])
+
+    try:
+        spotify_client = SpotifyClient.for_user(job.user)
+        analytics_service = AnalyticsService(spotify_client=spotify_client)
+        if job.playlist_id == AnalysisJob.LIBRARY:
+            analytics_service.analyze_library(job.user, progress=report)
+        elif job.playlist_id == AnalysisJob.LISTENING_HISTORY:
+            report(0, 'Syncing listening history')
+            ListeningHistorySync(spotify_client).sync(job.user)
+        else:
+            analytics_service.refresh_playlist(job.playlist_id, user=job.user, progress=report)
+
+        AnalysisJob.objects.filter(id=job.id).update(
+            status=AnalysisJob.STATUS_SUCCEEDED,
+            progress=100,
+            message='Analysis complete',
+            finished_at=timezone.now()
+        )
+        logger.info(f"Analysis job {job.id} for playlist {job.playlist_id} succeeded")
+    except Exception as e:
+        # The error is returned to the client, keep exception details in the log
+        logger.error(f"Analysis job {job.id} for playlist {job.playlist_id} failed: {str(e)}", exc_info=True)
+        AnalysisJob.objects.filter(id=job.id).update(
+            status=AnalysisJob.STATUS_FAILED,
+            message='Analysis failed',
+            error=JOB_ERROR,
+            finished_at=timezone.now()
+        )
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import List, Dict, Any, Optional
+from django.conf import settings
+from django.db import connection
+from django.db.models import Avg, Count, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .features import TrackFeatureStore
+from .models import ListeningEvent, TrackFeatures
+from .taxonomy import genre_taxonomy
+from core.spotify import SpotifyClient
+from users.models import User
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ListeningHistorySync:
+    """
+    Appends a user's new Spotify plays to the ListeningEvent table.
+
+    User.spotify_last_sync holds the time of the newest synced play and is
+    passed as the `after` cursor, so each sync only downloads plays that
+    are not stored yet. Spotify only exposes the last 50 plays, syncing
+    has to run more often than a user gets through them.
+    """
+
+    PAGE_SIZE = 50
+    # Upper bound on pages followed in one sync
+    MAX_PAGES = 10
+
+    def __init__(self, spotify_client: SpotifyClient):
+        self.spotify_client = spotify_client
+
+    def sync(self, user: User) -> int:
+        """Store the plays since the last sync, returning how many were inserted."""
+        newest = user.spotify_last_sync
+        after = int(newest.timestamp() * 1000) if newest else None
+        inserted = 0
+
+        for _ in range(self.MAX_PAGES):
+            page = self.spotify_client.get_recently_played(limit=self.PAGE_SIZE, after=after)
+            items = page.get('items', [])
+            events = self._events(user, items)
+            if events:
+                played_at = max(event.played_at for event in events)
+                newest = max(newest, played_at) if newest else played_at
+                # Plays already stored (e.g. by an overlapping sync) aren't counted,
+                # ignore_conflicts covers those stored after this check
+                stored = set(ListeningEvent.objects.filter(
+                    user=user, played_at__in=[event.played_at for event in events]
+                ).values_list('played_at', flat=True))
+                events = [event for event in events if event.played_at not in stored]
+                ListeningEvent.objects.bulk_create(events, batch_size=500, ignore_conflicts=True)
+                inserted += len(events)
+
+            cursor = (page.get('cursors') or {}).get('after')
+            if len(items) < self.PAGE_SIZE or not cursor:
+                break
+            after = int(cursor)
+
+        if newest != user.spotify_last_sync:
+            user.spotify_last_sync = newest
+            user.save(update_fields=['spotify_last_sync'])
+        logger.debug(f"Synced {inserted} new plays for user {user.id}")
+        return inserted
+
+    def _events(self, user: User, items: List[Dict]) -> List[ListeningEvent]:
+        """Build events for a page of play history items."""
+        plays = []
+        for item in items:
+            track = (item or {}).get('track') or {}
+            played_at = parse_datetime(item.get('played_at') or '') if item else None
+            if track.get('id') and played_at:
+                plays.append((track, played_at))
+        if not plays:
+            return []
+
+        # Track objects are kept for the dashboard, artists give the genre
+        self.spotify_client.metadata_cache.set_many('track', {track['id']: track for track, _ in plays})
+        try:
+            # Stored in TrackFeatures for the listening summary
+            TrackFeatureStore(self.spotify_client).get_features([track for track, _ in plays])
+        except Exception as e:
+            logger.warning(f"Error fetching audio features of synced plays: {str(e)}")
+        artists = self.spotify_client.get_artists([
+            (track.get('artists') or [{}])[0].get('id') for track, _ in plays
+        ])
+
+        events = []
+        for track, played_at in plays:
+            artist_id = (track.get('artists') or [{}])[0].get('id') or ''
+            genres = genre_taxonomy.macro_genres(artists.get(artist_id, {}).get('genres', []))
+            events.append(ListeningEvent(
+                user=user,
+                track_id=track['id'],
+                artist_id=artist_id,
+                genre=genres[0] if genres else '',
+                duration_ms=track.get('duration_ms') or 0,
+                played_at=played_at
+            ))
+        return events
+
+def _sync_user(user_id: int) -> Optional[int]:
+    """Sync one user in a worker thread, returning None on failure."""
+    try:
+        user = User.objects.get(pk=user_id)
+        return ListeningHistorySync(SpotifyClient.for_user(user)).sync(user)
+    except Exception as e:
+        logger.error(f"Error syncing listening history of user {user_id}: {str(e)}")
+        return None
+    finally:
+        connection.close()
+
+def sync_all_users(workers: int = None) -> Dict[str, int]:
+    """
+    Sync the listening history of every user with a linked Spotify
+    account, at most `workers` users at a time.
+
+    A sync handles one page of at most 50 plays at a time, which is a
+    single audio feature chunk and artist batch fetched one after the
+    other. Spotify requests in flight are therefore bounded by `workers`
+    (and by the scheduler's concurrency limit), not by workers times
+    SPOTIFY_MAX_WORKERS.
+    """
+    workers = workers or getattr(settings, 'LISTENING_SYNC_WORKERS', 4)
+    user_ids = list(
+        User.objects.exclude(spotify_refresh_token__isnull=True)
+        .exclude(spotify_refresh_token='')
+        .values_list('id', flat=True)
+    )
+    results = {'users': len(user_ids), 'failed': 0, 'plays': 0}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='listening-sync') as executor:
+        for inserted in executor.map(_sync_user, user_ids):
+            if inserted is None:
+                results['failed'] += 1
+            else:
+                results['plays'] += inserted
+    return results
+
+# Audio features averaged over the tracks of a listening history
+SUMMARY_FEATURES = ['danceability', 'energy', 'valence', 'acousticness',
+                    'instrumentalness', 'speechiness', 'liveness']
+
+def listening_summary(user: User, days: int = None, recent: int = 10) -> Dict[str, Any]:
+    """
+    Play and track counts, listening time, genres, mean audio features and
+    latest plays from the stored history. Features are averaged over the
+    distinct tracks with a TrackFeatures row, empty if there are none.
+    """
+    days = days or getattr(settings, 'LISTENING_HISTORY_DAYS', 180)
+    events = ListeningEvent.objects.filter(user=user, played_at__gte=timezone.now() - timedelta(days=days))
+
+    totals = events.aggregate(
+        plays=Count('id'), tracks=Count('track_id', distinct=True), duration_ms=Sum('duration_ms')
+    )
+    means = TrackFeatures.objects.filter(track_id__in=events.values('track_id')).aggregate(
+        **{field: Avg(field) for field in SUMMARY_FEATURES}
+    )
+    genre_counts = list(
+        events.exclude(genre='')
+        .values('genre')
+        .annotate(plays=Count('id'))
+        .order_by('-plays', 'genre')
+    )
+    genre_total = sum(row['plays'] for row in genre_counts)
+
+    return {
+        'days': days,
+        'play_count': totals['plays'],
+        'track_count': totals['tracks'],
+        'total_duration_ms': totals['duration_ms'] or 0,
+        'top_genre': genre_counts[0]['genre'] if genre_counts else None,
+        'genre_distribution': {
+            row['genre']: round(row['plays'] / genre_total * 100, 1) for row in genre_counts[:10]
+        },
+        'audio_features': {
+            field: round(value, 2) for field, value in means.items() if value is not None
+        },
+        'recent': list(ListeningEvent.objects.filter(user=user).values('track_id', 'played_at')[:recent]),
+    }
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from analytics.models import TrackFeatures
+from analytics.similarity import TrackFeatureIndex, feature_rows, index_directory
+from django.utils import timezone
+import os
+import time
+
+class Command(BaseCommand):
+    help = 'Builds or updates the nearest-neighbour index over TrackFeatures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Retrain the clusters instead of adding new tracks to them')
+        parser.add_argument('--lists', type=int, default=None,
+                            help='Number of clusters for a full build (default: sqrt of the track count)')
+
+    def handle(self, *args, **options):
+        directory = index_directory()
+        os.makedirs(directory, exist_ok=True)
+        started = time.monotonic()
+        # Taken before reading, rows written while building are read next run
+        built_at = timezone.now()
+
+        index = None if options['full'] else TrackFeatureIndex.load(directory)
+        if index is None:
+            ids, vectors = feature_rows()
+            self.stdout.write(f"Building index over {len(ids)} tracks...")
+            index = TrackFeatureIndex.build(ids, vectors, n_lists=options['lists'], built_at=built_at)
+        else:
+            ids, vectors = feature_rows(TrackFeatures.objects.filter(last_updated__gt=index.built_at))
+            removed = index.missing_ids(TrackFeatures.objects.values_list('track_id', flat=True).iterator())
+            if not ids and not removed:
+                self.stdout.write(f"Index is up to date ({len(index)} tracks)")
+                return
+            self.stdout.write(f"Adding {len(ids)} new or updated and removing {len(removed)} deleted tracks...")
+            index = index.extend(ids, vectors, removed=removed, built_at=built_at)
+
+        path = index.save(directory)
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved index of {len(index)} tracks in {len(index.centroids)} clusters to {path} "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from analytics.models import PublicTrend
+from analytics.services import AnalyticsService
+from analytics.trends import trend_revalidator
+from core.spotify import SpotifyClient
+import time
+
+class Command(BaseCommand):
+    help = 'Regenerates public trends before the active trend expires or when requests mark them stale'
+
+    # Seconds between checks for the stale flag while waiting in --loop mode
+    STALE_POLL = 10
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and refresh trends whenever they are due')
+        parser.add_argument('--interval', type=float, default=300,
+                            help='Maximum seconds between checks in --loop mode')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate even if the active trend is still fresh')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Worker processes merging a large corpus (default: CORPUS_TREND_PROCESSES)')
+
+    def handle(self, *args, **options):
+        force = options['force']
+        self.processes = options['processes'] or getattr(settings, 'CORPUS_TREND_PROCESSES', 1)
+        while True:
+            close_old_connections()
+            wait, failed = self.refresh(force)
+            force = False
+            if not options['loop']:
+                return
+
+            wait = min(wait, options['interval'])
+            self.stdout.write(f"Next check in {wait:.0f}s")
+            try:
+                self.sleep(wait, wake_on_stale=not failed)
+            except KeyboardInterrupt:
+                return
+
+    def sleep(self, seconds, wake_on_stale=True):
+        """Sleep, waking early when a request marks the trends stale (unless backing off)."""
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            time.sleep(min(deadline - time.monotonic(), self.STALE_POLL))
+            if wake_on_stale and trend_revalidator.is_stale():
+                return
+
+    def refresh(self, force=False):
+        """
+        Refresh trends if due or marked stale.
+        Returns the seconds until the next refresh is due and whether this one failed.
+        """
+        margin = getattr(settings, 'PUBLIC_TRENDS_REFRESH_MARGIN', 60 * 60)
+        if not force and trend_revalidator.backing_off():
+            self.stdout.write('Backing off after a failed regeneration, nothing to do')
+            return trend_revalidator.BACKOFF, True
+
+        active = PublicTrend.objects.filter(trend_type='general', is_active=True).first()
+        if active and not force and not trend_revalidator.is_stale():
+            due_in = (active.valid_until - timezone.now()).total_seconds() - margin
+            if due_in > 0:
+                self.stdout.write(f"Active trends valid until {active.valid_until}, nothing to do")
+                return due_in, False
+
+        if not trend_revalidator.acquire():
+            self.stdout.write('Another refresher is regenerating trends, skipping')
+            return self.STALE_POLL, False
+
+        self.stdout.write('Generating public trends...')
+        started = time.monotonic()
+        try:
+            analytics_service = AnalyticsService(spotify_client=SpotifyClient.for_app())
+            trend = analytics_service.refresh_public_trends(processes=self.processes)
+        except Exception as e:
+            self.stderr.write(f"Error refreshing trends: {str(e)}")
+            trend = None
+        finally:
+            trend_revalidator.release()
+
+        if trend is None:
+            # Keep serving the current trend and retry with a growing delay
+            self.stderr.write('Trend generation failed')
+            return trend_revalidator.record_failure(), True
+        trend_revalidator.record_success()
+        self.stdout.write(self.style.SUCCESS(
+            f"Published trends in {time.monotonic() - started:.1f}s, valid until {trend.valid_until}"
+        ))
+        return (trend.valid_until - timezone.now()).total_seconds() - margin, False
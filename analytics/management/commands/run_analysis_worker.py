@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from analytics.jobs import claim_next_job, requeue_stale_jobs, run_job
+import threading
+import time
+
+class Command(BaseCommand):
+    help = 'Runs queued playlist analysis jobs with a pool of worker threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2,
+                            help='Number of jobs to run concurrently')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+        parser.add_argument('--requeue-interval', type=float, default=60.0,
+                            help='Seconds between checks for jobs left running by a dead worker')
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        self.once = options['once']
+        self.poll_interval = options['poll_interval']
+
+        requeue_stale_jobs()
+        self.stdout.write(self.style.SUCCESS(
+            f"Starting analysis worker with {options['workers']} threads"
+        ))
+
+        threads = [
+            threading.Thread(target=self.work, name=f'analysis-worker-{i}', daemon=True)
+            for i in range(options['workers'])
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            next_requeue = time.monotonic() + options['requeue_interval']
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+                if time.monotonic() >= next_requeue:
+                    self.requeue()
+                    next_requeue = time.monotonic() + options['requeue_interval']
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping after the current jobs...')
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+    def requeue(self):
+        """Requeue jobs of workers that died, so a long-running worker picks them up."""
+        close_old_connections()
+        try:
+            requeue_stale_jobs()
+        except Exception as e:
+            self.stderr.write(f"Error requeueing stale jobs: {str(e)}")
+
+    def work(self):
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+                job = claim_next_job()
+                if job is None:
+                    if self.once:
+                        return
+                    self.stop.wait(self.poll_interval)
+                    continue
+
+                self.stdout.write(f"Running analysis job {job.id} (playlist {job.playlist_id})")
+                started = time.monotonic()
+                run_job(job)
+                self.stdout.write(f"Finished analysis job {job.id} in {time.monotonic() - started:.1f}s")
+        finally:
+            connection.close()
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from analytics.listening import sync_all_users
+import time
+
+class Command(BaseCommand):
+    help = 'Appends the new Spotify plays of every linked user to their listening history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of users synced concurrently')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and sync every --interval seconds')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Seconds between syncs in --loop mode')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'LISTENING_SYNC_WORKERS', 4)
+        interval = options['interval'] or getattr(settings, 'LISTENING_SYNC_INTERVAL', 30 * 60)
+        while True:
+            close_old_connections()
+            self.sync(workers)
+            if not options['loop']:
+                return
+
+            self.stdout.write(f"Next sync in {interval:.0f}s")
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                return
+
+    def sync(self, workers):
+        self.stdout.write(f"Syncing listening history with {workers} workers...")
+        started = time.monotonic()
+        results = sync_all_users(workers)
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {results['plays']} new plays for {results['users']} users "
+            f"({results['failed']} failed) in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playlistanalysis',
+            name='aggregate_state',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='playlistanalysis',
+            name='snapshot_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='playlistanalysis',
+            name='track_ids',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='playlistanalysis',
+            name='track_index',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0004_analysisjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='publictrend',
+            index=models.Index(fields=['trend_type', 'is_active', '-created_at'], name='analytics_p_trend_t_bf1804_idx'),
+        ),
+    ]
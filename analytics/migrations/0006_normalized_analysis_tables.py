@@ -0,0 +1,117 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_rows(apps, schema_editor):
+    """Populate the normalized tables from the stored analyses."""
+    PlaylistAnalysis = apps.get_model('analytics', 'PlaylistAnalysis')
+    PlaylistTrack = apps.get_model('analytics', 'PlaylistTrack')
+    PlaylistGenreCount = apps.get_model('analytics', 'PlaylistGenreCount')
+    PlaylistArtistCount = apps.get_model('analytics', 'PlaylistArtistCount')
+
+    analyses = PlaylistAnalysis.objects.only('id', 'track_ids', 'aggregate_state', 'analysis_data')
+    for analysis in analyses.iterator(chunk_size=100):
+        state = analysis.aggregate_state
+        if state:
+            genres = state.get('genres', {})
+            artists = state.get('artists', {})
+        else:
+            # Analyses stored before aggregate state existed
+            sections = (analysis.analysis_data or {}).get('analysis', {})
+            genres = {genre: data['count'] for genre, data in sections.get('genre_distribution', {}).items()}
+            artists = sections.get('artists', {}).get('artist_distribution', {})
+
+        PlaylistTrack.objects.bulk_create([
+            PlaylistTrack(analysis_id=analysis.id, track_id=track_id, position=position)
+            for position, track_id in enumerate(analysis.track_ids or []) if track_id
+        ], batch_size=1000)
+        PlaylistGenreCount.objects.bulk_create([
+            PlaylistGenreCount(analysis_id=analysis.id, genre=genre[:255], count=count)
+            for genre, count in genres.items() if count > 0
+        ], batch_size=1000)
+        PlaylistArtistCount.objects.bulk_create([
+            PlaylistArtistCount(
+                analysis_id=analysis.id,
+                artist_id=artist_id,
+                name=(info.get('name') or '')[:255],
+                popularity=info.get('popularity') or 0,
+                count=info.get('track_count', 0)
+            )
+            for artist_id, info in artists.items() if info.get('track_count', 0) > 0
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0005_publictrend_active_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaylistGenreCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('genre', models.CharField(max_length=255)),
+                ('count', models.IntegerField()),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='genre_counts', to='analytics.playlistanalysis')),
+            ],
+            options={
+                'verbose_name': 'playlist genre count',
+                'verbose_name_plural': 'playlist genre counts',
+            },
+        ),
+        migrations.CreateModel(
+            name='PlaylistTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('track_id', models.CharField(max_length=255)),
+                ('position', models.PositiveIntegerField()),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tracks', to='analytics.playlistanalysis')),
+            ],
+            options={
+                'verbose_name': 'playlist track',
+                'verbose_name_plural': 'playlist tracks',
+                'ordering': ['analysis', 'position'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PlaylistArtistCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('artist_id', models.CharField(max_length=255)),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('popularity', models.IntegerField(default=0)),
+                ('count', models.IntegerField()),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='artist_counts', to='analytics.playlistanalysis')),
+            ],
+            options={
+                'verbose_name': 'playlist artist count',
+                'verbose_name_plural': 'playlist artist counts',
+                'indexes': [models.Index(fields=['artist_id', 'count'], name='analytics_p_artist__58a428_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='playlistartistcount',
+            constraint=models.UniqueConstraint(fields=('analysis', 'artist_id'), name='unique_playlist_artist'),
+        ),
+        migrations.AddIndex(
+            model_name='playlistgenrecount',
+            index=models.Index(fields=['genre', 'count'], name='analytics_p_genre_3a4acf_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='playlistgenrecount',
+            constraint=models.UniqueConstraint(fields=('analysis', 'genre'), name='unique_playlist_genre'),
+        ),
+        migrations.AddIndex(
+            model_name='playlisttrack',
+            index=models.Index(fields=['track_id'], name='analytics_p_track_i_c7fcec_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='playlisttrack',
+            constraint=models.UniqueConstraint(fields=('analysis', 'position'), name='unique_playlist_track_position'),
+        ),
+        migrations.RunPython(backfill_rows, migrations.RunPython.noop),
+    ]
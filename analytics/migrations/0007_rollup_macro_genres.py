@@ -0,0 +1,258 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:49
+
+import re
+
+from django.db import migrations
+
+# Frozen copy of analytics/data/genre_taxonomy.json version 1 and of the
+# GenreTaxonomy lookup, so this migration gives the same result whatever
+# the live taxonomy becomes
+TAXONOMY_VERSION = 1
+DEFAULT_GENRE = 'Other'
+MACRO_GENRES = {
+    'Pop': {
+        'keywords': [
+            'pop', 'teen pop', 'boy band', 'girl group', 'idol', 'j-pop', 'k-pop', 'c-pop',
+            'mandopop', 'cantopop', 'europop', 'schlager', 'chanson', 'singer-songwriter',
+            'adult standards', 'easy listening',
+        ],
+        'genres': [
+            'dance pop', 'electropop', 'synthpop', 'indie pop', 'art pop', 'dream pop',
+            'bedroom pop', 'hyperpop', 'k-pop boy group', 'k-pop girl group', 'post-teen pop',
+            'viral pop',
+        ],
+    },
+    'Hip Hop': {
+        'keywords': [
+            'hip hop', 'rap', 'trap', 'drill', 'grime', 'boom bap', 'crunk', 'phonk',
+            'gangster rap', 'hyphy', 'bounce',
+        ],
+        'genres': [
+            'pop rap', 'emo rap', 'melodic rap', 'underground hip hop',
+        ],
+    },
+    'R&B': {
+        'keywords': [
+            'r&b', 'rnb', 'neo soul', 'new jack swing', 'quiet storm', 'alternative r&b',
+        ],
+        'genres': [
+            'contemporary r&b', 'urban contemporary',
+        ],
+    },
+    'Soul & Funk': {
+        'keywords': [
+            'soul', 'funk', 'motown', 'disco', 'boogie', 'gospel', 'northern soul', 'p funk',
+        ],
+        'genres': [
+            'classic soul', 'southern soul', 'funk carioca',
+        ],
+    },
+    'Rock': {
+        'keywords': [
+            'rock', 'punk', 'grunge', 'emo', 'shoegaze', 'britpop', 'garage', 'post-punk',
+            'new wave', 'psychedelia', 'hardcore', 'screamo', 'math rock', 'surf', 'rockabilly',
+        ],
+        'genres': [
+            'album rock', 'classic rock', 'hard rock', 'soft rock', 'pop rock', 'modern rock',
+            'alternative rock', 'indie rock', 'pop punk',
+        ],
+    },
+    'Metal': {
+        'keywords': [
+            'metal', 'metalcore', 'deathcore', 'djent', 'grindcore', 'doom', 'sludge', 'nu metal',
+            'thrash',
+        ],
+        'genres': [
+        ],
+    },
+    'Indie': {
+        'keywords': [
+            'indie', 'lo-fi', 'slacker', 'alternative', 'chamber', 'twee',
+        ],
+        'genres': [
+            'indie folk', 'indie soul', 'indietronica',
+        ],
+    },
+    'Electronic': {
+        'keywords': [
+            'edm', 'electronic', 'electronica', 'electro', 'house', 'techno', 'trance', 'dubstep',
+            'drum and bass', 'dnb', 'jungle', 'garage house', 'uk garage', 'breakbeat', 'big room',
+            'hardstyle', 'idm', 'downtempo', 'chillwave', 'synthwave', 'vaporwave', 'ambient',
+            'bass music', 'future bass', 'trip hop', 'dance', 'club', 'rave', 'eurodance', 'hi-nrg',
+            'footwork', 'glitch',
+        ],
+        'genres': [
+            'dance rock', 'electro house', 'progressive house', 'deep house', 'tropical house',
+            'melodic techno', 'brostep', 'lo-fi beats', 'chillhop',
+        ],
+    },
+    'Latin': {
+        'keywords': [
+            'latin', 'latino', 'reggaeton', 'salsa', 'bachata', 'merengue', 'cumbia', 'banda',
+            'corrido', 'corridos', 'norteno', 'mariachi', 'ranchera', 'bolero', 'tango',
+            'sertanejo', 'pagode', 'samba', 'mpb', 'bossa nova', 'forro', 'urbano', 'dembow',
+            'tejano', 'grupera', 'vallenato',
+        ],
+        'genres': [
+            'latin pop', 'latin hip hop', 'latin rock', 'latin alternative', 'trap latino',
+            'urbano latino', 'reggaeton flow', 'musica mexicana', 'sierreno',
+        ],
+    },
+    'Country': {
+        'keywords': [
+            'country', 'americana', 'bluegrass', 'honky tonk', 'outlaw', 'red dirt',
+            'nashville sound', 'western swing',
+        ],
+        'genres': [
+            'country pop', 'country rock', 'contemporary country', 'modern country pop',
+        ],
+    },
+    'Folk': {
+        'keywords': [
+            'folk', 'acoustic', 'celtic', 'traditional', 'cantautor', 'sea shanties',
+        ],
+        'genres': [
+            'folk rock', 'folk-pop', 'stomp and holler',
+        ],
+    },
+    'Jazz': {
+        'keywords': [
+            'jazz', 'bebop', 'swing', 'big band', 'bossa', 'fusion', 'smooth jazz', 'vocal jazz',
+            'cool jazz', 'hard bop', 'free jazz',
+        ],
+        'genres': [
+            'jazz fusion', 'jazz rap', 'acid jazz', 'nu jazz',
+        ],
+    },
+    'Blues': {
+        'keywords': [
+            'blues', 'delta blues', 'chicago blues', 'electric blues',
+        ],
+        'genres': [
+            'blues rock',
+        ],
+    },
+    'Reggae': {
+        'keywords': [
+            'reggae', 'dancehall', 'ska', 'dub', 'rocksteady', 'roots reggae', 'soca', 'calypso',
+            'afrobeats', 'afrobeat', 'afropop', 'afro', 'amapiano', 'highlife', 'azonto',
+            'bongo flava',
+        ],
+        'genres': [
+            'lovers rock', 'afro dancehall', 'afroswing',
+        ],
+    },
+    'Classical': {
+        'keywords': [
+            'classical', 'baroque', 'romantic', 'opera', 'orchestra', 'orchestral', 'symphony',
+            'chamber music', 'choral', 'choir', 'string quartet', 'early music', 'minimalism',
+            'neoclassical', 'compositional ambient', 'piano',
+        ],
+        'genres': [
+            'contemporary classical', 'classical performance', 'neo-classical', 'post-romantic era',
+            'early romantic era',
+        ],
+    },
+    'Soundtrack': {
+        'keywords': [
+            'soundtrack', 'score', 'video game music', 'anime', 'show tunes', 'broadway', 'musical',
+            'movie tunes', 'hollywood', 'bollywood', 'filmi', "children's music", 'lullaby',
+        ],
+        'genres': [
+            'orchestral soundtrack', 'anime score', 'japanese vgm',
+        ],
+    },
+    'World': {
+        'keywords': [
+            'world', 'flamenco', 'fado', 'klezmer', 'qawwali', 'bhangra', 'desi', 'arabesk',
+            'turkish', 'persian', 'arab', 'balkan', 'polka', 'zouk', 'kizomba', 'kompa',
+        ],
+        'genres': [
+            'world music', 'indian classical', 'carnatic', 'hindustani classical',
+        ],
+    },
+}
+
+TOKEN_SEPARATORS = re.compile(r'[\s\-/]+')
+
+
+def _tokens(genre):
+    return [token for token in TOKEN_SEPARATORS.split(genre.strip().lower()) if token]
+
+
+def _build():
+    exact = {}
+    keywords = {}
+    for name, entry in MACRO_GENRES.items():
+        for genre in [name, *entry.get('genres', [])]:
+            exact[' '.join(_tokens(genre))] = name
+        for keyword in entry.get('keywords', []):
+            keywords[tuple(_tokens(keyword))] = name
+    exact[' '.join(_tokens(DEFAULT_GENRE))] = DEFAULT_GENRE
+    return exact, keywords
+
+
+EXACT, KEYWORDS = _build()
+
+
+def macro_genre(genre):
+    """Table entry, else the keyword ending last (longest first), else the default."""
+    tokens = _tokens(genre)
+    macro = EXACT.get(' '.join(tokens))
+    if macro is not None:
+        return macro
+    best = None
+    for start in range(len(tokens)):
+        for end in range(start, len(tokens)):
+            name = KEYWORDS.get(tuple(tokens[start:end + 1]))
+            if name is not None and (best is None or (end, end - start) > best[:2]):
+                best = (end, end - start, name)
+    return best[2] if best else DEFAULT_GENRE
+
+
+def macro_genres(genres):
+    return list(dict.fromkeys(macro_genre(genre) for genre in genres if genre))
+
+
+def rollup_genres(apps, schema_editor):
+    """Roll the stored artist genres and genre rows up to macro-genres."""
+    PlaylistAnalysis = apps.get_model('analytics', 'PlaylistAnalysis')
+    PlaylistGenreCount = apps.get_model('analytics', 'PlaylistGenreCount')
+
+    analyses = PlaylistAnalysis.objects.only('id', 'aggregate_state', 'analysis_data')
+    for analysis in analyses.iterator(chunk_size=100):
+        state = analysis.aggregate_state
+        if state:
+            artists = state.get('artists', {})
+        else:
+            # Analyses stored before aggregate state existed
+            sections = (analysis.analysis_data or {}).get('analysis', {})
+            artists = sections.get('artists', {}).get('artist_distribution', {})
+
+        genres = {}
+        for info in artists.values():
+            info['genres'] = macro_genres(info.get('genres', []))
+            for genre in info['genres']:
+                genres[genre] = genres.get(genre, 0) + info.get('track_count', 0)
+
+        if state:
+            state['genres'] = {genre: count for genre, count in genres.items() if count > 0}
+            state['genre_taxonomy'] = TAXONOMY_VERSION
+            analysis.save(update_fields=['aggregate_state'])
+
+        PlaylistGenreCount.objects.filter(analysis_id=analysis.id).delete()
+        PlaylistGenreCount.objects.bulk_create([
+            PlaylistGenreCount(analysis_id=analysis.id, genre=genre, count=count)
+            for genre, count in genres.items() if count > 0
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0006_normalized_analysis_tables'),
+    ]
+
+    operations = [
+        migrations.RunPython(rollup_genres, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0007_rollup_macro_genres'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListeningEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('track_id', models.CharField(max_length=255)),
+                ('artist_id', models.CharField(blank=True, default='', max_length=255)),
+                ('genre', models.CharField(blank=True, default='', max_length=64)),
+                ('duration_ms', models.IntegerField(default=0)),
+                ('played_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listening_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'listening event',
+                'verbose_name_plural': 'listening events',
+                'ordering': ['-played_at'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='listeningevent',
+            constraint=models.UniqueConstraint(fields=('user', 'played_at'), name='unique_listening_event'),
+        ),
+    ]
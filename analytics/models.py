@@ -31,6 +31,11 @@ class PlaylistAnalysis(models.Model):
     analysis_data = models.JSONField()
     track_count = models.IntegerField(default=0)
     total_duration_ms = models.BigIntegerField(default=0)
+    # Incremental refresh state: Spotify snapshot, member tracks and aggregates
+    snapshot_id = models.CharField(max_length=255, blank=True, default='')
+    track_ids = models.JSONField(default=list, blank=True)
+    track_index = models.JSONField(default=dict, blank=True)
+    aggregate_state = models.JSONField(default=dict, blank=True)
     last_updated = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -43,6 +48,72 @@ class PlaylistAnalysis(models.Model):
     def __str__(self):
         return f"{self.name} - {self.user.username}"
 
+class PlaylistTrack(models.Model):
+    """
+    Track membership of an analysed playlist, one row per playlist entry.
+    """
+    analysis = models.ForeignKey(PlaylistAnalysis, on_delete=models.CASCADE, related_name='tracks')
+    track_id = models.CharField(max_length=255)
+    position = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = _('playlist track')
+        verbose_name_plural = _('playlist tracks')
+        ordering = ['analysis', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['analysis', 'position'], name='unique_playlist_track_position'),
+        ]
+        indexes = [
+            models.Index(fields=['track_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.track_id} - {self.analysis_id}"
+
+class PlaylistGenreCount(models.Model):
+    """
+    Number of genre mentions (via track artists) in an analysed playlist.
+    """
+    analysis = models.ForeignKey(PlaylistAnalysis, on_delete=models.CASCADE, related_name='genre_counts')
+    genre = models.CharField(max_length=255)
+    count = models.IntegerField()
+
+    class Meta:
+        verbose_name = _('playlist genre count')
+        verbose_name_plural = _('playlist genre counts')
+        constraints = [
+            models.UniqueConstraint(fields=['analysis', 'genre'], name='unique_playlist_genre'),
+        ]
+        indexes = [
+            models.Index(fields=['genre', 'count']),
+        ]
+
+    def __str__(self):
+        return f"{self.genre}: {self.count}"
+
+class PlaylistArtistCount(models.Model):
+    """
+    Number of tracks per artist in an analysed playlist.
+    """
+    analysis = models.ForeignKey(PlaylistAnalysis, on_delete=models.CASCADE, related_name='artist_counts')
+    artist_id = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, blank=True, default='')
+    popularity = models.IntegerField(default=0)
+    count = models.IntegerField()
+
+    class Meta:
+        verbose_name = _('playlist artist count')
+        verbose_name_plural = _('playlist artist counts')
+        constraints = [
+            models.UniqueConstraint(fields=['analysis', 'artist_id'], name='unique_playlist_artist'),
+        ]
+        indexes = [
+            models.Index(fields=['artist_id', 'count']),
+        ]
+
+    def __str__(self):
+        return f"{self.name or self.artist_id}: {self.count}"
+
 class PublicTrend(models.Model):
     """
     Stores public music trends and statistics.
@@ -66,6 +137,10 @@ class PublicTrend(models.Model):
         verbose_name = _('public trend')
         verbose_name_plural = _('public trends')
         ordering = ['-created_at']
+        indexes = [
+            # The trends endpoint reads the newest active trend of a type
+            models.Index(fields=['trend_type', 'is_active', '-created_at']),
+        ]
 
     def __str__(self):
         return f"{self.get_trend_type_display()} - {self.created_at}"
@@ -120,3 +195,78 @@ class TrackFeatures(models.Model):
 
     def __str__(self):
         return f"{self.name} - {self.artist_name}"
+
+
+class AnalysisJob(models.Model):
+    """
+    Queued playlist analysis, processed by the run_analysis_worker command.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = [STATUS_PENDING, STATUS_RUNNING]
+    # playlist_id of jobs analysing every playlist of the user
+    LIBRARY = '*'
+    # playlist_id of jobs syncing the user's listening history
+    LISTENING_HISTORY = '~history'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    playlist_id = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    progress = models.IntegerField(default=0)
+    message = models.CharField(max_length=255, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = _('analysis job')
+        verbose_name_plural = _('analysis jobs')
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+        constraints = [
+            # At most one queued or running job per playlist and user
+            models.UniqueConstraint(
+                fields=['user', 'playlist_id'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_analysis_job'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.playlist_id} - {self.user.username} - {self.status}"
+
+class ListeningEvent(models.Model):
+    """
+    One play from a user's Spotify listening history, appended by the
+    sync_listening_history command. Only IDs and the macro-genre of the
+    primary artist are kept, track details come from the metadata cache.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='listening_events')
+    track_id = models.CharField(max_length=255)
+    artist_id = models.CharField(max_length=255, blank=True, default='')
+    genre = models.CharField(max_length=64, blank=True, default='')
+    duration_ms = models.IntegerField(default=0)
+    played_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = _('listening event')
+        verbose_name_plural = _('listening events')
+        ordering = ['-played_at']
+        constraints = [
+            # Spotify reports one play per user and timestamp, re-syncs are no-ops
+            models.UniqueConstraint(fields=['user', 'played_at'], name='unique_listening_event'),
+        ]
+
+    def __str__(self):
+        return f"{self.track_id} - {self.user.username} - {self.played_at}"
@@ -0,0 +1,91 @@
+from queue import Queue, Empty, Full
+from typing import Dict, Iterable, Iterator, List, Tuple
+from django.db import connection
+from .features import TrackFeatureStore
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# A batch is one page of tracks with the audio features and the artists
+# first seen in that page
+Batch = Tuple[List[Dict], Dict[str, Dict], Dict[str, Dict]]
+
+def track_pages(spotify_client, playlist_id: str, first_page: Dict = None, fields: str = None) -> Iterator[List[Dict]]:
+    """Yield the tracks of a playlist one page at a time."""
+    pages = spotify_client.iter_playlist_track_pages(playlist_id, first_page=first_page, fields=fields)
+    for page in pages:
+        yield [item['track'] for item in page.get('items', []) if item and item.get('track')]
+
+def with_features(pages: Iterable[List[Dict]], feature_store: TrackFeatureStore) -> Iterator[Tuple[List[Dict], Dict]]:
+    """Attach the audio features of each page, keyed by track ID."""
+    for tracks in pages:
+        yield tracks, feature_store.get_features(tracks)
+
+def with_artists(batches: Iterable[Tuple[List[Dict], Dict]], spotify_client) -> Iterator[Batch]:
+    """
+    Attach the artists of each page. Only artists not seen in an earlier
+    page are resolved, AnalysisState keeps the ones it has already added.
+    """
+    seen = set()
+    for tracks, features in batches:
+        artist_ids = {
+            artist.get('id')
+            for track in tracks if track.get('id') in features
+            for artist in track.get('artists', [])
+        }
+        artist_ids.discard(None)
+        new_ids = artist_ids - seen
+        seen |= new_ids
+        yield tracks, features, spotify_client.get_artists(list(new_ids)) if new_ids else {}
+
+def prefetch(iterable: Iterable, depth: int = 2) -> Iterator:
+    """
+    Run an iterator in a background thread, buffering at most `depth` items.
+    Lets the network-bound stages run ahead while the consumer aggregates,
+    without holding more than a few pages in memory. Exceptions are
+    re-raised in the consumer.
+    """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            # Stages may query the database from this thread
+            connection.close()
+
+    thread = threading.Thread(target=produce, name='analysis-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                item, error = queue.get(timeout=0.1)
+            except Empty:
+                if not thread.is_alive() and queue.empty():
+                    raise RuntimeError('Prefetch thread exited without finishing')
+                continue
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
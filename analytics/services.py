@@ -1,10 +1,24 @@
 from collections import Counter, defaultdict
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import List, Dict, Any
+from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Avg, Count
-from .models import PlaylistAnalysis, PublicTrend, ArtistAnalysis, TrackFeatures
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Sum
+from django.utils import timezone
+from .models import (
+    PlaylistAnalysis, PublicTrend, ArtistAnalysis, TrackFeatures,
+    PlaylistTrack, PlaylistGenreCount, PlaylistArtistCount
+)
+from .features import TrackFeatureStore
+from .engine import TrackFrame
+from .aggregates import AnalysisState
+from .pipeline import track_pages, with_features, with_artists, prefetch
+from .sketches import merge_sketches, percentiles
+from .corpus import CorpusTrendEngine
+from .similarity import playlist_similarity_matrix
 from core.spotify import SpotifyClient
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,109 +27,75 @@ class AnalyticsService:
     """
     Service class for processing and analyzing Spotify music data.
     """
+
+    # Spotify field projections covering only what the analysis reads
+    TRACK_FIELDS = 'id,name,duration_ms,popularity,artists(id,name),album(release_date)'
+    TRACK_PAGE_FIELDS = f'total,limit,offset,next,items(track({TRACK_FIELDS}))'
+    PLAYLIST_FIELDS = f'id,name,snapshot_id,tracks({TRACK_PAGE_FIELDS})'
+
+    # Distinct tracks whose features are loaded and fetched per batch in library mode
+    LIBRARY_BATCH_SIZE = 1000
     
     def __init__(self, spotify_client: SpotifyClient = None):
         self.spotify_client = spotify_client
 
-    def analyze_playlist(self, playlist_id: str, user=None) -> Dict[str, Any]:
-        """Perform comprehensive analysis of a playlist."""
+    def analyze_playlist(self, playlist_id: str, user=None, progress=None) -> Dict[str, Any]:
+        """
+        Perform comprehensive analysis of a playlist.
+        `progress` is an optional callable taking (percent, message).
+        """
         print(f"Starting analysis for playlist {playlist_id}")
         try:
-            # Get playlist data
-            playlist_data = self.spotify_client.get_playlist(playlist_id)
-            tracks_data = []
-            
-            # Fetch all tracks with pagination
-            tracks = playlist_data.get('tracks', {})
-            while tracks:
-                valid_tracks = [item['track'] for item in tracks.get('items', []) 
-                              if item and item.get('track')]
-                tracks_data.extend(valid_tracks)
-                
-                if tracks.get('next'):
-                    tracks = self.spotify_client.make_request(tracks['next'])
-                else:
-                    break
-
-            # Safety check for empty playlist
-            if not tracks_data:
-                return {
-                    'playlist_id': playlist_id,
-                    'name': playlist_data.get('name', ''),
-                    'track_count': 0,
-                    'total_duration_ms': 0,
-                    'analysis': {
-                        'genre_distribution': {},
-                        'audio_features': {},
-                        'artists': {'unique_count': 0},
-                        'popularity': {'average': 0},
-                        'decades': {},
-                        'key_distribution': {},
-                        'tempo_distribution': {}
-                    }
-                }
+            # Get playlist data, projected to the fields the analysis uses
+            playlist_data = self.spotify_client.get_playlist(playlist_id, fields=self.PLAYLIST_FIELDS)
+            total = playlist_data.get('tracks', {}).get('total') or 1
 
-            # Get audio features for all tracks
-            track_ids = [track['id'] for track in tracks_data if track.get('id')]
-            audio_features = []
-            
-            # Process track IDs in batches
-            if track_ids:
-                features_response = self.spotify_client.get_tracks_features(track_ids)
-                audio_features = features_response.get('audio_features', [])
-
-            # Combine track data with audio features
-            tracks_with_features = []
-            for track, features in zip(tracks_data, audio_features):
-                if features and track:
-                    tracks_with_features.append({**track, 'audio_features': features})
-
-            # Safety check for analysis
-            if not tracks_with_features:
-                return {
-                    'playlist_id': playlist_id,
-                    'name': playlist_data.get('name', ''),
-                    'track_count': len(tracks_data),
-                    'total_duration_ms': sum(t.get('duration_ms', 0) for t in tracks_data),
-                    'analysis': {
-                        'genre_distribution': {},
-                        'audio_features': {},
-                        'artists': {'unique_count': 0},
-                        'popularity': {'average': 0},
-                        'decades': {},
-                        'key_distribution': {},
-                        'tempo_distribution': {}
-                    }
-                }
+            # Stream the playlist page by page: tracks are fetched, enriched
+            # with features and artists in a background thread and folded into
+            # the aggregate state here, so raw payloads are dropped per page
+            pages = track_pages(
+                self.spotify_client, playlist_id,
+                first_page=playlist_data.get('tracks', {}), fields=self.TRACK_PAGE_FIELDS
+            )
+            batches = prefetch(with_artists(
+                with_features(pages, TrackFeatureStore(self.spotify_client)),
+                self.spotify_client
+            ))
 
-            # Perform analysis
-            analysis_results = {
-                'playlist_id': playlist_id,
-                'name': playlist_data['name'],
-                'track_count': len(tracks_with_features),
-                'total_duration_ms': sum(t['duration_ms'] for t in tracks_data),
-                'analysis': {
-                    'genre_distribution': self._analyze_genres(tracks_with_features),
-                    'audio_features': self._analyze_audio_features(tracks_with_features),
-                    'artists': self._analyze_artists(tracks_with_features),
-                    'popularity': self._analyze_popularity(tracks_with_features),
-                    'decades': self._analyze_decades(tracks_with_features),
-                    'key_distribution': self._analyze_keys(tracks_with_features),
-                    'tempo_distribution': self._analyze_tempo(tracks_with_features),
-                }
-            }
+            state = AnalysisState()
+            track_ids = []
+            track_index = {}
+            duration_ms = 0
+            for tracks, audio_features, artists in batches:
+                state.add_tracks(
+                    [{**t, 'audio_features': audio_features[t['id']]} for t in tracks if t.get('id') in audio_features],
+                    artists
+                )
+                duration_ms += sum(t.get('duration_ms', 0) for t in tracks)
+                for track in tracks:
+                    track_ids.append(track.get('id'))
+                    if track.get('id'):
+                        track_index[track['id']] = self._track_record(track, track['id'] in audio_features)
+                self._report(progress, 5 + 85 * min(len(track_ids) / total, 1), 'Analyzing tracks')
+
+            # Safety check for empty playlists and playlists without features
+            if not state.track_count:
+                return self._empty_results(playlist_id, playlist_data.get('name', ''), len(track_ids), duration_ms)
+
+            # The analysis is rendered from the mergeable state
+            state.add_duration(duration_ms)
+            analysis_results = self._build_results(playlist_id, playlist_data['name'], state)
 
             # Store analysis if user is provided
             if user:
-                PlaylistAnalysis.objects.update_or_create(
-                    playlist_id=playlist_id,
-                    user=user,
-                    defaults={
-                        'name': playlist_data['name'],
-                        'analysis_data': analysis_results,
-                        'track_count': len(tracks_with_features),
-                        'total_duration_ms': sum(t['duration_ms'] for t in tracks_data)
-                    }
+                self._report(progress, 95, 'Saving analysis')
+                # Local files have no ID, such playlists can't be refreshed incrementally
+                incremental = all(track_ids)
+                self._save_analysis(
+                    playlist_id, user, playlist_data['name'], analysis_results, state,
+                    snapshot_id=playlist_data.get('snapshot_id', '') if incremental else '',
+                    track_ids=track_ids,
+                    track_index=track_index
                 )
 
             return analysis_results
@@ -124,177 +104,576 @@ class AnalyticsService:
             logger.error(f"Error analyzing playlist {playlist_id}: {str(e)}")
             raise
 
-    def generate_public_trends(self) -> Dict[str, Any]:
+    def refresh_playlist(self, playlist_id: str, user, progress=None) -> Dict[str, Any]:
+        """
+        Re-analyse a stored playlist analysis incrementally.
+        Nothing is recomputed when the playlist snapshot is unchanged;
+        otherwise only added and removed tracks are applied to the stored
+        aggregate state.
+        """
+        try:
+            analysis = PlaylistAnalysis.objects.filter(playlist_id=playlist_id, user=user).first()
+            if not analysis or not analysis.snapshot_id or not analysis.aggregate_state:
+                return self.analyze_playlist(playlist_id, user=user, progress=progress)
+
+            playlist_data = self.spotify_client.get_playlist(playlist_id, fields='id,name,snapshot_id')
+            if playlist_data.get('snapshot_id') == analysis.snapshot_id:
+                logger.debug(f"Playlist {playlist_id} unchanged since last analysis")
+                return analysis.analysis_data
+
+            # Only the IDs are kept for the diff, plus the payloads of tracks
+            # occurring more often than in the stored snapshot
+            self._report(progress, 10, 'Fetching tracks')
+            old_counts = Counter(analysis.track_ids)
+            new_counts = Counter()
+            new_ids = []
+            tracks_by_id = {}
+            for tracks in track_pages(self.spotify_client, playlist_id, fields=self.TRACK_PAGE_FIELDS):
+                for track in tracks:
+                    track_id = track.get('id')
+                    new_ids.append(track_id)
+                    new_counts[track_id] += 1
+                    if new_counts[track_id] > old_counts[track_id]:
+                        tracks_by_id.setdefault(track_id, track)
+
+            if not all(new_ids):
+                return self.analyze_playlist(playlist_id, user=user, progress=progress)
+
+            added = new_counts - old_counts
+            removed = old_counts - new_counts
+            index = dict(analysis.track_index)
+            feature_store = TrackFeatureStore(self.spotify_client)
+
+            # Rebuild removed tracks from the stored index and TrackFeatures
+            if any(track_id not in index for track_id in removed):
+                return self.analyze_playlist(playlist_id, user=user, progress=progress)
+            removed_features = feature_store.load([t for t in removed if index[t]['f']])
+            if any(index[t]['f'] and t not in removed_features for t in removed):
+                return self.analyze_playlist(playlist_id, user=user, progress=progress)
+
+            state = AnalysisState(analysis.aggregate_state)
+            removed_tracks = [
+                self._track_from_record(track_id, index[track_id], removed_features.get(track_id))
+                for track_id, count in removed.items() for _ in range(count)
+            ]
+            state.add_tracks([t for t in removed_tracks if t.get('audio_features')], {}, sign=-1)
+            state.add_duration(-sum(t['duration_ms'] for t in removed_tracks))
+
+            # Fetch features and artists for the added tracks only
+            self._report(progress, 60, 'Analyzing changed tracks')
+            added_tracks = [tracks_by_id[track_id] for track_id, count in added.items() for _ in range(count)]
+            added_features = feature_store.get_features(added_tracks)
+            added_with_features = [
+                {**t, 'audio_features': added_features[t['id']]}
+                for t in added_tracks if t['id'] in added_features
+            ]
+            state.add_tracks(added_with_features, self._resolve_artists(added_with_features))
+            state.add_duration(sum(t.get('duration_ms', 0) for t in added_tracks))
+
+            for track_id in removed:
+                if track_id not in new_counts:
+                    del index[track_id]
+            for track_id in added:
+                index[track_id] = self._track_record(tracks_by_id[track_id], track_id in added_features)
+
+            # Sketches can't drop tracks, rebuild them from stored features
+            if state.sketches_stale:
+                current_features = feature_store.load([t for t in new_counts if index[t]['f'] and t not in added_features])
+                current_features.update(added_features)
+                state.rebuild_sketches(TrackFrame.from_tracks([
+                    {'audio_features': current_features[track_id]}
+                    for track_id in new_ids if track_id in current_features
+                ]))
+
+            logger.info(f"Refreshed playlist {playlist_id}: {sum(added.values())} added, "
+                        f"{sum(removed.values())} removed")
+
+            analysis_results = self._build_results(playlist_id, playlist_data.get('name', analysis.name), state)
+            self._save_analysis(
+                playlist_id, user, analysis_results['name'], analysis_results, state,
+                snapshot_id=playlist_data.get('snapshot_id', ''),
+                track_ids=new_ids,
+                track_index=index
+            )
+            return analysis_results
+
+        except Exception as e:
+            logger.error(f"Error refreshing playlist {playlist_id}: {str(e)}")
+            raise
+
+    def analyze_library(self, user, progress=None) -> Dict[str, Any]:
+        """
+        Analyse every playlist of a user in one batch.
+        Tracks and artists shared between playlists are fetched once: the
+        union of IDs is resolved up front and then fanned out to one
+        aggregate state per playlist. Playlists whose snapshot matches the
+        stored analysis are skipped.
+        """
+        try:
+            stored = {
+                analysis.playlist_id: analysis.snapshot_id
+                for analysis in PlaylistAnalysis.objects.filter(user=user).only('playlist_id', 'snapshot_id')
+            }
+
+            # Collect the member track IDs of every changed playlist and
+            # one copy of each distinct track
+            self._report(progress, 5, 'Fetching playlists')
+            user_playlists = [p for p in self.spotify_client.iter_user_playlists() if p and p.get('id')]
+            playlists = []
+            tracks_by_id = {}
+            local_tracks = defaultdict(list)
+            skipped = 0
+            for i, playlist in enumerate(user_playlists):
+                self._report(progress, 5 + 35 * i / len(user_playlists), 'Fetching tracks')
+                playlist_id = playlist['id']
+                if playlist.get('snapshot_id') and stored.get(playlist_id) == playlist['snapshot_id']:
+                    skipped += 1
+                    continue
+
+                track_ids = []
+                for tracks in track_pages(self.spotify_client, playlist_id, fields=self.TRACK_PAGE_FIELDS):
+                    for track in tracks:
+                        track_id = track.get('id')
+                        track_ids.append(track_id)
+                        if track_id:
+                            tracks_by_id.setdefault(track_id, track)
+                        else:
+                            local_tracks[playlist_id].append(track)
+                playlists.append((playlist, track_ids))
+
+            # Resolve features and artists once for the whole library
+            self._report(progress, 40, 'Fetching audio features')
+            feature_store = TrackFeatureStore(self.spotify_client)
+            unique_tracks = list(tracks_by_id.values())
+            audio_features = {}
+            for i in range(0, len(unique_tracks), self.LIBRARY_BATCH_SIZE):
+                audio_features.update(feature_store.get_features(unique_tracks[i:i + self.LIBRARY_BATCH_SIZE]))
+
+            self._report(progress, 70, 'Fetching artists')
+            artists = self._resolve_artists([tracks_by_id[track_id] for track_id in audio_features])
+
+            # Fan the shared data out to one state per playlist
+            analyzed = 0
+            for i, (playlist, track_ids) in enumerate(playlists):
+                playlist_id = playlist['id']
+                tracks = [tracks_by_id[track_id] for track_id in track_ids if track_id]
+                state = AnalysisState()
+                state.add_tracks(
+                    [{**t, 'audio_features': audio_features[t['id']]} for t in tracks if t['id'] in audio_features],
+                    artists
+                )
+                if not state.track_count:
+                    continue
+                state.add_duration(sum(t.get('duration_ms', 0) for t in tracks + local_tracks[playlist_id]))
+
+                name = playlist.get('name', '')
+                analysis_results = self._build_results(playlist_id, name, state)
+                incremental = all(track_ids)
+                self._save_analysis(
+                    playlist_id, user, name, analysis_results, state,
+                    snapshot_id=playlist.get('snapshot_id', '') if incremental else '',
+                    track_ids=track_ids,
+                    track_index={t['id']: self._track_record(t, t['id'] in audio_features) for t in tracks}
+                )
+                analyzed += 1
+                self._report(progress, 75 + 20 * (i + 1) / len(playlists), 'Saving analyses')
+
+            total_tracks = sum(len(track_ids) for _, track_ids in playlists)
+            logger.info(f"Analyzed library of user {user.id}: {analyzed} playlists, {skipped} unchanged, "
+                        f"{len(tracks_by_id)} distinct of {total_tracks} tracks")
+            return {
+                'playlist_count': len(user_playlists),
+                'analyzed': analyzed,
+                'skipped': skipped,
+                'track_count': total_tracks,
+                'unique_track_count': len(tracks_by_id),
+                'artist_count': len(artists),
+            }
+
+        except Exception as e:
+            logger.error(f"Error analyzing library of user {user.id}: {str(e)}")
+            raise
+
+    @staticmethod
+    def _report(progress, percent, message):
+        """Forward analysis progress to an optional callback."""
+        if progress:
+            progress(int(percent), message)
+
+    def _empty_results(self, playlist_id: str, name: str, track_count: int, duration_ms: int) -> Dict[str, Any]:
+        """Result for playlists without any analysable tracks."""
+        return {
+            'playlist_id': playlist_id,
+            'name': name,
+            'track_count': track_count,
+            'total_duration_ms': duration_ms,
+            'analysis': {
+                'genre_distribution': {},
+                'audio_features': {},
+                'artists': {'unique_count': 0},
+                'popularity': {'average': 0},
+                'decades': {},
+                'key_distribution': {},
+                'tempo_distribution': {}
+            }
+        }
+
+    def _build_results(self, playlist_id: str, name: str, state: AnalysisState) -> Dict[str, Any]:
+        """Render the stored analysis payload from aggregate state."""
+        return {
+            'playlist_id': playlist_id,
+            'name': name,
+            'track_count': state.track_count,
+            'total_duration_ms': state.total_duration_ms,
+            'analysis': state.to_analysis()
+        }
+
+    def _save_analysis(self, playlist_id: str, user, name: str, analysis_results: Dict[str, Any],
+                       state: AnalysisState, snapshot_id: str, track_ids: List[str],
+                       track_index: Dict[str, Dict]):
+        """
+        Store the analysis together with the state needed to refresh it.
+        An empty snapshot_id marks analyses that can't be refreshed incrementally.
+        """
+        with transaction.atomic():
+            analysis, _ = PlaylistAnalysis.objects.update_or_create(
+                playlist_id=playlist_id,
+                user=user,
+                defaults={
+                    'name': name,
+                    'analysis_data': analysis_results,
+                    'track_count': state.track_count,
+                    'total_duration_ms': state.total_duration_ms,
+                    'snapshot_id': snapshot_id,
+                    'track_ids': track_ids,
+                    'track_index': track_index,
+                    'aggregate_state': state.to_dict()
+                }
+            )
+            self._save_rows(analysis, state, track_ids)
+
+    def _save_rows(self, analysis: PlaylistAnalysis, state: AnalysisState, track_ids: List[str]):
+        """
+        Bring the normalized membership, genre and artist rows of an analysis
+        up to date, writing only rows that changed.
+        """
+        # Membership rows are keyed by position: appended or trailing removed
+        # tracks touch only those rows, an entry that moved is updated in place
+        wanted = {position: track_id for position, track_id in enumerate(track_ids) if track_id}
+        stale, changed = [], []
+        for row in analysis.tracks.only('id', 'position', 'track_id'):
+            track_id = wanted.pop(row.position, None)
+            if track_id is None:
+                stale.append(row.id)
+            elif track_id != row.track_id:
+                row.track_id = track_id
+                changed.append(row)
+        PlaylistTrack.objects.filter(id__in=stale).delete()
+        PlaylistTrack.objects.bulk_update(changed, ['track_id'], batch_size=1000)
+        PlaylistTrack.objects.bulk_create([
+            PlaylistTrack(analysis=analysis, track_id=track_id, position=position)
+            for position, track_id in wanted.items()
+        ], batch_size=1000)
+
+        self._sync_counts(
+            analysis, PlaylistGenreCount, 'genre',
+            {genre[:255]: {'count': count} for genre, count in state.genres.items() if count > 0}
+        )
+        self._sync_counts(
+            analysis, PlaylistArtistCount, 'artist_id',
+            {
+                artist_id: {
+                    'name': (info.get('name') or '')[:255],
+                    'popularity': info.get('popularity') or 0,
+                    'count': info['track_count'],
+                }
+                for artist_id, info in state.artists.items() if info['track_count'] > 0
+            }
+        )
+
+    @staticmethod
+    def _sync_counts(analysis: PlaylistAnalysis, model, key: str, wanted: Dict[str, Dict[str, Any]]):
+        """Upsert the count rows of an analysis whose values changed and delete the rest."""
+        fields = sorted({field for values in wanted.values() for field in values})
+        stale, changed = [], []
+        for row in model.objects.filter(analysis=analysis):
+            values = wanted.pop(getattr(row, key), None)
+            if values is None:
+                stale.append(row.id)
+            elif any(getattr(row, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(row, field, value)
+                changed.append(row)
+        model.objects.filter(id__in=stale).delete()
+        model.objects.bulk_update(changed, fields, batch_size=1000)
+        model.objects.bulk_create([
+            model(analysis=analysis, **{key: value}, **values) for value, values in wanted.items()
+        ], batch_size=1000)
+
+    def playlist_similarity(self, user) -> Dict[str, Any]:
+        """
+        Similarity matrix of a user's analysed playlists.
+        Cached until an analysis of the user is added, removed or updated.
+        """
+        analyses = PlaylistAnalysis.objects.filter(user=user)
+        # Fingerprint of every (id, last_updated) pair: a count and latest
+        # timestamp miss a delete paired with an add or an older update
+        fingerprint = hashlib.sha1()
+        for analysis_id, updated in analyses.order_by('id').values_list('id', 'last_updated'):
+            fingerprint.update(f"{analysis_id}:{updated.timestamp()};".encode())
+        cache_key = f"analytics:playlist_similarity:{user.id}:{fingerprint.hexdigest()}"
+
+        result = cache.get(cache_key)
+        if result is None:
+            result = playlist_similarity_matrix(analyses)
+            cache.set(cache_key, result, timeout=60 * 60 * 24)
+        return result
+
+    def genre_leaderboard(self, analyses, limit: int = 20) -> List[Dict[str, Any]]:
+        """Top genres across a PlaylistAnalysis queryset, aggregated in SQL."""
+        return list(
+            PlaylistGenreCount.objects.filter(analysis__in=analyses)
+            .values('genre')
+            .annotate(total=Sum('count'), playlists=Count('analysis'))
+            .order_by('-total', 'genre')[:limit]
+        )
+
+    def artist_leaderboard(self, analyses, limit: int = 20) -> List[Dict[str, Any]]:
+        """Artists on the most tracks across a PlaylistAnalysis queryset, aggregated in SQL."""
+        return list(
+            PlaylistArtistCount.objects.filter(analysis__in=analyses)
+            .values('artist_id')
+            .annotate(artist_name=Max('name'), artist_popularity=Max('popularity'),
+                      track_count=Sum('count'), playlists=Count('analysis'))
+            .order_by('-track_count', '-artist_popularity', 'artist_id')[:limit]
+        )
+
+    def track_leaderboard(self, analyses, limit: int = 20) -> List[Dict[str, Any]]:
+        """Tracks appearing in the most playlists of a PlaylistAnalysis queryset."""
+        return list(
+            PlaylistTrack.objects.filter(analysis__in=analyses)
+            .values('track_id')
+            .annotate(playlists=Count('analysis', distinct=True))
+            .order_by('-playlists', 'track_id')[:limit]
+        )
+
+    @staticmethod
+    def _track_record(track: Dict, has_features: bool) -> Dict[str, Any]:
+        """Compact per-track entry needed to remove a track from the state later."""
+        return {
+            'p': track.get('popularity', 0),
+            'r': ((track.get('album') or {}).get('release_date') or '')[:4],
+            'd': track.get('duration_ms', 0),
+            'a': [a['id'] for a in track.get('artists', []) if a.get('id')],
+            'f': has_features
+        }
+
+    @staticmethod
+    def _track_from_record(track_id: str, record: Dict[str, Any], features: Dict = None) -> Dict[str, Any]:
+        """Rebuild the track fields the aggregation reads from a stored record."""
+        return {
+            'id': track_id,
+            'popularity': record['p'],
+            'album': {'release_date': record['r']},
+            'duration_ms': record['d'],
+            'artists': [{'id': artist_id} for artist_id in record['a']],
+            'audio_features': features
+        }
+
+    # Sections a generated trend needs before it is published
+    REQUIRED_TREND_SECTIONS = ['genre_distribution', 'audio_features', 'trending_artists',
+                               'mood_analysis', 'tempo_distribution']
+
+    def refresh_public_trends(self, ttl: int = None, processes: int = 1):
+        """
+        Generate public trends and publish them as the active PublicTrend.
+        `processes` is passed on to the corpus merge.
+        Returns the new row, or None if generation failed.
+        """
+        trends = self.generate_public_trends(processes=processes)
+        if not trends or not all(section in trends for section in self.REQUIRED_TREND_SECTIONS):
+            logger.error("Generated trends are incomplete, keeping the active trend")
+            return None
+        return self.publish_public_trends(trends, ttl)
+
+    def publish_public_trends(self, trends: Dict[str, Any], ttl: int = None):
+        """Atomically replace the active general trend with new trend data."""
+        ttl = ttl or getattr(settings, 'PUBLIC_TRENDS_TTL', 60 * 60 * 24)
+        with transaction.atomic():
+            trend = PublicTrend.objects.create(
+                trend_type='general',
+                trend_data=trends,
+                valid_until=timezone.now() + timedelta(seconds=ttl),
+                is_active=True
+            )
+            # Readers see either the old or the new row as active, never neither
+            PublicTrend.objects.filter(trend_type='general', is_active=True).exclude(id=trend.id).update(is_active=False)
+        logger.info(f"Published public trends valid until {trend.valid_until}")
+        return trend
+
+    def generate_public_trends(self, processes: int = 1) -> Dict[str, Any]:
         """
         Generate public music trends from analyzed data and Spotify API.
+        Sections are built from the public playlist analyses of our users
+        once there are enough of them; Spotify is only asked for the rest.
+        Nothing is stored, see refresh_public_trends().
         """
         try:
-            logger.info("Generating public trends from Spotify data")
+            logger.info("Generating public trends")
             
-            if not self.spotify_client:
+            # Initialize trends from the analysis corpus
+            trends = CorpusTrendEngine(processes=processes).trends()
+
+            if not self.spotify_client and not ('audio_features' in trends and 'trending_artists' in trends):
                 logger.error("No Spotify client available to fetch trends")
                 return None
-                
-            # Initialize trends dictionary
-            trends = {}
             
-            # Get genre distribution (simplest part, static for now)
-            trends["genre_distribution"] = {
-                "Pop": 30,
-                "Hip Hop": 25,
-                "Rock": 20, 
-                "Electronic": 15,
-                "R&B": 10
-            }
+            # Static genre distribution until the corpus is large enough
+            if 'genre_distribution' not in trends:
+                trends["genre_distribution"] = {
+                    "Pop": 30,
+                    "Hip Hop": 25,
+                    "Rock": 20, 
+                    "Electronic": 15,
+                    "R&B": 10
+                }
             
-            # Try to fetch audio features from recommendations
-            try:
-                # Fetch recommendations for audio features
-                recommendations = self.spotify_client.get_recommendations(
-                    seed_genres=["pop", "rock", "hip-hop", "dance"], 
-                    limit=50
-                )
+            if 'audio_features' not in trends:
+                # Try to fetch audio features from recommendations
+                try:
+                    # Fetch recommendations for audio features
+                    recommendations = self.spotify_client.get_recommendations(
+                        seed_genres=["pop", "rock", "hip-hop", "dance"], 
+                        limit=50
+                    )
                 
-                if recommendations and 'tracks' in recommendations:
-                    track_ids = [track['id'] for track in recommendations.get('tracks', [])]
+                    if recommendations and 'tracks' in recommendations:
+                        track_ids = [track['id'] for track in recommendations.get('tracks', [])]
                     
-                    if track_ids:
-                        # Fetch audio features for these tracks
-                        audio_features_data = self.spotify_client.get_tracks_features(track_ids)
-                        audio_features = audio_features_data.get('audio_features', [])
+                        if track_ids:
+                            # Fetch audio features for these tracks
+                            audio_features_data = self.spotify_client.get_tracks_features(track_ids)
+                            audio_features = audio_features_data.get('audio_features', [])
                         
-                        # Calculate average audio features
-                        features_sum = defaultdict(float)
-                        feature_keys = ['danceability', 'energy', 'speechiness', 'acousticness', 
-                                       'instrumentalness', 'liveness', 'valence']
-                        count = len([af for af in audio_features if af])  # Count non-null features
+                            # Calculate average audio features
+                            features_sum = defaultdict(float)
+                            feature_keys = ['danceability', 'energy', 'speechiness', 'acousticness', 
+                                           'instrumentalness', 'liveness', 'valence']
+                            count = len([af for af in audio_features if af])  # Count non-null features
                         
-                        if count > 0:
-                            for feature in audio_features:
-                                if feature:  # Skip null features
-                                    for key in feature_keys:
-                                        features_sum[key] += feature.get(key, 0)
+                            if count > 0:
+                                for feature in audio_features:
+                                    if feature:  # Skip null features
+                                        for key in feature_keys:
+                                            features_sum[key] += feature.get(key, 0)
                             
-                            trends['audio_features'] = {key: features_sum[key] / count for key in feature_keys}
+                                trends['audio_features'] = {key: features_sum[key] / count for key in feature_keys}
                             
-                            # Create tempo distribution from the audio features
-                            tempo_bins = defaultdict(int)
-                            for feature in audio_features:
-                                if feature and 'tempo' in feature:
-                                    tempo = feature['tempo']
-                                    if tempo < 80:
-                                        tempo_bins['60-80 BPM'] += 1
-                                    elif tempo < 100:
-                                        tempo_bins['80-100 BPM'] += 1
-                                    elif tempo < 120:
-                                        tempo_bins['100-120 BPM'] += 1
-                                    elif tempo < 140:
-                                        tempo_bins['120-140 BPM'] += 1
-                                    elif tempo < 160:
-                                        tempo_bins['140-160 BPM'] += 1
-                                    else:
-                                        tempo_bins['160+ BPM'] += 1
+                                # Create tempo distribution from the audio features
+                                tempo_bins = defaultdict(int)
+                                for feature in audio_features:
+                                    if feature and 'tempo' in feature:
+                                        tempo = feature['tempo']
+                                        if tempo < 80:
+                                            tempo_bins['60-80 BPM'] += 1
+                                        elif tempo < 100:
+                                            tempo_bins['80-100 BPM'] += 1
+                                        elif tempo < 120:
+                                            tempo_bins['100-120 BPM'] += 1
+                                        elif tempo < 140:
+                                            tempo_bins['120-140 BPM'] += 1
+                                        elif tempo < 160:
+                                            tempo_bins['140-160 BPM'] += 1
+                                        else:
+                                            tempo_bins['160+ BPM'] += 1
                             
-                            # Calculate percentages for tempo distribution
-                            tempo_distribution = {}
-                            total = sum(tempo_bins.values())
-                            if total > 0:
-                                for bin_key, count in tempo_bins.items():
-                                    tempo_distribution[bin_key] = round((count / total) * 100)
+                                # Calculate percentages for tempo distribution
+                                tempo_distribution = {}
+                                total = sum(tempo_bins.values())
+                                if total > 0:
+                                    for bin_key, count in tempo_bins.items():
+                                        tempo_distribution[bin_key] = round((count / total) * 100)
                             
-                            trends['tempo_distribution'] = tempo_distribution
+                                trends['tempo_distribution'] = tempo_distribution
                 
-            except Exception as e:
-                logger.error(f"Error getting audio features from recommendations: {str(e)}")
-                # Use fallback audio features
-                trends['audio_features'] = {
-                    "danceability": 0.71,
-                    "energy": 0.68,
-                    "valence": 0.62,
-                    "acousticness": 0.21,
-                    "instrumentalness": 0.08,
-                    "speechiness": 0.09,
-                    "liveness": 0.16
-                }
+                except Exception as e:
+                    logger.error(f"Error getting audio features from recommendations: {str(e)}")
+                    # Use fallback audio features
+                    trends['audio_features'] = {
+                        "danceability": 0.71,
+                        "energy": 0.68,
+                        "valence": 0.62,
+                        "acousticness": 0.21,
+                        "instrumentalness": 0.08,
+                        "speechiness": 0.09,
+                        "liveness": 0.16
+                    }
                 
-                # Use fallback tempo distribution
-                trends['tempo_distribution'] = {
-                    "60-80 BPM": 10,
-                    "80-100 BPM": 25,
-                    "100-120 BPM": 40,
-                    "120-140 BPM": 15,
-                    "140-160 BPM": 8,
-                    "160+ BPM": 2
-                }
+                    # Use fallback tempo distribution
+                    trends['tempo_distribution'] = {
+                        "60-80 BPM": 10,
+                        "80-100 BPM": 25,
+                        "100-120 BPM": 40,
+                        "120-140 BPM": 15,
+                        "140-160 BPM": 8,
+                        "160+ BPM": 2
+                    }
             
-            # Try to get trending artists from new releases
-            try:
-                new_releases = self.spotify_client.get_new_releases(limit=20)
+            if 'trending_artists' not in trends:
+                # Try to get trending artists from new releases
+                try:
+                    new_releases = self.spotify_client.get_new_releases(limit=20)
                 
-                if new_releases and 'albums' in new_releases:
-                    # Get some popular artists from new releases
-                    trending_artists = []
-                    processed_artists = set()
-                    
-                    # Process new releases to extract artists
-                    for album in new_releases.get('albums', {}).get('items', []):
-                        for artist in album.get('artists', []):
-                            artist_id = artist.get('id')
-                            
-                            # Skip if we already processed this artist
-                            if artist_id in processed_artists:
-                                continue
-                                
-                            # Get detailed artist info
-                            try:
-                                artist_data = self.spotify_client.get_artist(artist_id)
-                                trending_artists.append({
-                                    "name": artist_data.get('name'),
-                                    "image": artist_data.get('images', [{}])[0].get('url') if artist_data.get('images') else "/static/img/default-artist.png",
-                                    "genres": artist_data.get('genres', [])[:3],
-                                    "popularity": artist_data.get('popularity', 0)
-                                })
-                                processed_artists.add(artist_id)
-                                
-                                # Stop when we have enough artists
-                                if len(trending_artists) >= 4:
-                                    break
-                            except Exception as e:
-                                logger.warning(f"Failed to get artist details: {str(e)}")
+                    if new_releases and 'albums' in new_releases:
+                        # Resolve the artists of all new releases in batched requests
+                        artist_ids = [
+                            artist.get('id')
+                            for album in new_releases.get('albums', {}).get('items', [])
+                            for artist in album.get('artists', [])
+                        ]
+                        trending_artists = [
+                            {
+                                "name": artist_data.get('name'),
+                                "image": artist_data.get('images', [{}])[0].get('url') if artist_data.get('images') else "/static/img/default-artist.png",
+                                "genres": artist_data.get('genres', [])[:3],
+                                "popularity": artist_data.get('popularity', 0)
+                            }
+                            for artist_data in self.spotify_client.get_artists(artist_ids).values()
+                        ]
                     
-                    # Sort by popularity (descending)
-                    trending_artists.sort(key=lambda x: x['popularity'], reverse=True)
-                    trends['trending_artists'] = trending_artists[:4]  # Limit to top 4
+                        # Sort by popularity (descending)
+                        trending_artists.sort(key=lambda x: x['popularity'], reverse=True)
+                        trends['trending_artists'] = trending_artists[:4]  # Limit to top 4
             
-            except Exception as e:
-                logger.error(f"Error fetching new releases: {str(e)}")
-                # Use fallback trending artists
-                trends['trending_artists'] = [
-                    {
-                        "name": "Taylor Swift",
-                        "image": "/static/img/default-artist.png",
-                        "genres": ["pop", "country pop"],
-                        "popularity": 92
-                    },
-                    {
-                        "name": "The Weeknd",
-                        "image": "/static/img/default-artist.png",
-                        "genres": ["canadian pop", "r&b"],
-                        "popularity": 90
-                    },
-                    {
-                        "name": "Bad Bunny",
-                        "image": "/static/img/default-artist.png",
-                        "genres": ["reggaeton", "latin"],
-                        "popularity": 88
-                    },
-                    {
-                        "name": "Drake",
-                        "image": "/static/img/default-artist.png",
-                        "genres": ["canadian hip hop", "rap"],
-                        "popularity": 86
-                    }
-                ]
+                except Exception as e:
+                    logger.error(f"Error fetching new releases: {str(e)}")
+                    # Use fallback trending artists
+                    trends['trending_artists'] = [
+                        {
+                            "name": "Taylor Swift",
+                            "image": "/static/img/default-artist.png",
+                            "genres": ["pop", "country pop"],
+                            "popularity": 92
+                        },
+                        {
+                            "name": "The Weeknd",
+                            "image": "/static/img/default-artist.png",
+                            "genres": ["canadian pop", "r&b"],
+                            "popularity": 90
+                        },
+                        {
+                            "name": "Bad Bunny",
+                            "image": "/static/img/default-artist.png",
+                            "genres": ["reggaeton", "latin"],
+                            "popularity": 88
+                        },
+                        {
+                            "name": "Drake",
+                            "image": "/static/img/default-artist.png",
+                            "genres": ["canadian hip hop", "rap"],
+                            "popularity": 86
+                        }
+                    ]
             
             # Generate mood analysis based on audio features
             try:
@@ -346,28 +725,9 @@ class AnalyticsService:
                 }
 
             # Check if we have all the necessary sections
-            required_sections = ['genre_distribution', 'audio_features', 'trending_artists', 
-                                'mood_analysis', 'tempo_distribution']
-            for section in required_sections:
+            for section in self.REQUIRED_TREND_SECTIONS:
                 if section not in trends:
                     logger.warning(f"Missing required trend section: {section}")
-            
-            # Store the trends in the database
-            if trends and all(section in trends for section in required_sections):
-                try:
-                    # Deactivate all previous trends
-                    PublicTrend.objects.filter(trend_type='general', is_active=True).update(is_active=False)
-                    
-                    # Create new trend
-                    PublicTrend.objects.create(
-                        trend_type='general',
-                        trend_data=trends,
-                        valid_until=datetime.now() + timedelta(days=1),
-                        is_active=True
-                    )
-                    logger.info("Successfully stored new trends in database")
-                except Exception as e:
-                    logger.error(f"Error saving trends to database: {str(e)}")
 
             return trends
 
@@ -375,189 +735,22 @@ class AnalyticsService:
             logger.error(f"Error generating public trends: {str(e)}")
             return None
 
-    def _analyze_genres(self, tracks: List[Dict]) -> Dict[str, int]:
-        """Analyze genre distribution in tracks."""
-        genres = []
-        for track in tracks:
-            for artist in track['artists']:
-                artist_data = self.spotify_client.get_artist(artist['id'])
-                genres.extend(artist_data.get('genres', []))
-        
-        genre_counts = Counter(genres)
-        total = sum(genre_counts.values())
-        
-        return {
-            genre: {'count': count, 'percentage': (count/total)*100}
-            for genre, count in genre_counts.most_common()
-        }
-
-    def _analyze_audio_features(self, tracks: List[Dict]) -> Dict[str, float]:
-        """Analyze average audio features of tracks."""
-        features = defaultdict(list)
-        
-        for track in tracks:
-            if 'audio_features' in track:
-                for key, value in track['audio_features'].items():
-                    if isinstance(value, (int, float)):
-                        features[key].append(value)
-        
-        return {
-            feature: sum(values) / len(values)
-            for feature, values in features.items()
-            if values
-        }
-
-    def _analyze_artists(self, tracks: List[Dict]) -> Dict[str, Any]:
-        """Analyze artist distribution and information."""
-        artist_counts = Counter()
-        artist_info = {}
-        
-        for track in tracks:
-            for artist in track['artists']:
-                artist_counts[artist['id']] += 1
-                if artist['id'] not in artist_info:
-                    artist_data = self.spotify_client.get_artist(artist['id'])
-                    artist_info[artist['id']] = {
-                        'name': artist['name'],
-                        'popularity': artist_data.get('popularity', 0),
-                        'genres': artist_data.get('genres', [])
-                    }
-
-        total_tracks = len(tracks)
-        return {
-            'artist_distribution': {
-                artist_id: {
-                    **artist_info[artist_id],
-                    'track_count': count,
-                    'percentage': (count/total_tracks)*100
-                }
-                for artist_id, count in artist_counts.most_common()
-            }
-        }
-
-    def _analyze_popularity(self, tracks: List[Dict]) -> Dict[str, Any]:
-        """Analyze track popularity distribution."""
-        popularities = [track.get('popularity', 0) for track in tracks]
-        avg_popularity = sum(popularities) / len(popularities)
-        
-        popularity_ranges = {
-            'high': len([p for p in popularities if p >= 70]),
-            'medium': len([p for p in popularities if 30 <= p < 70]),
-            'low': len([p for p in popularities if p < 30])
-        }
-        
-        return {
-            'average_popularity': avg_popularity,
-            'popularity_distribution': popularity_ranges
-        }
+    def _resolve_artists(self, tracks: List[Dict]) -> Dict[str, Dict]:
+        """Fetch full artist objects for every artist appearing in tracks."""
+        artist_ids = [
+            artist.get('id')
+            for track in tracks
+            for artist in track.get('artists', [])
+        ]
+        return self.spotify_client.get_artists(artist_ids)
 
-    def _analyze_decades(self, tracks: List[Dict]) -> Dict[str, int]:
-        """Analyze track release date distribution by decades."""
-        decades = Counter()
-        
-        for track in tracks:
-            if 'release_date' in track['album']:
-                year = int(track['album']['release_date'][:4])
-                decade = f"{year//10*10}s"
-                decades[decade] += 1
-        
-        return dict(decades.most_common())
-
-    def _analyze_keys(self, tracks: List[Dict]) -> Dict[str, int]:
-        """Analyze musical key distribution."""
-        key_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        keys = Counter()
-        
-        for track in tracks:
-            if 'audio_features' in track:
-                key = track['audio_features'].get('key')
-                mode = track['audio_features'].get('mode')
-                if key is not None and mode is not None:
-                    key_name = f"{key_names[key]} {'major' if mode else 'minor'}"
-                    keys[key_name] += 1
-        
-        return dict(keys.most_common())
-
-    def _analyze_tempo(self, tracks: List[Dict]) -> Dict[str, int]:
-        """Analyze tempo distribution."""
-        tempo_ranges = {
-            'slow': (0, 90),
-            'medium': (90, 120),
-            'fast': (120, 1000)
-        }
-        
-        tempos = defaultdict(int)
-        for track in tracks:
-            if 'audio_features' in track:
-                tempo = track['audio_features'].get('tempo', 0)
-                for range_name, (min_tempo, max_tempo) in tempo_ranges.items():
-                    if min_tempo <= tempo < max_tempo:
-                        tempos[range_name] += 1
-                        break
-        
-        return dict(tempos)
-
-    def _aggregate_genre_trends(self, analyses) -> Dict[str, int]:
-        """Aggregate genre trends from multiple playlist analyses."""
-        genre_counts = Counter()
-        
-        for analysis in analyses:
-            genres = analysis.analysis_data['analysis']['genre_distribution']
-            for genre, data in genres.items():
-                genre_counts[genre] += data['count']
-        
-        return dict(genre_counts.most_common(20))
-
-    def _aggregate_audio_features(self, analyses) -> Dict[str, float]:
-        """Aggregate average audio features from multiple playlist analyses."""
-        features = defaultdict(list)
-        
-        for analysis in analyses:
-            audio_features = analysis.analysis_data['analysis']['audio_features']
-            for feature, value in audio_features.items():
-                features[feature].append(value)
-        
+    def feature_percentiles(self, analyses, points=(10, 25, 50, 75, 90)) -> Dict[str, Any]:
+        """
+        Percentiles of the audio features across a PlaylistAnalysis queryset.
+        Only the stored sketches are read and merged, never the tracks.
+        """
+        sketches = merge_sketches(analyses.values_list('aggregate_state__sketches', flat=True).iterator())
         return {
-            feature: sum(values) / len(values)
-            for feature, values in features.items()
+            'track_count': int(max((sketch.count for sketch in sketches.values()), default=0)),
+            'percentiles': percentiles(sketches, points),
         }
-
-    def _aggregate_artist_trends(self, analyses) -> Dict[str, Dict]:
-        """Aggregate artist popularity from multiple playlist analyses."""
-        artist_data = defaultdict(lambda: {'count': 0, 'popularity': 0})
-        
-        for analysis in analyses:
-            artists = analysis.analysis_data['analysis']['artists']['artist_distribution']
-            for artist_id, data in artists.items():
-                artist_data[artist_id]['count'] += data['track_count']
-                artist_data[artist_id]['name'] = data['name']
-                artist_data[artist_id]['popularity'] = data['popularity']
-                artist_data[artist_id]['genres'] = data['genres']
-        
-        return dict(sorted(
-            artist_data.items(),
-            key=lambda x: (x[1]['count'], x[1]['popularity']),
-            reverse=True
-        )[:20])
-
-    def _aggregate_tempo_trends(self, analyses) -> Dict[str, int]:
-        """Aggregate tempo distributions from multiple playlist analyses."""
-        tempo_counts = Counter()
-        
-        for analysis in analyses:
-            tempo_dist = analysis.analysis_data['analysis']['tempo_distribution']
-            for tempo_range, count in tempo_dist.items():
-                tempo_counts[tempo_range] += count
-        
-        return dict(tempo_counts)
-
-    def _aggregate_key_trends(self, analyses) -> Dict[str, int]:
-        """Aggregate key distributions from multiple playlist analyses."""
-        key_counts = Counter()
-        
-        for analysis in analyses:
-            key_dist = analysis.analysis_data['analysis']['key_distribution']
-            for key, count in key_dist.items():
-                key_counts[key] += count
-        
-        return dict(key_counts)
\ No newline at end of file
@@ -0,0 +1,348 @@
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
+from django.conf import settings
+from django.utils import timezone
+from .models import TrackFeatures, PlaylistGenreCount
+from .features import FEATURE_FIELDS
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Audio features making up a track's vector, standardized per dimension
+VECTOR_FIELDS = [
+    'danceability', 'energy', 'speechiness', 'acousticness', 'instrumentalness',
+    'liveness', 'valence', 'tempo', 'loudness'
+]
+
+class TrackFeatureIndex:
+    """
+    Inverted-file (IVF) nearest-neighbour index over track feature vectors.
+
+    Vectors are standardized, clustered with k-means and stored grouped by
+    cluster, so a query only scans the `nprobe` clusters closest to it.
+    Arrays are saved as .npy files and loaded memory-mapped: a process
+    only pages in the clusters its queries touch.
+    """
+
+    # Upper bound of training points for k-means
+    TRAIN_SAMPLE = 100000
+    TRAIN_ITERATIONS = 10
+    # Rows assigned to clusters per block, bounds memory during assignment
+    ASSIGN_BLOCK = 65536
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, ids: np.ndarray,
+                 offsets: np.ndarray, mean: np.ndarray, scale: np.ndarray, built_at: datetime):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.mean = mean
+        self.scale = scale
+        self.built_at = built_at
+
+    def __len__(self):
+        return len(self.ids)
+
+    def normalize(self, vectors: np.ndarray) -> np.ndarray:
+        return ((np.asarray(vectors, dtype=np.float32) - self.mean) / self.scale).astype(np.float32)
+
+    @classmethod
+    def build(cls, ids: List[str], raw_vectors: np.ndarray, n_lists: int = None, seed: int = 0,
+              built_at: datetime = None) -> 'TrackFeatureIndex':
+        """
+        Train the clusters and build an index over raw feature vectors.
+        `built_at` should be taken before the rows were read, so rows written
+        during the build are picked up by the next extend().
+        """
+        raw_vectors = np.asarray(raw_vectors, dtype=np.float32)
+        mean = raw_vectors.mean(axis=0) if len(raw_vectors) else np.zeros(len(VECTOR_FIELDS), dtype=np.float32)
+        scale = raw_vectors.std(axis=0) if len(raw_vectors) else np.ones(len(VECTOR_FIELDS), dtype=np.float32)
+        scale[scale == 0] = 1
+
+        vectors = ((raw_vectors - mean) / scale).astype(np.float32)
+        n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        centroids = cls._train(vectors, n_lists, seed)
+        index = cls(centroids, np.empty((0, len(VECTOR_FIELDS)), dtype=np.float32), np.empty(0, dtype='S1'),
+                    np.zeros(len(centroids) + 1, dtype=np.int64), mean, scale, built_at or timezone.now())
+        return index._with(ids, vectors, built_at=index.built_at)
+
+    @classmethod
+    def _train(cls, vectors: np.ndarray, n_lists: int, seed: int) -> np.ndarray:
+        """Plain k-means on a sample of the vectors."""
+        if not len(vectors):
+            return np.zeros((1, len(VECTOR_FIELDS)), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), cls.TRAIN_SAMPLE), replace=False)]
+        n_lists = min(n_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(cls.TRAIN_ITERATIONS):
+            assignment = cls._nearest(sample, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        return centroids
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # |v - c|^2 = |v|^2 - 2 v.c + |c|^2, |v|^2 doesn't change the argmin
+        distances = (centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T
+        return distances.argmin(axis=1)
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.concatenate([
+            self._nearest(vectors[i:i + self.ASSIGN_BLOCK], self.centroids)
+            for i in range(0, len(vectors), self.ASSIGN_BLOCK)
+        ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+    def _with(self, ids: List[str], vectors: np.ndarray, replace: np.ndarray = None,
+              built_at: datetime = None) -> 'TrackFeatureIndex':
+        """
+        Return a new index with normalized vectors added to the existing clusters.
+        Existing rows whose ID is in `replace` are dropped first.
+        """
+        lists = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        keep = np.ones(len(self.ids), dtype=bool) if replace is None else ~np.isin(self.ids, replace)
+
+        all_ids = np.concatenate([np.asarray(self.ids[keep]), np.array(ids, dtype=bytes)]) if len(ids) else np.asarray(self.ids[keep])
+        all_vectors = np.concatenate([np.asarray(self.vectors[keep]), vectors]).astype(np.float32)
+        all_lists = np.concatenate([lists[keep], self._assign(vectors)])
+
+        order = np.argsort(all_lists, kind='stable')
+        offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(all_lists, minlength=len(self.centroids)))
+        return TrackFeatureIndex(self.centroids, all_vectors[order], all_ids[order], offsets,
+                                 self.mean, self.scale, built_at or timezone.now())
+
+    def extend(self, ids: List[str], raw_vectors: np.ndarray, removed: List[str] = (),
+               built_at: datetime = None) -> 'TrackFeatureIndex':
+        """
+        Add or replace tracks and drop removed ones without retraining the clusters.
+        Cheap enough to run often; a full build() rebalances the clusters.
+        """
+        replace = np.array(list(ids) + list(removed), dtype=bytes)
+        return self._with(ids, self.normalize(raw_vectors), replace=replace, built_at=built_at)
+
+    def missing_ids(self, present_ids) -> List[str]:
+        """IDs in the index that are not among `present_ids`."""
+        present = np.array(list(present_ids), dtype=bytes)
+        ids = np.asarray(self.ids)
+        return [track_id.decode() for track_id in ids[~np.isin(ids, present)]]
+
+    def search(self, vector: np.ndarray, k: int = 10, nprobe: int = None,
+               exclude: str = None) -> List[Tuple[str, float]]:
+        """Return up to k (track_id, distance) pairs nearest to a raw feature vector."""
+        nprobe = nprobe or getattr(settings, 'TRACK_INDEX_NPROBE', 8)
+        query = self.normalize(vector)
+        centroid_distances = ((self.centroids - query) ** 2).sum(axis=1)
+        probe = np.argsort(centroid_distances)[:nprobe]
+
+        candidates = [np.arange(self.offsets[i], self.offsets[i + 1]) for i in probe]
+        rows = np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+        if not len(rows):
+            return []
+        distances = ((np.asarray(self.vectors[rows]) - query) ** 2).sum(axis=1)
+        if exclude is not None:
+            distances[np.asarray(self.ids[rows]) == exclude.encode()] = np.inf
+
+        count = min(k, len(rows))
+        nearest = np.argpartition(distances, count - 1)[:count]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [
+            (self.ids[rows[i]].decode(), float(np.sqrt(distances[i])))
+            for i in nearest if np.isfinite(distances[i])
+        ]
+
+    def save(self, directory: str) -> str:
+        """
+        Write the index to a new version directory and point CURRENT at it.
+        Readers switch atomically; the version CURRENT pointed at before is
+        kept for readers still on it, every older one is removed.
+        """
+        version = timezone.now().strftime('%Y%m%d%H%M%S%f')
+        path = os.path.join(directory, version)
+        os.makedirs(path)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'vectors.npy'), np.ascontiguousarray(self.vectors))
+        np.save(os.path.join(path, 'ids.npy'), np.asarray(self.ids))
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'fields': VECTOR_FIELDS,
+                'mean': self.mean.tolist(),
+                'scale': self.scale.tolist(),
+                'built_at': self.built_at.isoformat(),
+                'count': len(self),
+            }, f)
+
+        pointer = os.path.join(directory, 'CURRENT')
+        try:
+            with open(pointer) as f:
+                previous = f.read().strip()
+        except FileNotFoundError:
+            previous = None
+        with open(pointer + '.tmp', 'w') as f:
+            f.write(version)
+        os.replace(pointer + '.tmp', pointer)
+
+        for name in os.listdir(directory):
+            if name.isdigit() and name not in (version, previous):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        return path
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['TrackFeatureIndex']:
+        """Load the current version memory-mapped, or None if none was built."""
+        try:
+            with open(os.path.join(directory, 'CURRENT')) as f:
+                path = os.path.join(directory, f.read().strip())
+        except FileNotFoundError:
+            return None
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['fields'] != VECTOR_FIELDS:
+            logger.warning(f"Track index at {path} was built with other fields, rebuild it")
+            return None
+        return cls(
+            np.load(os.path.join(path, 'centroids.npy')),
+            np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'offsets.npy')),
+            np.array(meta['mean'], dtype=np.float32),
+            np.array(meta['scale'], dtype=np.float32),
+            datetime.fromisoformat(meta['built_at'])
+        )
+
+def feature_rows(queryset=None, chunk_size: int = 10000) -> Tuple[List[str], np.ndarray]:
+    """Read track IDs and raw feature vectors from TrackFeatures."""
+    queryset = queryset if queryset is not None else TrackFeatures.objects.all()
+    ids = []
+    vectors = []
+    for row in queryset.order_by().values_list('track_id', *VECTOR_FIELDS).iterator(chunk_size=chunk_size):
+        ids.append(row[0])
+        vectors.append(row[1:])
+    return ids, np.array(vectors, dtype=np.float32).reshape(-1, len(VECTOR_FIELDS))
+
+def index_directory() -> str:
+    return str(getattr(settings, 'TRACK_INDEX_DIR', os.path.join(settings.BASE_DIR, 'var', 'track_index')))
+
+class IndexHolder:
+    """
+    Process-wide handle on the saved index, reloaded when a new version
+    is published (checked at most every CHECK_INTERVAL seconds).
+    """
+
+    CHECK_INTERVAL = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+        self._checked_at = 0
+
+    def get(self) -> Optional[TrackFeatureIndex]:
+        now = time.monotonic()
+        if now - self._checked_at < self.CHECK_INTERVAL:
+            return self._index
+
+        with self._lock:
+            if now - self._checked_at < self.CHECK_INTERVAL:
+                return self._index
+            self._checked_at = now
+            directory = index_directory()
+            try:
+                with open(os.path.join(directory, 'CURRENT')) as f:
+                    version = f.read().strip()
+            except FileNotFoundError:
+                return None
+            if version != self._version:
+                self._index = TrackFeatureIndex.load(directory)
+                self._version = version
+                logger.info(f"Loaded track index version {version} ({len(self._index or [])} tracks)")
+            return self._index
+
+# Process-wide index used by the similar tracks endpoint
+track_index = IndexHolder()
+
+def similar_tracks(track_id: str, k: int = 10) -> Optional[List[Dict[str, Any]]]:
+    """
+    Tracks closest to a track in audio feature space.
+    Returns None if the track or the index is unknown.
+    """
+    index = track_index.get()
+    if index is None:
+        return None
+    row = TrackFeatures.objects.filter(track_id=track_id).values_list(*VECTOR_FIELDS).first()
+    if row is None:
+        return None
+
+    neighbours = index.search(np.array(row, dtype=np.float32), k=k, exclude=track_id)
+    names = {
+        t['track_id']: t
+        for t in TrackFeatures.objects.filter(track_id__in=[n for n, _ in neighbours]).values('track_id', 'name', 'artist_name')
+    }
+    return [
+        {
+            'track_id': neighbour_id,
+            'name': names.get(neighbour_id, {}).get('name', ''),
+            'artist_name': names.get(neighbour_id, {}).get('artist_name', ''),
+            'distance': distance,
+        }
+        for neighbour_id, distance in neighbours
+    ]
+
+def playlist_similarity_matrix(analyses, feature_weight: float = 0.5) -> Dict[str, Any]:
+    """
+    Pairwise similarity of playlist analyses.
+
+    Every playlist becomes one row joining its audio feature centroid
+    (standardized across the playlists) and its genre count vector, each
+    L2-normalized and weighted, so the full cosine similarity matrix is a
+    single matrix product. Only aggregate sums and the normalized genre
+    rows are read, never tracks.
+    """
+    rows = list(analyses.order_by('id').values_list(
+        'id', 'playlist_id', 'name', 'aggregate_state__feature_sums', 'aggregate_state__feature_counts'
+    ))
+    if not rows:
+        return {'playlists': [], 'matrix': []}
+
+    positions = {row[0]: i for i, row in enumerate(rows)}
+    columns = [FEATURE_FIELDS.index(field) for field in VECTOR_FIELDS]
+    sums = np.array([row[3] or [0.0] * len(FEATURE_FIELDS) for row in rows], dtype=float)[:, columns]
+    counts = np.array([row[4] or [0] * len(FEATURE_FIELDS) for row in rows], dtype=float)[:, columns]
+    centroids = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    spread = centroids.std(axis=0)
+    features = (centroids - centroids.mean(axis=0)) / np.where(spread > 0, spread, 1)
+
+    genre_rows = list(
+        PlaylistGenreCount.objects.filter(analysis_id__in=positions).values_list('analysis_id', 'genre', 'count')
+    )
+    genre_columns = {genre: i for i, genre in enumerate(sorted({genre for _, genre, _ in genre_rows}))}
+    genres = np.zeros((len(rows), len(genre_columns)))
+    for analysis_id, genre, count in genre_rows:
+        genres[positions[analysis_id], genre_columns[genre]] = count
+
+    def unit(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    vectors = np.hstack([
+        np.sqrt(feature_weight) * unit(features),
+        np.sqrt(1 - feature_weight) * unit(genres),
+    ])
+    matrix = vectors @ vectors.T
+    np.fill_diagonal(matrix, 1.0)
+
+    return {
+        'playlists': [{'playlist_id': row[1], 'name': row[2]} for row in rows],
+        'matrix': np.round(matrix, 4).tolist(),
+    }
@@ -0,0 +1,121 @@
+from typing import Dict, Any, Iterable
+import numpy as np
+
+class QuantileSketch:
+    """
+    Mergeable t-digest style quantile sketch.
+
+    Values are summarised as weighted centroids, kept small in the middle
+    of the distribution and near-singleton in the tails (arcsine scale
+    function). Sketches built on separate playlists can be merged and
+    queried for any quantile without revisiting the values. Removing
+    values is not supported, a sketch has to be rebuilt instead.
+    """
+
+    DEFAULT_COMPRESSION = 100
+    # Centroids buffered, relative to the compression, before compressing
+    BUFFER_FACTOR = 4
+
+    def __init__(self, compression: int = None):
+        self.compression = compression or self.DEFAULT_COMPRESSION
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self) -> float:
+        return float(self.weights.sum())
+
+    def add(self, values: Iterable[float]) -> 'QuantileSketch':
+        """Add values, NaNs are ignored."""
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, np.ones(len(values))])
+        if len(self.means) > self.BUFFER_FACTOR * self.compression:
+            self.compress()
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """Fold another sketch into this one and return self."""
+        if not len(other.means):
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        if len(self.means) > self.BUFFER_FACTOR * self.compression:
+            self.compress()
+        return self
+
+    def compress(self):
+        """Merge neighbouring centroids falling into the same unit of the scale function."""
+        if not len(self.means):
+            return
+        order = np.argsort(self.means, kind='mergesort')
+        means, weights = self.means[order], self.weights[order]
+        total = weights.sum()
+        # Quantile at the centre of every centroid, mapped onto the k-scale
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        groups = np.floor(k - k[0]).astype(int)
+        _, groups = np.unique(groups, return_inverse=True)
+        self.weights = np.bincount(groups, weights=weights)
+        self.means = np.bincount(groups, weights=means * weights) / self.weights
+
+    def quantiles(self, qs: Iterable[float]) -> np.ndarray:
+        """Estimate the values at the given quantiles (0-1)."""
+        qs = np.asarray(list(qs), dtype=float)
+        if not len(self.means):
+            return np.full(len(qs), np.nan)
+        self.compress()
+        cumulative = np.cumsum(self.weights)
+        centres = cumulative - self.weights / 2
+        # Anchor the ends on the exact minimum and maximum
+        positions = np.concatenate([[0], centres, [cumulative[-1]]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return np.interp(qs * cumulative[-1], positions, values)
+
+    def quantile(self, q: float) -> float:
+        return float(self.quantiles([q])[0])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the compressed sketch for a JSONField."""
+        self.compress()
+        return {
+            'm': [float(f'{mean:.6g}') for mean in self.means],
+            'w': self.weights.astype(int).tolist(),
+            'min': self.min if len(self.means) else None,
+            'max': self.max if len(self.means) else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], compression: int = None) -> 'QuantileSketch':
+        sketch = cls(compression)
+        if data and data.get('m'):
+            sketch.means = np.array(data['m'], dtype=float)
+            sketch.weights = np.array(data['w'], dtype=float)
+            sketch.min = data['min']
+            sketch.max = data['max']
+        return sketch
+
+def merge_sketches(sketches: Iterable[Dict[str, Dict]]) -> Dict[str, QuantileSketch]:
+    """Merge serialized per-feature sketches, as stored in aggregate state."""
+    merged = {}
+    for fields in sketches:
+        for field, data in (fields or {}).items():
+            merged.setdefault(field, QuantileSketch()).merge(QuantileSketch.from_dict(data))
+    return merged
+
+def percentiles(sketches: Dict[str, QuantileSketch], points=(10, 25, 50, 75, 90)) -> Dict[str, Dict[str, float]]:
+    """Percentile summaries per feature, e.g. {'energy': {'p50': 0.61, ...}}."""
+    return {
+        field: dict(zip((f'p{p:g}' for p in points), sketch.quantiles(np.array(points) / 100).tolist()))
+        for field, sketch in sketches.items()
+        if sketch.count
+    }
@@ -0,0 +1,100 @@
+from functools import lru_cache
+from typing import List, Dict, Iterable
+import json
+import logging
+import os
+import re
+import sys
+
+logger = logging.getLogger(__name__)
+
+TAXONOMY_PATH = os.path.join(os.path.dirname(__file__), 'data', 'genre_taxonomy.json')
+
+# Genre names are split into tokens on whitespace, hyphens and slashes,
+# so 'k-pop', 'k pop' and 'K-Pop' all read as ('k', 'pop')
+TOKEN_SEPARATORS = re.compile(r'[\s\-/]+')
+
+# Trie key marking the end of a keyword
+_END = None
+
+def _tokens(genre: str) -> List[str]:
+    return [token for token in TOKEN_SEPARATORS.split(genre.strip().lower()) if token]
+
+class GenreTaxonomy:
+    """
+    Maps Spotify micro-genres onto a small set of macro-genres.
+
+    A genre listed in the table maps directly. Otherwise its tokens are
+    matched against a trie of keywords and the keyword ending last wins,
+    longest first, since genre names end in their head ('dance pop' is
+    pop, 'pop punk' is punk). Unmatched genres map to the default.
+    Macro-genre names map to themselves, so rolling up is idempotent.
+    """
+
+    CACHE_SIZE = 16384
+
+    def __init__(self, macro_genres: Dict[str, Dict[str, List[str]]], default: str = 'Other', version: int = 1):
+        self.version = version
+        self.default = sys.intern(default)
+        self.names = [sys.intern(name) for name in macro_genres]
+        self._exact = {}
+        self._trie = {}
+
+        for name, entry in macro_genres.items():
+            name = sys.intern(name)
+            for genre in [name, *entry.get('genres', [])]:
+                self._exact[' '.join(_tokens(genre))] = name
+            for keyword in entry.get('keywords', []):
+                node = self._trie
+                for token in _tokens(keyword):
+                    node = node.setdefault(sys.intern(token), {})
+                node[_END] = name
+        self._exact[' '.join(_tokens(self.default))] = self.default
+
+        # Results are cached per instance, Spotify reuses the same few thousand names
+        self.macro_genre = lru_cache(maxsize=self.CACHE_SIZE)(self._lookup)
+
+    @classmethod
+    def load(cls, path: str = TAXONOMY_PATH) -> 'GenreTaxonomy':
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading genre taxonomy from {path}: {str(e)}")
+            raise
+        taxonomy = cls(data['macro_genres'], data.get('default', 'Other'), data.get('version', 1))
+        logger.debug(f"Loaded genre taxonomy v{taxonomy.version} with {len(taxonomy._exact)} genres")
+        return taxonomy
+
+    def _lookup(self, genre: str) -> str:
+        tokens = _tokens(genre)
+        macro = self._exact.get(' '.join(tokens))
+        if macro is not None:
+            return macro
+
+        # Best match as (last token index, keyword length, macro-genre)
+        best = None
+        for start in range(len(tokens)):
+            node = self._trie
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                if _END in node and (best is None or (end, end - start) > best[:2]):
+                    best = (end, end - start, node[_END])
+        return best[2] if best else self.default
+
+    def macro_genres(self, genres: Iterable[str]) -> List[str]:
+        """The distinct macro-genres of a list of genres, in first-seen order."""
+        return list(dict.fromkeys(self.macro_genre(genre) for genre in genres if genre))
+
+    def rollup(self, counts: Dict[str, int]) -> Dict[str, int]:
+        """Sum genre counts per macro-genre."""
+        rolled = {}
+        for genre, count in counts.items():
+            macro = self.macro_genre(genre)
+            rolled[macro] = rolled.get(macro, 0) + count
+        return rolled
+
+# Loaded once per process, on first import
+genre_taxonomy = GenreTaxonomy.load()
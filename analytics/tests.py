@@ -1,3 +1,816 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone as dt_timezone
+from importlib import import_module
+from io import StringIO
+from unittest import mock
+from django.apps import apps
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from core.cache import MetadataCache
+from users.models import User
+from .aggregates import AnalysisState, merge_states
+from .corpus import CorpusTrendEngine
+from .features import FEATURE_FIELDS, TrackFeatureStore
+from .jobs import JOB_ERROR, enqueue_analysis, enqueue_library_analysis, claim_next_job, requeue_stale_jobs, run_job
+from .listening import ListeningHistorySync
+from .models import (
+    AnalysisJob, ListeningEvent, PlaylistAnalysis, PublicTrend, PlaylistArtistCount, PlaylistGenreCount, PlaylistTrack,
+    TrackFeatures
+)
+from .management.commands.refresh_trends import Command as RefreshTrendsCommand
+from .pipeline import prefetch, track_pages, with_artists, with_features
+from .services import AnalyticsService
+from .similarity import VECTOR_FIELDS, TrackFeatureIndex
+from .sketches import QuantileSketch, merge_sketches, percentiles
+from .taxonomy import GenreTaxonomy, genre_taxonomy
+from .trends import trend_revalidator
+import json
+import numpy as np
+import os
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+def make_track(n):
+    """Track object as returned by the playlist tracks endpoint."""
+    return {
+        'id': f'track{n:04d}',
+        'name': f'Track {n}',
+        'duration_ms': 150000 + n * 1000,
+        'popularity': (n * 7) % 100,
+        'artists': [{'id': f'artist{n % 5}', 'name': f'Artist {n % 5}'}],
+        'album': {'release_date': f'{1970 + (n * 3) % 50}-01-01'},
+    }
+
+def make_features(track_id, n):
+    """Audio features covering every FEATURE_FIELDS column."""
+    values = {
+        'danceability': (n % 10) / 10, 'energy': (n % 7) / 7, 'key': n % 12,
+        'loudness': -(n % 20), 'mode': n % 2, 'speechiness': (n % 5) / 10,
+        'acousticness': (n % 4) / 4, 'instrumentalness': (n % 3) / 3,
+        'liveness': (n % 6) / 6, 'valence': (n % 9) / 9, 'tempo': 60 + (n * 13) % 140,
+        'duration_ms': 150000 + n * 1000, 'time_signature': 4,
+    }
+    return {'id': track_id, **{field: values[field] for field in FEATURE_FIELDS}}
+
+ARTISTS = {
+    f'artist{i}': {
+        'id': f'artist{i}', 'name': f'Artist {i}', 'popularity': 40 + i * 10,
+        'genres': [['dance pop'], ['uk drill', 'grime'], ['indie rock'], ['deep house'], []][i],
+    }
+    for i in range(5)
+}
+
+class FakeSpotifyClient:
+    """In-memory stand-in for SpotifyClient covering what the analysis calls."""
+
+    PAGE_SIZE = 3
+
+    def __init__(self):
+        self.playlists = {}
+        self.plays = []
+        self.recently_played_calls = []
+        self.feature_requests = []
+        self.metadata_cache = MetadataCache()
+
+    def set_playlist(self, playlist_id, numbers, snapshot_id):
+        self.playlists[playlist_id] = {
+            'name': f'Playlist {playlist_id}',
+            'snapshot_id': snapshot_id,
+            'tracks': [make_track(n) for n in numbers],
+        }
+
+    def _page(self, playlist_id, offset):
+        tracks = self.playlists[playlist_id]['tracks']
+        end = offset + self.PAGE_SIZE
+        return {
+            'items': [{'track': track} for track in tracks[offset:end]],
+            'total': len(tracks), 'limit': self.PAGE_SIZE, 'offset': offset,
+            'next': 'next' if end < len(tracks) else None,
+        }
+
+    def get_playlist(self, playlist_id, fields=None):
+        playlist = self.playlists[playlist_id]
+        return {'id': playlist_id, 'name': playlist['name'], 'snapshot_id': playlist['snapshot_id'],
+                'tracks': self._page(playlist_id, 0)}
+
+    def iter_playlist_track_pages(self, playlist_id, first_page=None, fields=None):
+        offset = 0
+        while True:
+            page = self._page(playlist_id, offset)
+            yield page
+            if not page['next']:
+                return
+            offset += self.PAGE_SIZE
+
+    def iter_user_playlists(self):
+        for playlist_id, playlist in self.playlists.items():
+            yield {'id': playlist_id, 'name': playlist['name'], 'snapshot_id': playlist['snapshot_id']}
+
+    def get_tracks_features_map(self, track_ids):
+        self.feature_requests.append(list(track_ids))
+        # Every fourth track has no audio features
+        return {
+            track_id: make_features(track_id, int(track_id[-4:]))
+            for track_id in track_ids if int(track_id[-4:]) % 4
+        }
+
+    def get_artists(self, artist_ids):
+        return {artist_id: ARTISTS[artist_id] for artist_id in artist_ids if artist_id in ARTISTS}
+
+    def get_recently_played(self, limit=20, after=None):
+        self.recently_played_calls.append(after)
+        plays = sorted(
+            (play for play in self.plays if after is None or play[1] > after),
+            key=lambda play: play[1]
+        )[:limit]
+        items = [
+            {'track': make_track(n), 'played_at': datetime.fromtimestamp(ms / 1000, dt_timezone.utc).isoformat()}
+            for n, ms in plays
+        ]
+        return {'items': items, 'cursors': {'after': str(plays[-1][1])} if plays else None}
+
+class AnalysisTestCase(TransactionTestCase):
+    # Not TestCase: the analysis pipeline reads TrackFeatures from a
+    # prefetch thread, which an open test transaction would lock out
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='listener', password='secret')
+        self.spotify = FakeSpotifyClient()
+        self.service = AnalyticsService(spotify_client=self.spotify)
+
+    def assertAlmostEqualNested(self, first, second, path='', places=6):
+        """Compare nested analysis payloads, floats to `places` decimals."""
+        if isinstance(first, dict) and isinstance(second, dict):
+            self.assertEqual(set(first), set(second), f"keys differ at {path or 'top level'}")
+            for key in first:
+                self.assertAlmostEqualNested(first[key], second[key], f'{path}.{key}', places)
+        elif isinstance(first, (list, tuple)) and isinstance(second, (list, tuple)):
+            self.assertEqual(len(first), len(second), f'lengths differ at {path}')
+            for i, (a, b) in enumerate(zip(first, second)):
+                self.assertAlmostEqualNested(a, b, f'{path}[{i}]', places)
+        elif isinstance(first, float) or isinstance(second, float):
+            self.assertAlmostEqual(first, second, places=places, msg=f'values differ at {path}')
+        else:
+            self.assertEqual(first, second, f'values differ at {path}')
+
+class TrackFeatureStoreTests(AnalysisTestCase):
+    def test_fetches_only_unknown_tracks_and_stores_them(self):
+        store = TrackFeatureStore(self.spotify)
+        first = store.get_features([make_track(n) for n in range(1, 6)])
+        self.assertEqual(set(first), {make_track(n)['id'] for n in (1, 2, 3, 5)})
+        stored = TrackFeatures.objects.get(track_id='track0002')
+        self.assertEqual((stored.name, stored.artist_name), ('Track 2', 'Artist 2'))
+
+        second = store.get_features([make_track(n) for n in range(3, 9)])
+        # Stored tracks are read from the table, only the rest is requested
+        self.assertEqual(self.spotify.feature_requests[-1], [make_track(n)['id'] for n in (4, 6, 7, 8)])
+        self.assertEqual(second[make_track(3)['id']], make_features(make_track(3)['id'], 3))
+        self.assertEqual(TrackFeatures.objects.count(), 6)
+
+    def test_incomplete_features_are_not_stored(self):
+        self.spotify.get_tracks_features_map = lambda ids: {ids[0]: {'id': ids[0], 'energy': 0.5}}
+        features = TrackFeatureStore(self.spotify).get_features([make_track(1)])
+        self.assertEqual(features, {'track0001': {'id': 'track0001', 'energy': 0.5}})
+        self.assertFalse(TrackFeatures.objects.exists())
+
+    def test_without_client_only_stored_features_are_returned(self):
+        TrackFeatureStore(self.spotify).get_features([make_track(1)])
+        self.assertEqual(set(TrackFeatureStore().get_features([make_track(1), make_track(2)])), {'track0001'})
+
+class PipelineTests(AnalysisTestCase):
+    def test_stages_attach_features_and_new_artists_per_page(self):
+        self.spotify.set_playlist('p1', list(range(1, 9)), snapshot_id='v1')
+        pages = track_pages(self.spotify, 'p1')
+        batches = list(with_artists(with_features(pages, TrackFeatureStore(self.spotify)), self.spotify))
+
+        self.assertEqual([[t['id'] for t in tracks] for tracks, _, _ in batches],
+                         [[make_track(n)['id'] for n in page] for page in ([1, 2, 3], [4, 5, 6], [7, 8])])
+        self.assertEqual(set(batches[1][1]), {make_track(n)['id'] for n in (5, 6)})
+        # Each artist is resolved in the first page it appears in (with features)
+        self.assertEqual([set(artists) for _, _, artists in batches],
+                         [{'artist1', 'artist2', 'artist3'}, {'artist0'}, set()])
+        # Features are requested page by page
+        self.assertEqual(len(self.spotify.feature_requests), 3)
+
+class PrefetchTests(SimpleTestCase):
+    def test_yields_items_in_order(self):
+        self.assertEqual(list(prefetch(iter(range(50)), depth=3)), list(range(50)))
+
+    def test_producer_runs_at_most_depth_ahead(self):
+        produced = []
+
+        def items():
+            for n in range(20):
+                produced.append(n)
+                yield n
+
+        consumer = prefetch(items(), depth=2)
+        self.assertEqual(next(consumer), 0)
+        time.sleep(0.3)
+        # One item consumed, `depth` buffered and one blocked on the full queue
+        self.assertLessEqual(len(produced), 4)
+        consumer.close()
+
+    def test_producer_errors_are_raised_in_consumer(self):
+        def items():
+            yield 1
+            raise ValueError('page failed')
+
+        consumer = prefetch(items())
+        self.assertEqual(next(consumer), 1)
+        with self.assertRaisesMessage(ValueError, 'page failed'):
+            next(consumer)
+
+    def test_closing_consumer_stops_producer(self):
+        def items():
+            n = 0
+            while True:
+                n += 1
+                yield n
+
+        consumer = prefetch(items(), depth=1)
+        next(consumer)
+        consumer.close()
+        self.assertFalse(any(thread.name == 'analysis-prefetch' for thread in threading.enumerate()))
+
+class QuantileSketchTests(SimpleTestCase):
+    QS = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+
+    def setUp(self):
+        self.values = np.random.default_rng(7).beta(2, 5, 50000)
+
+    def assertRankError(self, sketch, values, tolerance):
+        """Every estimate's rank in `values` is within `tolerance` of the asked quantile."""
+        ordered = np.sort(values)
+        for q, estimate in zip(self.QS, sketch.quantiles(self.QS)):
+            rank = np.searchsorted(ordered, estimate) / len(ordered)
+            self.assertLess(abs(rank - q), tolerance, f'quantile {q}')
+
+    def test_accuracy_and_size(self):
+        sketch = QuantileSketch().add(self.values)
+        self.assertRankError(sketch, self.values, 0.005)
+        self.assertLess(len(sketch.to_dict()['m']), 2 * QuantileSketch.DEFAULT_COMPRESSION)
+        self.assertEqual((sketch.quantile(0), sketch.quantile(1)), (self.values.min(), self.values.max()))
+
+    def test_merged_shards_match_whole(self):
+        shards = np.array_split(self.values, 37)
+        merged = QuantileSketch()
+        for shard in shards:
+            merged.merge(QuantileSketch.from_dict(QuantileSketch().add(shard).to_dict()))
+        self.assertEqual(merged.count, len(self.values))
+        self.assertRankError(merged, self.values, 0.01)
+
+    def test_merge_serialized_feature_sketches(self):
+        stored = [
+            {'energy': QuantileSketch().add(shard).to_dict()}
+            for shard in np.array_split(self.values, 4)
+        ] + [None, {}]
+        summary = percentiles(merge_sketches(stored), points=(50,))
+        self.assertAlmostEqual(summary['energy']['p50'], float(np.median(self.values)), delta=0.005)
+
+    def test_nan_and_empty(self):
+        sketch = QuantileSketch().add([np.nan, 1.0, np.nan, 3.0])
+        self.assertEqual(sketch.count, 2)
+        self.assertEqual(sketch.quantile(0.5), 2.0)
+        self.assertTrue(np.isnan(QuantileSketch().quantile(0.5)))
+        self.assertEqual(percentiles({'energy': QuantileSketch()}), {})
+
+class TrackFeatureIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        # Clustered vectors on very different per-dimension scales
+        centres = rng.normal(0, 5, (20, len(VECTOR_FIELDS)))
+        self.vectors = (centres[rng.integers(0, 20, 3000)] + rng.normal(0, 1, (3000, len(VECTOR_FIELDS)))) \
+            * np.logspace(-1, 2, len(VECTOR_FIELDS))
+        self.ids = [f't{n}' for n in range(len(self.vectors))]
+        self.index = TrackFeatureIndex.build(self.ids, self.vectors, seed=1)
+        directory = tempfile.TemporaryDirectory()
+        self.directory = directory.name
+        self.addCleanup(directory.cleanup)
+
+    def exact(self, index, vector, k):
+        """Brute-force neighbours in the index's normalized space."""
+        distances = ((index.normalize(self.vectors) - index.normalize(vector)) ** 2).sum(axis=1)
+        return [self.ids[i] for i in np.argsort(distances)[:k]]
+
+    def test_probing_every_list_is_exact(self):
+        query = self.vectors[42]
+        result = self.index.search(query, k=10, nprobe=len(self.index.centroids))
+        self.assertEqual([track_id for track_id, _ in result], self.exact(self.index, query, 10))
+        self.assertEqual(result[0], ('t42', 0.0))
+        self.assertEqual([d for _, d in result], sorted(d for _, d in result))
+
+    def test_recall_with_few_probes(self):
+        hits = 0
+        for i in range(0, 3000, 60):
+            found = {track_id for track_id, _ in self.index.search(self.vectors[i], k=10, nprobe=8)}
+            hits += len(found & set(self.exact(self.index, self.vectors[i], 10)))
+        self.assertGreater(hits / (50 * 10), 0.9)
+
+    def test_exclude(self):
+        result = self.index.search(self.vectors[42], k=5, exclude='t42')
+        self.assertNotIn('t42', [track_id for track_id, _ in result])
+        self.assertEqual(len(result), 5)
+
+    def test_extend_adds_replaces_and_removes(self):
+        moved = self.vectors[100] * -3
+        extended = self.index.extend(['t100', 'new'], np.array([moved, self.vectors[7]]), removed=['t7', 't8'])
+
+        self.assertEqual(len(extended), len(self.index) - 1)
+        self.assertEqual(sorted(extended.missing_ids(self.ids)), ['new'])
+        self.assertEqual(sorted(self.index.missing_ids(extended.ids.astype(str))), ['t7', 't8'])
+        everything = len(extended.centroids)
+        self.assertEqual(extended.search(moved, k=1, nprobe=everything)[0][0], 't100')
+        self.assertEqual(extended.search(self.vectors[7], k=1, nprobe=everything)[0][0], 'new')
+        # The original index is left untouched for readers still using it
+        self.assertEqual(self.index.search(self.vectors[7], k=1, nprobe=everything)[0][0], 't7')
+
+    def test_save_and_load_round_trip(self):
+        self.assertIsNone(TrackFeatureIndex.load(self.directory))
+        self.index.save(self.directory)
+        loaded = TrackFeatureIndex.load(self.directory)
+
+        self.assertEqual(len(loaded), len(self.index))
+        self.assertEqual(loaded.built_at, self.index.built_at)
+        for i in (0, 1234, 2999):
+            self.assertEqual(loaded.search(self.vectors[i], k=10), self.index.search(self.vectors[i], k=10))
+
+    def test_save_keeps_current_and_previous_version(self):
+        paths = [self.index.save(self.directory) for _ in range(3)]
+        versions = sorted(name for name in os.listdir(self.directory) if name.isdigit())
+        self.assertEqual(versions, sorted(os.path.basename(path) for path in paths[1:]))
+        with open(os.path.join(self.directory, 'CURRENT')) as f:
+            self.assertEqual(f.read(), os.path.basename(paths[-1]))
+
+rollup_migration = import_module('analytics.migrations.0007_rollup_macro_genres')
+
+class GenreTaxonomyTests(SimpleTestCase):
+    def setUp(self):
+        self.taxonomy = GenreTaxonomy({
+            'Pop': {'keywords': ['pop', 'k-pop'], 'genres': ['dance pop']},
+            'Rock': {'keywords': ['rock', 'punk', 'pop punk']},
+            'Electronic': {'keywords': ['house', 'deep house']},
+        })
+
+    def test_lookup(self):
+        cases = {
+            'dance pop': 'Pop',
+            # The keyword ending last wins, longer keywords first
+            'pop punk revival': 'Rock',
+            'punk pop': 'Pop',
+            'pop punk': 'Rock',
+            'deep house': 'Electronic',
+            # Case, hyphens and slashes don't matter
+            'K-Pop': 'Pop',
+            'k pop': 'Pop',
+            'Indie/Rock': 'Rock',
+            'gregorian chant': 'Other',
+            # Macro-genres map to themselves
+            'Rock': 'Rock',
+            'Other': 'Other',
+        }
+        self.assertEqual({genre: self.taxonomy.macro_genre(genre) for genre in cases}, cases)
+
+    def test_macro_genres_and_rollup(self):
+        self.assertEqual(self.taxonomy.macro_genres(['deep house', 'k-pop', 'house', '', 'dance pop']),
+                         ['Electronic', 'Pop'])
+        self.assertEqual(self.taxonomy.rollup({'dance pop': 3, 'k-pop': 2, 'garage rock': 1, 'zydeco': 4}),
+                         {'Pop': 5, 'Rock': 1, 'Other': 4})
+
+    def test_frozen_migration_copy_matches_taxonomy(self):
+        with open(os.path.join(os.path.dirname(__file__), 'data', 'genre_taxonomy.json')) as f:
+            data = json.load(f)
+        if data.get('version', 1) != rollup_migration.TAXONOMY_VERSION:
+            self.skipTest('taxonomy changed since the rollup migration')
+
+        genres = [
+            genre for entry in data['macro_genres'].values() for genre in entry['genres'] + entry['keywords']
+        ] + ['uk drill', 'pop punk', 'deep house', 'dark synthpop', 'zydeco', 'Alt-Country']
+        self.assertEqual(
+            [rollup_migration.macro_genre(genre) for genre in genres],
+            [genre_taxonomy.macro_genre(genre) for genre in genres]
+        )
+
+class GenreRollupMigrationTests(AnalysisTestCase):
+    def test_rolls_up_state_and_genre_rows(self):
+        analysis = PlaylistAnalysis.objects.create(
+            playlist_id='p1', user=self.user, name='p1', analysis_data={},
+            aggregate_state={
+                'genres': {'dance pop': 3, 'uk drill': 2, 'grime': 2},
+                'artists': {
+                    'a1': {'genres': ['dance pop', 'electropop'], 'track_count': 3},
+                    'a2': {'genres': ['uk drill', 'grime'], 'track_count': 2},
+                    'a3': {'genres': [], 'track_count': 1},
+                },
+            }
+        )
+        PlaylistGenreCount.objects.create(analysis=analysis, genre='uk drill', count=2)
+        legacy = PlaylistAnalysis.objects.create(
+            playlist_id='p2', user=self.user, name='p2',
+            analysis_data={'analysis': {'artists': {'artist_distribution': {
+                'a4': {'genres': ['deep house', 'zydeco'], 'track_count': 4},
+            }}}}
+        )
+
+        rollup_migration.rollup_genres(apps, None)
+
+        analysis.refresh_from_db()
+        self.assertEqual(analysis.aggregate_state['genres'], {'Pop': 3, 'Hip Hop': 2})
+        self.assertEqual(analysis.aggregate_state['artists']['a2']['genres'], ['Hip Hop'])
+        self.assertEqual(analysis.aggregate_state['genre_taxonomy'], rollup_migration.TAXONOMY_VERSION)
+        self.assertEqual(dict(analysis.genre_counts.values_list('genre', 'count')), {'Pop': 3, 'Hip Hop': 2})
+        # Analyses without aggregate state only get their genre rows
+        self.assertEqual(dict(legacy.genre_counts.values_list('genre', 'count')), {'Electronic': 4, 'Other': 4})
+
+class IncrementalRefreshTests(AnalysisTestCase):
+    """refresh_playlist() must store the same analysis as analysing from scratch."""
+
+    def refresh_and_compare(self, numbers):
+        self.spotify.set_playlist('p1', numbers, snapshot_id=f'snap-{len(numbers)}-{sum(numbers)}')
+        self.spotify.feature_requests.clear()
+        refreshed = self.service.refresh_playlist('p1', user=self.user)
+        analysis = PlaylistAnalysis.objects.get(playlist_id='p1', user=self.user)
+        self.refresh_requests = {track_id for request in self.spotify.feature_requests for track_id in request}
+
+        full_user = User.objects.create_user(username=f'full{len(numbers)}-{sum(numbers)}', password='secret')
+        full = self.service.analyze_playlist('p1', user=full_user)
+        full_analysis = PlaylistAnalysis.objects.get(playlist_id='p1', user=full_user)
+
+        self.assertAlmostEqualNested(refreshed, full)
+        self.assertAlmostEqualNested(analysis.aggregate_state, full_analysis.aggregate_state)
+        self.assertEqual(analysis.track_ids, [make_track(n)['id'] for n in numbers])
+        self.assertEqual(
+            list(PlaylistTrack.objects.filter(analysis=analysis).order_by('position').values_list('track_id', flat=True)),
+            analysis.track_ids
+        )
+        return analysis
+
+    def test_additions(self):
+        self.spotify.set_playlist('p1', list(range(1, 11)), snapshot_id='v1')
+        self.service.analyze_playlist('p1', user=self.user)
+
+        self.refresh_and_compare(list(range(1, 16)))
+        # Only the added tracks were looked up
+        self.assertTrue(self.refresh_requests)
+        self.assertTrue(self.refresh_requests <= {make_track(n)['id'] for n in range(11, 16)})
+
+    def test_removals(self):
+        self.spotify.set_playlist('p1', list(range(1, 16)), snapshot_id='v1')
+        self.service.analyze_playlist('p1', user=self.user)
+        self.refresh_and_compare([1, 2, 5, 6, 9, 13, 14])
+        # Removed tracks come from the stored index, a full analysis would refetch
+        self.assertEqual(self.refresh_requests, set())
+
+    def test_additions_and_removals_with_duplicates(self):
+        self.spotify.set_playlist('p1', [1, 2, 2, 3, 5, 5, 5, 8], snapshot_id='v1')
+        self.service.analyze_playlist('p1', user=self.user)
+        # One copy of 5 removed, a second copy of 3 added, 2 removed entirely
+        self.refresh_and_compare([1, 3, 3, 5, 5, 8, 9, 9])
+        self.assertEqual(self.refresh_requests, {make_track(9)['id']})
+
+    def test_unchanged_snapshot_is_not_reanalysed(self):
+        self.spotify.set_playlist('p1', list(range(1, 8)), snapshot_id='v1')
+        stored = self.service.analyze_playlist('p1', user=self.user)
+        # Tracks changed without a new snapshot: the stored analysis is kept
+        self.spotify.set_playlist('p1', list(range(1, 4)), snapshot_id='v1')
+        self.spotify.feature_requests.clear()
+
+        refreshed = self.service.refresh_playlist('p1', user=self.user)
+        self.assertAlmostEqualNested(refreshed, stored)
+        self.assertEqual(self.spotify.feature_requests, [])
+        self.assertEqual(PlaylistAnalysis.objects.get(playlist_id='p1').track_count, stored['track_count'])
+
+    def test_refresh_writes_only_changed_rows(self):
+        self.spotify.set_playlist('p1', list(range(1, 11)), snapshot_id='v1')
+        self.service.analyze_playlist('p1', user=self.user)
+        tracks = dict(PlaylistTrack.objects.filter(analysis__user=self.user).values_list('position', 'id'))
+        genres = dict(PlaylistGenreCount.objects.filter(analysis__user=self.user).values_list('genre', 'id'))
+
+        # Appending keeps every existing membership and count row
+        analysis = self.refresh_and_compare(list(range(1, 11)) + [20, 25])
+        self.assertEqual(dict(analysis.tracks.filter(position__lt=10).values_list('position', 'id')), tracks)
+        self.assertEqual(dict(analysis.genre_counts.values_list('genre', 'id')), genres)
+        self.assertEqual(
+            dict(analysis.artist_counts.values_list('artist_id', 'count')),
+            {artist_id: info['track_count'] for artist_id, info in analysis.aggregate_state['artists'].items()}
+        )
+
+        # Dropping an artist's last tracks deletes its rows
+        analysis = self.refresh_and_compare([n for n in range(1, 11) if n % 5 != 1])
+        self.assertFalse(analysis.artist_counts.filter(artist_id='artist1').exists())
+        genres = set(analysis.genre_counts.values_list('genre', flat=True))
+        self.assertNotIn('Hip Hop', genres)
+        self.assertEqual(genres, {genre for genre, count in analysis.aggregate_state['genres'].items() if count > 0})
+
+class LeaderboardTests(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        for playlist_id, numbers in [('p1', [1, 2, 3, 6]), ('p2', [2, 3, 7, 11]), ('p3', [3, 5, 13])]:
+            self.spotify.set_playlist(playlist_id, numbers, snapshot_id='v1')
+            self.service.analyze_playlist(playlist_id, user=self.user)
+        self.analyses = PlaylistAnalysis.objects.filter(user=self.user)
+
+    def test_genre_leaderboard(self):
+        board = self.service.genre_leaderboard(self.analyses)
+        self.assertEqual(board[0], {'genre': 'Electronic', 'total': 4, 'playlists': 3})
+        # Ties are broken by name
+        self.assertEqual([row['genre'] for row in board[1:]], ['Hip Hop', 'Rock', 'Pop'])
+        self.assertEqual(len(self.service.genre_leaderboard(self.analyses, limit=2)), 2)
+
+    def test_artist_leaderboard(self):
+        board = self.service.artist_leaderboard(self.analyses)
+        self.assertEqual(
+            [(row['artist_id'], row['track_count'], row['playlists']) for row in board],
+            [('artist3', 4, 3), ('artist2', 3, 2), ('artist1', 3, 2), ('artist0', 1, 1)]
+        )
+        self.assertEqual(board[0]['artist_name'], 'Artist 3')
+
+    def test_artist_leaderboard_breaks_ties_by_id(self):
+        PlaylistArtistCount.objects.update(popularity=50)
+        board = self.service.artist_leaderboard(self.analyses)
+        self.assertEqual([row['artist_id'] for row in board], ['artist3', 'artist1', 'artist2', 'artist0'])
+
+    def test_track_leaderboard(self):
+        board = self.service.track_leaderboard(self.analyses, limit=3)
+        self.assertEqual(board, [
+            {'track_id': 'track0003', 'playlists': 3},
+            {'track_id': 'track0002', 'playlists': 2},
+            {'track_id': 'track0001', 'playlists': 1},
+        ])
+
+class PlaylistSimilarityTests(AnalysisTestCase):
+    def analyze(self, playlist_id, numbers):
+        self.spotify.set_playlist(playlist_id, numbers, snapshot_id='v1')
+        self.service.analyze_playlist(playlist_id, user=self.user)
+
+    def test_matrix(self):
+        self.analyze('p1', list(range(1, 12)))
+        self.analyze('p2', list(range(1, 12)))
+        self.analyze('p3', [3, 8, 13, 18, 23])
+        result = self.service.playlist_similarity(self.user)
+
+        self.assertEqual([p['playlist_id'] for p in result['playlists']], ['p1', 'p2', 'p3'])
+        matrix = result['matrix']
+        self.assertEqual([matrix[i][i] for i in range(3)], [1.0, 1.0, 1.0])
+        self.assertEqual(matrix, [list(row) for row in zip(*matrix)])
+        # Identical playlists are as similar as can be, a different one less so
+        self.assertAlmostEqual(matrix[0][1], 1.0, places=3)
+        self.assertLess(matrix[0][2], matrix[0][1])
+
+    def test_cache_follows_removed_and_added_analyses(self):
+        self.analyze('p1', list(range(1, 12)))
+        self.analyze('p2', [3, 8, 13, 18, 23])
+        first = self.service.playlist_similarity(self.user)
+
+        # Same count and an older timestamp than the newest analysis
+        replacement = PlaylistAnalysis.objects.get(playlist_id='p2')
+        self.analyze('p3', [2, 7, 12])
+        PlaylistAnalysis.objects.filter(playlist_id='p3').update(last_updated=replacement.last_updated)
+        replacement.delete()
+
+        second = self.service.playlist_similarity(self.user)
+        self.assertEqual([p['playlist_id'] for p in first['playlists']], ['p1', 'p2'])
+        self.assertEqual([p['playlist_id'] for p in second['playlists']], ['p1', 'p3'])
+
+class LibraryAnalysisTests(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spotify.set_playlist('p1', list(range(1, 13)), snapshot_id='v1')
+        self.spotify.set_playlist('p2', list(range(7, 19)) + [7], snapshot_id='v1')
+
+    def test_shared_tracks_are_fetched_once(self):
+        result = self.service.analyze_library(self.user)
+
+        requested = [track_id for request in self.spotify.feature_requests for track_id in request]
+        self.assertEqual(sorted(requested), [make_track(n)['id'] for n in range(1, 19)])
+        self.assertEqual((result['analyzed'], result['skipped']), (2, 0))
+        self.assertEqual((result['track_count'], result['unique_track_count']), (25, 18))
+
+    def test_matches_analysing_each_playlist(self):
+        self.service.analyze_library(self.user)
+        other = User.objects.create_user(username='other', password='secret')
+        for playlist_id in ('p1', 'p2'):
+            single = self.service.analyze_playlist(playlist_id, user=other)
+            stored = PlaylistAnalysis.objects.get(playlist_id=playlist_id, user=self.user)
+            self.assertAlmostEqualNested(stored.analysis_data, single)
+            self.assertEqual(stored.track_ids, PlaylistAnalysis.objects.get(playlist_id=playlist_id, user=other).track_ids)
+
+    def test_unchanged_playlists_are_skipped(self):
+        self.service.analyze_library(self.user)
+        self.spotify.set_playlist('p2', list(range(7, 20)), snapshot_id='v2')
+        self.spotify.feature_requests.clear()
+
+        result = self.service.analyze_library(self.user)
+        self.assertEqual((result['analyzed'], result['skipped']), (1, 1))
+        self.assertEqual(PlaylistAnalysis.objects.get(playlist_id='p2', user=self.user).snapshot_id, 'v2')
+
+class MergeStateTests(AnalysisTestCase):
+    def state_of(self, numbers):
+        tracks = [
+            {**make_track(n), 'audio_features': make_features(make_track(n)['id'], n)}
+            for n in numbers if n % 4
+        ]
+        state = AnalysisState()
+        state.add_tracks(tracks, ARTISTS)
+        state.add_duration(sum(make_track(n)['duration_ms'] for n in numbers))
+        return state
+
+    def test_merge_states_matches_serial_merge(self):
+        shards = [list(range(1, 9)), list(range(5, 20)), [2, 2, 3], list(range(30, 41))]
+        merged = merge_states(self.state_of(numbers) for numbers in shards)
+
+        serial = AnalysisState()
+        for numbers in shards:
+            serial.merge(self.state_of(numbers))
+        self.assertAlmostEqualNested(merged.to_dict(), serial.to_dict())
+
+        # Merging is associative: partial merges merged again give the same state
+        partial = merge_states([
+            merge_states(self.state_of(numbers) for numbers in shards[:2]),
+            merge_states(self.state_of(numbers) for numbers in shards[2:]),
+        ])
+        self.assertAlmostEqualNested(partial.to_dict(), serial.to_dict())
+
+    def test_merged_state_matches_state_of_all_tracks(self):
+        shards = [list(range(1, 9)), list(range(9, 25))]
+        merged = merge_states(self.state_of(numbers) for numbers in shards)
+        whole = self.state_of(list(range(1, 25)))
+        self.assertAlmostEqualNested(merged.to_analysis(), whole.to_analysis())
+
+    def test_corpus_chunks_match_serial_merge(self):
+        for i, numbers in enumerate([list(range(1, 9)), list(range(5, 20)), [2, 2, 3]]):
+            self.spotify.set_playlist(f'p{i}', numbers, snapshot_id='v1')
+            self.service.analyze_playlist(f'p{i}', user=self.user)
+        PlaylistAnalysis.objects.update(is_public=True)
+
+        serial = merge_states(AnalysisState(a.aggregate_state) for a in PlaylistAnalysis.objects.all())
+        chunked = CorpusTrendEngine(chunk_size=2).compute_state()
+        self.assertAlmostEqualNested(chunked.to_dict(), serial.to_dict())
+
+class AnalysisJobTests(AnalysisTestCase):
+    def test_enqueue_reuses_active_job(self):
+        job, created = enqueue_analysis(self.user, 'p1')
+        again, created_again = enqueue_analysis(self.user, 'p1')
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(job.id, again.id)
+
+        # Other playlists and the library get their own jobs
+        self.assertTrue(enqueue_analysis(self.user, 'p2')[1])
+        self.assertTrue(enqueue_library_analysis(self.user)[1])
+        self.assertEqual(AnalysisJob.objects.count(), 3)
+
+    def test_enqueue_after_finished_job_creates_new_one(self):
+        job, _ = enqueue_analysis(self.user, 'p1')
+        AnalysisJob.objects.filter(id=job.id).update(status=AnalysisJob.STATUS_SUCCEEDED)
+        again, created = enqueue_analysis(self.user, 'p1')
+        self.assertTrue(created)
+        self.assertNotEqual(job.id, again.id)
+
+    def test_claim_takes_each_job_once_in_order(self):
+        first, _ = enqueue_analysis(self.user, 'p1')
+        second, _ = enqueue_analysis(self.user, 'p2')
+
+        claimed = claim_next_job()
+        self.assertEqual(claimed.id, first.id)
+        self.assertEqual(claimed.status, AnalysisJob.STATUS_RUNNING)
+        self.assertIsNotNone(claimed.started_at)
+        self.assertEqual(claim_next_job().id, second.id)
+        self.assertIsNone(claim_next_job())
+
+        # A running job can't be queued again, enqueue returns it
+        job, created = enqueue_analysis(self.user, 'p1')
+        self.assertFalse(created)
+        self.assertEqual(job.id, first.id)
+
+    def test_claim_skips_job_claimed_by_another_worker(self):
+        first, _ = enqueue_analysis(self.user, 'p1')
+        second, _ = enqueue_analysis(self.user, 'p2')
+        # Another worker wins the race for the oldest job
+        AnalysisJob.objects.filter(id=first.id).update(status=AnalysisJob.STATUS_RUNNING)
+        self.assertEqual(claim_next_job().id, second.id)
+
+    def test_stale_running_jobs_are_requeued(self):
+        job, _ = enqueue_analysis(self.user, 'p1')
+        claim_next_job()
+        AnalysisJob.objects.filter(id=job.id).update(started_at=datetime.now(dt_timezone.utc) - timedelta(days=1))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertEqual(claim_next_job().id, job.id)
+
+    def test_failed_job_hides_exception_details(self):
+        enqueue_analysis(self.user, 'p1')
+        job = claim_next_job()
+        with mock.patch('analytics.jobs.SpotifyClient.for_user', side_effect=RuntimeError('refresh token abc123 rejected')), \
+                self.assertLogs('analytics.jobs', 'ERROR') as logs:
+            run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_FAILED)
+        self.assertEqual(job.error, JOB_ERROR)
+        self.assertIn('abc123', logs.output[0])
+
+class ListeningHistorySyncTests(AnalysisTestCase):
+    START = 1_700_000_000_000
+
+    def add_plays(self, count, start):
+        self.spotify.plays += [(n, start + n * 60000) for n in range(1, count + 1)]
+
+    def test_cursor_advances_to_newest_play(self):
+        self.add_plays(5, self.START)
+        sync = ListeningHistorySync(self.spotify)
+        self.assertEqual(sync.sync(self.user), 5)
+        self.user.refresh_from_db()
+        newest = self.START + 5 * 60000
+        self.assertEqual(int(self.user.spotify_last_sync.timestamp() * 1000), newest)
+        self.assertEqual(self.spotify.recently_played_calls, [None])
+
+        # The next sync asks only for plays after the newest stored one
+        self.spotify.plays.append((6, newest + 60000))
+        self.assertEqual(sync.sync(self.user), 1)
+        self.assertEqual(self.spotify.recently_played_calls[-1], newest)
+        self.user.refresh_from_db()
+        self.assertEqual(int(self.user.spotify_last_sync.timestamp() * 1000), newest + 60000)
+        self.assertEqual(ListeningEvent.objects.filter(user=self.user).count(), 6)
+
+    def test_sync_without_new_plays_keeps_cursor(self):
+        self.add_plays(3, self.START)
+        sync = ListeningHistorySync(self.spotify)
+        sync.sync(self.user)
+        self.user.refresh_from_db()
+        cursor = self.user.spotify_last_sync
+
+        self.assertEqual(sync.sync(self.user), 0)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.spotify_last_sync, cursor)
+        self.assertEqual(ListeningEvent.objects.filter(user=self.user).count(), 3)
+
+    def test_replayed_plays_are_not_counted(self):
+        self.add_plays(5, self.START)
+        sync = ListeningHistorySync(self.spotify)
+        sync.sync(self.user)
+        # A stale cursor (e.g. an overlapping sync) downloads stored plays again
+        self.user.spotify_last_sync = None
+        self.spotify.plays.append((6, self.START + 6 * 60000))
+
+        self.assertEqual(sync.sync(self.user), 1)
+        self.assertEqual(ListeningEvent.objects.filter(user=self.user).count(), 6)
+
+    def test_sync_follows_pages(self):
+        self.add_plays(120, self.START)
+        self.assertEqual(ListeningHistorySync(self.spotify).sync(self.user), 120)
+        self.assertEqual(len(self.spotify.recently_played_calls), 3)
+        self.assertEqual(ListeningEvent.objects.filter(user=self.user).count(), 120)
+
+@override_settings(PUBLIC_TRENDS_REFRESH_MARGIN=60 * 60)
+class RefreshTrendsTests(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.command = RefreshTrendsCommand(stdout=StringIO(), stderr=StringIO())
+        self.command.processes = 1
+        client = mock.patch('analytics.management.commands.refresh_trends.SpotifyClient')
+        refresh = mock.patch.object(AnalyticsService, 'refresh_public_trends')
+        client.start()
+        self.refresh_public_trends = refresh.start()
+        self.addCleanup(client.stop)
+        self.addCleanup(refresh.stop)
+
+    def publish(self, valid_for):
+        return self.service.publish_public_trends({'genre_distribution': {}}, ttl=valid_for)
+
+    def test_fresh_trend_is_kept(self):
+        self.publish(valid_for=3 * 60 * 60)
+        wait, failed = self.command.refresh()
+
+        self.refresh_public_trends.assert_not_called()
+        self.assertFalse(failed)
+        # Next check is due an hour (the refresh margin) before the trend expires
+        self.assertAlmostEqual(wait, 2 * 60 * 60, delta=5)
+
+    def test_trend_is_regenerated_before_it_expires(self):
+        self.publish(valid_for=30 * 60)
+        self.refresh_public_trends.side_effect = lambda processes: self.publish(valid_for=24 * 60 * 60)
+        wait, failed = self.command.refresh()
+
+        self.refresh_public_trends.assert_called_once()
+        self.assertFalse(failed)
+        self.assertAlmostEqual(wait, 23 * 60 * 60, delta=5)
+        self.assertEqual(PublicTrend.objects.filter(is_active=True).count(), 1)
+
+    def test_skips_while_another_refresher_holds_the_lock(self):
+        trend_revalidator.mark_stale()
+        self.assertTrue(trend_revalidator.acquire())
+        wait, failed = self.command.refresh()
+
+        self.refresh_public_trends.assert_not_called()
+        self.assertFalse(failed)
+        self.assertEqual(wait, RefreshTrendsCommand.STALE_POLL)
+        # The holder's stale flag is left for it (or the next run) to clear
+        self.assertTrue(trend_revalidator.is_stale())
+
+    def test_lock_is_released_after_a_failed_run(self):
+        self.refresh_public_trends.side_effect = RuntimeError('corpus unavailable')
+        wait, failed = self.command.refresh(force=True)
+
+        self.assertTrue(failed)
+        self.assertEqual(wait, trend_revalidator.BACKOFF)
+        self.assertTrue(trend_revalidator.acquire())
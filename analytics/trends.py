@@ -0,0 +1,60 @@
+from django.core.cache import cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+class TrendRevalidator:
+    """
+    Signals that the public trends need regenerating (stale-while-revalidate).
+
+    Requests that find the active trend expired, or no trend at all, keep
+    serving what they have and only mark the trends stale. Regeneration
+    never runs in a web worker: the refresh_trends command picks the flag
+    up, regenerates once and backs off after failures. A lock keeps two
+    refreshers (e.g. overlapping cron runs) from regenerating at once.
+    """
+
+    STALE_KEY = 'analytics:public_trends:stale'
+    FAILURES_KEY = 'analytics:public_trends:failures'
+    BACKOFF_KEY = 'analytics:public_trends:backoff'
+    LOCK_KEY = 'analytics:public_trends:lock'
+    # The flag outlives a stopped refresher only for this long
+    STALE_TIMEOUT = 60 * 60
+    # Retry delay after the first failure, doubled per failure up to MAX_BACKOFF
+    BACKOFF = 60
+    MAX_BACKOFF = 60 * 60
+    # Upper bound on one regeneration; a crashed refresher's lock expires after this
+    LOCK_TIMEOUT = 30 * 60
+
+    def acquire(self) -> bool:
+        """Take the regeneration lock, False if another refresher holds it."""
+        return cache.add(self.LOCK_KEY, True, timeout=self.LOCK_TIMEOUT)
+
+    def release(self):
+        cache.delete(self.LOCK_KEY)
+
+    def mark_stale(self) -> bool:
+        """Ask the refresher to regenerate, False if it was already asked."""
+        return cache.add(self.STALE_KEY, True, timeout=self.STALE_TIMEOUT)
+
+    def is_stale(self) -> bool:
+        return bool(cache.get(self.STALE_KEY))
+
+    def backing_off(self) -> bool:
+        """Whether a recent failure's retry delay is still running."""
+        return bool(cache.get(self.BACKOFF_KEY))
+
+    def record_success(self):
+        cache.delete_many([self.STALE_KEY, self.FAILURES_KEY, self.BACKOFF_KEY])
+
+    def record_failure(self) -> float:
+        """Count a failed regeneration and return the seconds to wait before retrying."""
+        failures = (cache.get(self.FAILURES_KEY) or 0) + 1
+        cache.set(self.FAILURES_KEY, failures, timeout=None)
+        delay = min(self.BACKOFF * 2 ** (failures - 1), self.MAX_BACKOFF)
+        cache.set(self.BACKOFF_KEY, True, timeout=delay)
+        logger.warning(f"Public trend regeneration failed {failures} time(s) in a row, retrying in {delay}s")
+        return delay
+
+# Process-wide revalidator shared by the trends endpoint and refresh_trends
+trend_revalidator = TrendRevalidator()
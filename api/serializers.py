@@ -5,7 +5,8 @@ from analytics.models import (
     PlaylistAnalysis,
     PublicTrend,
     ArtistAnalysis,
-    TrackFeatures
+    TrackFeatures,
+    AnalysisJob
 )
 
 class UserSerializer(serializers.ModelSerializer):
@@ -70,6 +71,18 @@ class TrackFeaturesSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'last_updated', 'created_at']
 
+class AnalysisJobSerializer(serializers.ModelSerializer):
+    """Serializer for AnalysisJob model."""
+    job_id = serializers.IntegerField(source='id', read_only=True)
+
+    class Meta:
+        model = AnalysisJob
+        fields = [
+            'job_id', 'playlist_id', 'status', 'progress', 'message',
+            'error', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
+
 class TrendDataSerializer(serializers.Serializer):
     """Serializer for trend data response."""
     genre_distribution = serializers.DictField(
@@ -6,6 +6,12 @@ app_name = 'api'
 urlpatterns = [
     # Core API endpoints
     path('trends/', views.TrendsView.as_view(), name='trends'),
+    path('features/percentiles/', views.FeaturePercentilesView.as_view(), name='feature-percentiles'),
+    path('leaderboards/', views.LeaderboardView.as_view(), name='leaderboards'),
+    path('tracks/<str:track_id>/similar/', views.SimilarTracksView.as_view(), name='similar-tracks'),
     path('user/analytics/', views.UserAnalyticsView.as_view(), name='user-analytics'),
+    path('playlists/similarity/', views.PlaylistSimilarityView.as_view(), name='playlist-similarity'),
     path('playlists/<str:playlist_id>/refresh/', views.PlaylistAnalysisRefreshView.as_view(), name='playlist-refresh'),
+    path('library/analyze/', views.LibraryAnalysisView.as_view(), name='library-analyze'),
+    path('jobs/<int:job_id>/', views.AnalysisJobStatusView.as_view(), name='job-status'),
 ]
\ No newline at end of file
@@ -6,8 +6,13 @@ from analytics.services import AnalyticsService
 from core.spotify import SpotifyClient
 import time
 from django.conf import settings
-from .serializers import TrendDataSerializer
-from analytics.models import PublicTrend
+from .serializers import TrendDataSerializer, AnalysisJobSerializer
+from analytics.jobs import enqueue_analysis, enqueue_library_analysis, enqueue_listening_sync
+from analytics.trends import trend_revalidator
+from analytics.similarity import similar_tracks, track_index
+from analytics.listening import listening_summary
+from analytics.models import PublicTrend, AnalysisJob, PlaylistAnalysis
+from datetime import timedelta
 from django.utils import timezone
 from users.models import User
 import logging
@@ -17,115 +22,100 @@ logger = logging.getLogger(__name__)
 class TrendsView(APIView):
     """
     API endpoint for public music trends.
-    Fetches real trend data from Spotify or from cached trends in the database.
+    Serves the trends published by the refresh_trends command; expired
+    trends keep being served and are only marked stale for the command.
     """
     permission_classes = [AllowAny]
 
     def get(self, request, format=None):
         try:
-            # First, check if we have any recent trends in the database
+            # Trends are precomputed by the refresh_trends command, the
+            # request path only reads the newest active row
             cached_trend = PublicTrend.objects.filter(
                 trend_type='general',
-                is_active=True,
-                valid_until__gt=timezone.now()
+                is_active=True
             ).first()
             
             if cached_trend:
-                # Use cached trend data if available and not expired
-                logger.debug("Using cached trend data")
+                if cached_trend.valid_until <= timezone.now():
+                    # Serve the stale trend, refresh_trends regenerates it
+                    if trend_revalidator.mark_stale():
+                        logger.warning(f"Trends from {cached_trend.created_at} expired, marked stale")
                 return Response(cached_trend.trend_data)
             
-            # Otherwise, we need to generate new trend data
-            try:
-                # Initialize Spotify client with client credentials flow
-                spotify_client = SpotifyClient()
-                auth_token = spotify_client.get_client_credentials()
-                spotify_client = SpotifyClient(access_token=auth_token)
-                
-                # Initialize analytics service with the Spotify client
-                analytics_service = AnalyticsService(spotify_client=spotify_client)
-                
-                # Generate new trends
-                logger.info("Generating new trend data from Spotify")
-                trends = analytics_service.generate_public_trends()
-                
-                if not trends:
-                    raise Exception("Failed to generate trends data")
-                    
-                return Response(trends)
-            except Exception as e:
-                logger.warning(f"Error generating trends from Spotify: {str(e)}")
-                # Fall back to default data if API calls fail
-                trends = {
-                    "genre_distribution": {
-                        "Pop": 30,
-                        "Hip Hop": 25,
-                        "Rock": 20,
-                        "Electronic": 15,
-                        "R&B": 10
+            # Fall back to default data until trends are published
+            trend_revalidator.mark_stale()
+            logger.warning("No public trends published yet, serving defaults")
+            trends = {
+                "genre_distribution": {
+                    "Pop": 30,
+                    "Hip Hop": 25,
+                    "Rock": 20,
+                    "Electronic": 15,
+                    "R&B": 10
+                },
+                "audio_features": {
+                    "danceability": 0.71,
+                    "energy": 0.68,
+                    "valence": 0.62,
+                    "acousticness": 0.21,
+                    "instrumentalness": 0.08,
+                    "speechiness": 0.09,
+                    "liveness": 0.16
+                },
+                "trending_artists": [
+                    {
+                        "name": "Taylor Swift",
+                        "image": "/static/img/default-artist.png",
+                        "genres": ["pop", "country pop"],
+                        "popularity": 92
                     },
-                    "audio_features": {
-                        "danceability": 0.71,
-                        "energy": 0.68,
-                        "valence": 0.62,
-                        "acousticness": 0.21,
-                        "instrumentalness": 0.08,
-                        "speechiness": 0.09,
-                        "liveness": 0.16
+                    {
+                        "name": "The Weeknd",
+                        "image": "/static/img/default-artist.png",
+                        "genres": ["canadian pop", "r&b"],
+                        "popularity": 90
                     },
-                    "trending_artists": [
-                        {
-                            "name": "Taylor Swift",
-                            "image": "/static/img/default-artist.png",
-                            "genres": ["pop", "country pop"],
-                            "popularity": 92
-                        },
-                        {
-                            "name": "The Weeknd",
-                            "image": "/static/img/default-artist.png",
-                            "genres": ["canadian pop", "r&b"],
-                            "popularity": 90
-                        },
-                        {
-                            "name": "Bad Bunny",
-                            "image": "/static/img/default-artist.png",
-                            "genres": ["reggaeton", "latin"],
-                            "popularity": 88
-                        },
-                        {
-                            "name": "Drake",
-                            "image": "/static/img/default-artist.png",
-                            "genres": ["canadian hip hop", "rap"],
-                            "popularity": 86
-                        }
-                    ],
-                    "mood_analysis": {
-                        "metrics": {
-                            "Happy": 0.65,
-                            "Energetic": 0.72,
-                            "Relaxed": 0.43,
-                            "Melancholic": 0.36,
-                            "Aggressive": 0.28
-                        },
-                        "summary": "Current global trends show a preference for upbeat and energetic music.",
-                        "insights": {
-                            "Top mood": "Energetic with 72% prevalence",
-                            "Fastest growing": "Happy tracks increased by 8%",
-                            "Regional difference": "European listeners prefer more relaxed tracks",
-                            "Seasonal shift": "Transitioning to more upbeat music compared to last quarter"
-                        }
+                    {
+                        "name": "Bad Bunny",
+                        "image": "/static/img/default-artist.png",
+                        "genres": ["reggaeton", "latin"],
+                        "popularity": 88
+                    },
+                    {
+                        "name": "Drake",
+                        "image": "/static/img/default-artist.png",
+                        "genres": ["canadian hip hop", "rap"],
+                        "popularity": 86
+                    }
+                ],
+                "mood_analysis": {
+                    "metrics": {
+                        "Happy": 0.65,
+                        "Energetic": 0.72,
+                        "Relaxed": 0.43,
+                        "Melancholic": 0.36,
+                        "Aggressive": 0.28
                     },
-                    "tempo_distribution": {
-                        "60-80 BPM": 10,
-                        "80-100 BPM": 25,
-                        "100-120 BPM": 40,
-                        "120-140 BPM": 15,
-                        "140-160 BPM": 8,
-                        "160+ BPM": 2
+                    "summary": "Current global trends show a preference for upbeat and energetic music.",
+                    "insights": {
+                        "Top mood": "Energetic with 72% prevalence",
+                        "Fastest growing": "Happy tracks increased by 8%",
+                        "Regional difference": "European listeners prefer more relaxed tracks",
+                        "Seasonal shift": "Transitioning to more upbeat music compared to last quarter"
                     }
+                },
+                "tempo_distribution": {
+                    "60-80 BPM": 10,
+                    "80-100 BPM": 25,
+                    "100-120 BPM": 40,
+                    "120-140 BPM": 15,
+                    "140-160 BPM": 8,
+                    "160+ BPM": 2
                 }
-                
-                return Response(trends)
+            }
+            
+            return Response(trends)
             
         except Exception as e:
             logger.error(f"Error fetching trends data: {str(e)}")
@@ -165,11 +155,23 @@ class UserAnalyticsView(APIView):
                 logger.warning(f"Error fetching playlists: {str(e)}")
                 playlists = {'items': [], 'total': 0}
             
+            # Listening history comes from the local table kept up to date by
+            # sync_listening_history; a user never synced gets one sync job
+            # queued for the analysis worker
+            if user.spotify_last_sync is None and not AnalysisJob.objects.filter(
+                user=user, playlist_id=AnalysisJob.LISTENING_HISTORY
+            ).exists():
+                try:
+                    enqueue_listening_sync(user)
+                except Exception as e:
+                    logger.warning(f"Error queueing listening history sync: {str(e)}")
+            history = listening_summary(user)
+
             try:
-                recently_played = spotify.get_recently_played(limit=20)
+                recent_tracks = spotify.get_tracks([play['track_id'] for play in history['recent']])
             except Exception as e:
-                logger.warning(f"Error fetching recently played: {str(e)}")
-                recently_played = {'items': []}
+                logger.warning(f"Error fetching recent tracks: {str(e)}")
+                recent_tracks = {}
             
             try:
                 top_artists = spotify.get_user_top_artists(limit=8)
@@ -180,25 +182,13 @@ class UserAnalyticsView(APIView):
             # Return formatted data with safe access to potentially missing data
             return Response({
                 'playlist_count': playlists.get('total', 0),
-                'top_genre': 'Pop',  # This should be calculated from user's listening history
-                'tracks_analyzed': len(recently_played.get('items', [])),
-                'total_duration_ms': sum(item.get('track', {}).get('duration_ms', 0) for item in recently_played.get('items', [])),
-                'genre_distribution': {
-                    'Pop': 30,
-                    'Rock': 25,
-                    'Hip Hop': 20,
-                    'Electronic': 15,
-                    'R&B': 10
-                },
-                'audio_features': {
-                    'danceability': 0.65,
-                    'energy': 0.72,
-                    'valence': 0.54,
-                    'acousticness': 0.23,
-                    'instrumentalness': 0.12,
-                    'speechiness': 0.08,
-                    'liveness': 0.18
-                },
+                'top_genre': history['top_genre'] or 'Unknown',
+                'tracks_analyzed': history['track_count'],
+                'play_count': history['play_count'],
+                'total_duration_ms': history['total_duration_ms'],
+                'history_days': history['days'],
+                'genre_distribution': history['genre_distribution'],
+                'audio_features': history['audio_features'],
                 'playlists': [
                     {
                         'id': playlist.get('id', ''),
@@ -217,11 +207,13 @@ class UserAnalyticsView(APIView):
                 ],
                 'recent_activity': [
                     {
-                        'track_name': item.get('track', {}).get('name', 'Unknown Track'),
-                        'artist_name': item.get('track', {}).get('artists', [{}])[0].get('name', 'Unknown Artist') if item.get('track', {}).get('artists') else 'Unknown Artist',
-                        'played_at': item.get('played_at', ''),
-                        'album_image': item.get('track', {}).get('album', {}).get('images', [{}])[0].get('url', '') if item.get('track', {}).get('album', {}).get('images') else ''
-                    } for item in recently_played.get('items', [])[:10]  # Just the 10 most recent
+                        'track_name': track.get('name', 'Unknown Track'),
+                        'artist_name': track.get('artists', [{}])[0].get('name', 'Unknown Artist') if track.get('artists') else 'Unknown Artist',
+                        'played_at': play['played_at'],
+                        'album_image': track.get('album', {}).get('images', [{}])[0].get('url', '') if track.get('album', {}).get('images') else ''
+                    }
+                    for play in history['recent']
+                    for track in [recent_tracks.get(play['track_id'], {})]
                 ]
             })
             
@@ -250,25 +242,179 @@ class UserAnalyticsView(APIView):
                 'recent_activity': []
             }, status=status.HTTP_200_OK)  # Return 200 with empty data instead of 500
 
+def scoped_analyses(request, scope, days=0):
+    """
+    Resolve a 'public' or 'mine' scope to a PlaylistAnalysis queryset.
+    Returns (queryset, None) or (None, error response).
+    """
+    if scope == 'mine':
+        if not request.user.is_authenticated:
+            return None, Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+        analyses = PlaylistAnalysis.objects.filter(user=request.user)
+    elif scope == 'public':
+        analyses = PlaylistAnalysis.objects.filter(is_public=True)
+    else:
+        return None, Response({'error': "scope must be 'public' or 'mine'"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if days > 0:
+        analyses = analyses.filter(last_updated__gte=timezone.now() - timedelta(days=days))
+    return analyses, None
+
+class FeaturePercentilesView(APIView):
+    """
+    API endpoint for audio feature percentiles, merged from the quantile
+    sketches stored with each analysis.
+    Query parameters: scope ('public' or 'mine'), days (only analyses
+    updated within the window) and percentiles (e.g. '5,50,95').
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, format=None):
+        scope = request.query_params.get('scope', 'public')
+        try:
+            days = int(request.query_params.get('days', 0))
+            points = [float(p) for p in request.query_params.get('percentiles', '10,25,50,75,90').split(',')]
+        except ValueError:
+            return Response({'error': 'days and percentiles must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+        if not points or any(p < 0 or p > 100 for p in points):
+            return Response({'error': 'percentiles must be between 0 and 100'}, status=status.HTTP_400_BAD_REQUEST)
+
+        analyses, error = scoped_analyses(request, scope, days)
+        if error:
+            return error
+
+        try:
+            result = AnalyticsService().feature_percentiles(analyses, points)
+            return Response({'scope': scope, 'days': days, **result})
+        except Exception as e:
+            logger.error(f"Error computing feature percentiles: {str(e)}")
+            return Response({'error': 'Failed to compute percentiles'}, status=500)
+
+class LeaderboardView(APIView):
+    """
+    API endpoint for the top genres, artists and tracks across analyses,
+    aggregated in SQL over the normalized analysis tables.
+    Query parameters: scope ('public' or 'mine'), days and limit.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, format=None):
+        scope = request.query_params.get('scope', 'public')
+        try:
+            days = int(request.query_params.get('days', 0))
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            return Response({'error': 'days and limit must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        analyses, error = scoped_analyses(request, scope, days)
+        if error:
+            return error
+
+        try:
+            analytics_service = AnalyticsService()
+            return Response({
+                'scope': scope,
+                'days': days,
+                'genres': analytics_service.genre_leaderboard(analyses, limit),
+                'artists': analytics_service.artist_leaderboard(analyses, limit),
+                'tracks': analytics_service.track_leaderboard(analyses, limit),
+            })
+        except Exception as e:
+            logger.error(f"Error computing leaderboards: {str(e)}")
+            return Response({'error': 'Failed to compute leaderboards'}, status=500)
+
+class SimilarTracksView(APIView):
+    """
+    API endpoint for the tracks that sound most like a given track,
+    served from the audio feature nearest-neighbour index.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, track_id):
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 100)
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if track_index.get() is None:
+            return Response({'error': 'Similarity index has not been built'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        try:
+            tracks = similar_tracks(track_id, k=limit)
+        except Exception as e:
+            logger.error(f"Error finding tracks similar to {track_id}: {str(e)}")
+            return Response({'error': 'Failed to find similar tracks'}, status=500)
+
+        if tracks is None:
+            return Response({'error': 'No audio features known for this track'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'track_id': track_id, 'similar': tracks})
+
+class PlaylistSimilarityView(APIView):
+    """
+    API endpoint for the pairwise similarity of the user's analysed playlists.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        try:
+            return Response(AnalyticsService().playlist_similarity(request.user))
+        except Exception as e:
+            logger.error(f"Error computing playlist similarity: {str(e)}")
+            return Response({'error': 'Failed to compare playlists'}, status=500)
+
 class PlaylistAnalysisRefreshView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, playlist_id):
         try:
-            spotify_client = SpotifyClient(request.user.spotify_access_token)
-            analytics_service = AnalyticsService(spotify_client=spotify_client)
-            
-            # Get playlist details and perform analysis
-            analysis_data = analytics_service.analyze_playlist(playlist_id, user=request.user)
+            # Queue the analysis, the worker refreshes only what changed
+            job, created = enqueue_analysis(request.user, playlist_id)
             
             return Response({
-                'status': 'success',
-                'message': 'Analysis refreshed successfully'
-            })
+                'status': 'queued',
+                'job_id': job.id,
+                'message': 'Analysis queued' if created else 'Analysis already in progress'
+            }, status=status.HTTP_202_ACCEPTED)
             
         except Exception as e:
-            logger.error(f"Error refreshing playlist analysis: {str(e)}")
+            logger.error(f"Error queueing playlist analysis: {str(e)}")
             return Response({
                 'status': 'error',
                 'message': 'Failed to refresh analysis. Please try again.'
             }, status=500)
+
+class LibraryAnalysisView(APIView):
+    """
+    API endpoint queueing an analysis of all of the user's playlists.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        try:
+            job, created = enqueue_library_analysis(request.user)
+
+            return Response({
+                'status': 'queued',
+                'job_id': job.id,
+                'message': 'Library analysis queued' if created else 'Library analysis already in progress'
+            }, status=status.HTTP_202_ACCEPTED)
+
+        except Exception as e:
+            logger.error(f"Error queueing library analysis: {str(e)}")
+            return Response({
+                'status': 'error',
+                'message': 'Failed to analyze library. Please try again.'
+            }, status=500)
+
+class AnalysisJobStatusView(APIView):
+    """
+    API endpoint for polling the progress of a queued analysis.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = AnalysisJob.objects.filter(id=job_id, user=request.user).first()
+        if not job:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(AnalysisJobSerializer(job).data)
@@ -0,0 +1,184 @@
+from collections import OrderedDict, defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from urllib.parse import urlencode
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class MetadataCache:
+    """
+    Two-tier cache for slowly changing Spotify metadata (artists, tracks).
+
+    Lookups go through a bounded in-process LRU first and fall back to the
+    shared Django cache, so popular entities are served across workers
+    without hitting the Spotify API.
+    """
+
+    KEY_PREFIX = 'spotify:meta'
+
+    # Default time-to-live in seconds per entity type
+    DEFAULT_TTLS = {
+        'artist': 60 * 60 * 24,
+        'track': 60 * 60 * 24 * 7,
+    }
+    DEFAULT_LRU_SIZE = 10000
+
+    def __init__(self, max_size=None, ttls=None):
+        config = getattr(settings, 'SPOTIFY_METADATA_CACHE', {})
+        self.max_size = max_size or config.get('LRU_SIZE', self.DEFAULT_LRU_SIZE)
+        self.ttls = {**self.DEFAULT_TTLS, **config.get('TTLS', {}), **(ttls or {})}
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'local_hits': 0, 'shared_hits': 0, 'misses': 0})
+
+    def _key(self, entity, entity_id):
+        return f"{self.KEY_PREFIX}:{entity}:{entity_id}"
+
+    def get_many(self, entity, ids):
+        """
+        Look up several entities of one type.
+        Returns a dict of the IDs that were found; absent IDs are misses.
+        """
+        found = {}
+        remaining = []
+        now = time.monotonic()
+
+        with self._lock:
+            for entity_id in ids:
+                key = self._key(entity, entity_id)
+                entry = self._local.get(key)
+                if entry and entry[1] > now:
+                    self._local.move_to_end(key)
+                    found[entity_id] = entry[0]
+                else:
+                    if entry:
+                        del self._local[key]
+                    remaining.append(entity_id)
+            self._stats[entity]['local_hits'] += len(found)
+
+        if remaining:
+            try:
+                shared = cache.get_many([self._key(entity, i) for i in remaining])
+            except Exception as e:
+                logger.warning(f"Shared metadata cache unavailable: {str(e)}")
+                shared = {}
+
+            shared_found = {}
+            for entity_id in remaining:
+                value = shared.get(self._key(entity, entity_id))
+                if value is not None:
+                    shared_found[entity_id] = value
+
+            if shared_found:
+                self._store_local(entity, shared_found)
+                found.update(shared_found)
+
+            with self._lock:
+                self._stats[entity]['shared_hits'] += len(shared_found)
+                self._stats[entity]['misses'] += len(remaining) - len(shared_found)
+
+        return found
+
+    def get(self, entity, entity_id):
+        """Look up a single entity, returning None on a miss."""
+        return self.get_many(entity, [entity_id]).get(entity_id)
+
+    def set_many(self, entity, values):
+        """Store a dict of ID -> value in both cache tiers."""
+        if not values:
+            return
+        self._store_local(entity, values)
+        try:
+            cache.set_many(
+                {self._key(entity, i): v for i, v in values.items()},
+                timeout=self.ttls.get(entity)
+            )
+        except Exception as e:
+            logger.warning(f"Shared metadata cache unavailable: {str(e)}")
+
+    def set(self, entity, entity_id, value):
+        """Store a single entity in both cache tiers."""
+        self.set_many(entity, {entity_id: value})
+
+    def _store_local(self, entity, values):
+        expires_at = time.monotonic() + self.ttls.get(entity, 300)
+        with self._lock:
+            for entity_id, value in values.items():
+                key = self._key(entity, entity_id)
+                self._local[key] = (value, expires_at)
+                self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def clear_local(self):
+        """Drop the in-process tier (the shared tier is left untouched)."""
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        """Return hit/miss counters per entity type."""
+        with self._lock:
+            return {
+                'size': len(self._local),
+                'max_size': self.max_size,
+                'entities': {entity: dict(counts) for entity, counts in self._stats.items()},
+            }
+
+# Process-wide instance shared by all SpotifyClient objects
+metadata_cache = MetadataCache()
+
+class ConditionalResponseCache:
+    """
+    Stores Spotify response bodies with their ETag validators.
+
+    Requests send If-None-Match for stored entries and reuse the stored
+    body when Spotify answers 304 Not Modified. Every revalidation is still
+    made with the caller's own token, so an entry is only served to callers
+    Spotify would give the same response.
+    """
+
+    KEY_PREFIX = 'spotify:etag'
+    DEFAULT_TTL = 60 * 60 * 24
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or getattr(settings, 'SPOTIFY_HTTP_CACHE_TTL', self.DEFAULT_TTL)
+        self._lock = threading.Lock()
+        self._stats = {'revalidated': 0, 'stored': 0, 'misses': 0}
+
+    def key(self, url, params=None):
+        """Build the cache key for a request URL and its query parameters."""
+        query = urlencode(sorted((params or {}).items()))
+        digest = hashlib.sha1(f"{url}?{query}".encode()).hexdigest()
+        return f"{self.KEY_PREFIX}:{digest}"
+
+    def get(self, key):
+        """Return the stored {'etag', 'body'} entry or None."""
+        try:
+            return cache.get(key)
+        except Exception as e:
+            logger.warning(f"HTTP response cache unavailable: {str(e)}")
+            return None
+
+    def set(self, key, etag, body):
+        try:
+            cache.set(key, {'etag': etag, 'body': body}, timeout=self.ttl)
+            self.record('stored')
+        except Exception as e:
+            logger.warning(f"HTTP response cache unavailable: {str(e)}")
+
+    def record(self, name):
+        """Increment one of the revalidation counters."""
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        """Return revalidation counters."""
+        with self._lock:
+            return dict(self._stats)
+
+# Process-wide instance for conditional requests
+response_cache = ConditionalResponseCache()
@@ -0,0 +1,38 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+import logging
+import os
+import requests
+import threading
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+def get_session():
+    """
+    Return the process-wide HTTP session used for all Spotify requests.
+
+    Connections are pooled and kept alive across requests and clients.
+    Auth headers are sent per request, so the session carries no user state.
+    A new session is created after a fork so workers never share sockets.
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+
+    with _lock:
+        if _session is None or _session_pid != pid:
+            pool_size = getattr(settings, 'SPOTIFY_HTTP_POOL_SIZE', 10)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            logger.debug(f"Created pooled HTTP session (pool size {pool_size}) for process {pid}")
+            _session, _session_pid = session, pid
+
+    return _session
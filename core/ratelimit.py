@@ -0,0 +1,281 @@
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Path segments that look like Spotify IDs are collapsed in endpoint names
+ID_SEGMENT = re.compile(r'^[0-9A-Za-z]{16,}$')
+
+class SharedTokenBucket:
+    """
+    Request budget shared by every process through Redis.
+
+    The bucket holds up to `capacity` tokens (one second's worth by
+    default) and refills continuously at `rate` tokens per second, so no
+    window boundary ever lets more than `capacity + rate * t` requests
+    through in `t` seconds. Each attempt to take a token is one atomic Lua
+    script call. Without a Redis cache the bucket lives in the process,
+    and the budget is per process instead.
+    """
+
+    KEY = 'spotify:ratelimit:bucket'
+
+    # Refill the stored tokens, then take one or return the seconds until
+    # one is available. Numbers are returned as strings, Redis would
+    # truncate them to integers.
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'refilled_at')
+    local tokens = tonumber(state[1]) or capacity
+    local refilled_at = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - refilled_at) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'refilled_at', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {tostring(wait), tostring(tokens)}
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacity)
+        self._refilled_at = time.monotonic()
+        self._script = None
+        self._redis_checked = False
+
+    def _redis_script(self):
+        """Return the registered Lua script, or None without a Redis cache."""
+        if not self._redis_checked:
+            self._redis_checked = True
+            try:
+                from django_redis import get_redis_connection
+                self._script = get_redis_connection('default').register_script(self.SCRIPT)
+            except (ImportError, NotImplementedError):
+                self._script = None
+        return self._script
+
+    def _take(self):
+        """Take a token if one is available, else return the seconds until one is."""
+        script = self._redis_script()
+        if script is not None:
+            wait, _ = script(keys=[self.KEY], args=[self.rate, self.capacity])
+            return float(wait)
+
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self):
+        """Block until a token is available, returning the seconds waited."""
+        waited = 0.0
+        while True:
+            try:
+                delay = self._take()
+            except Exception as e:
+                # Never fail requests because the cache is down
+                logger.warning(f"Rate limit bucket unavailable: {str(e)}")
+                return waited
+            if delay <= 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def available(self):
+        """Return the number of tokens currently in the bucket."""
+        try:
+            script = self._redis_script()
+            if script is None:
+                with self._lock:
+                    self._refill()
+                    return self._tokens
+            tokens, refilled_at = script.registered_client.hmget(self.KEY, 'tokens', 'refilled_at')
+        except Exception:
+            return 0.0
+        if tokens is None:
+            return float(self.capacity)
+        elapsed = max(0.0, time.time() - float(refilled_at))
+        return min(float(self.capacity), float(tokens) + elapsed * self.rate)
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Caps in-flight requests, halving the cap on throttling and growing it
+    back by one after a full cap's worth of consecutive successes.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+
+    def on_throttle(self):
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+class RequestScheduler:
+    """
+    Schedules Spotify API requests within the rate limit.
+
+    Every request takes a token from the shared bucket, waits out any
+    Retry-After pause announced by a previous 429 (in any process) and is
+    retried after throttling. Concurrency adapts to observed throttling.
+    """
+
+    BLOCKED_KEY = 'spotify:ratelimit:blocked_until'
+
+    def __init__(self, rate=None, max_concurrency=None, max_retries=None, max_retry_after=None):
+        config = getattr(settings, 'SPOTIFY_RATE_LIMIT', {})
+        self.bucket = SharedTokenBucket(rate or config.get('REQUESTS_PER_SECOND', 10))
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency or config.get('MAX_CONCURRENCY', 8))
+        self.max_retries = max_retries if max_retries is not None else config.get('MAX_RETRIES', 3)
+        self.max_retry_after = max_retry_after or config.get('MAX_RETRY_AFTER', 60)
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0})
+
+    def request(self, session, method, url, **kwargs):
+        """Send a request through the scheduler and return the response."""
+        endpoint = self.endpoint_name(url)
+
+        for attempt in range(self.max_retries + 1):
+            waited = self._wait_if_blocked()
+            waited += self.bucket.acquire()
+
+            with self.limiter:
+                response = session.request(method, url, **kwargs)
+
+            with self._lock:
+                stats = self._stats[endpoint]
+                stats['requests'] += 1
+                stats['wait_seconds'] += waited
+
+            if response.status_code != 429:
+                self.limiter.on_success()
+                return response
+
+            self.limiter.on_throttle()
+            with self._lock:
+                self._stats[endpoint]['throttled'] += 1
+            if attempt == self.max_retries:
+                break
+
+            retry_after = self._retry_after(response)
+            self._block_for(retry_after)
+            logger.warning(f"Rate limited on {endpoint}, retrying in {retry_after:.1f}s "
+                           f"(attempt {attempt + 1}/{self.max_retries + 1})")
+
+        # Out of retries, let the caller handle the 429
+        logger.warning(f"Rate limited on {endpoint}, giving up after {self.max_retries + 1} attempts")
+        return response
+
+    def _retry_after(self, response):
+        """Parse the Retry-After header (seconds or HTTP date)."""
+        value = response.headers.get('Retry-After')
+        seconds = 1.0
+        if value:
+            try:
+                seconds = float(value)
+            except ValueError:
+                try:
+                    seconds = parsedate_to_datetime(value).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        return min(max(seconds, 0.0), self.max_retry_after)
+
+    def _block_for(self, seconds):
+        """
+        Pause all requests, in this and other processes, for `seconds`.
+        Only ever extends a pause: a shorter Retry-After doesn't cut a longer one short.
+        """
+        until = time.time() + seconds
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, until)
+        try:
+            if (cache.get(self.BLOCKED_KEY) or 0.0) < until:
+                cache.set(self.BLOCKED_KEY, until, timeout=int(seconds) + 1)
+        except Exception as e:
+            logger.warning(f"Could not share rate limit pause: {str(e)}")
+
+    def _wait_if_blocked(self):
+        """Sleep until any announced Retry-After pause has passed."""
+        try:
+            shared_until = cache.get(self.BLOCKED_KEY) or 0.0
+        except Exception:
+            shared_until = 0.0
+        delay = max(self._blocked_until, shared_until) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+    @staticmethod
+    def endpoint_name(url):
+        """Collapse a request URL into an endpoint name, e.g. playlists/{id}/tracks."""
+        path = urlparse(url).path
+        if path.startswith('/v1/'):
+            path = path[len('/v1/'):]
+        segments = ['{id}' if ID_SEGMENT.match(s) else s for s in path.strip('/').split('/')]
+        return '/'.join(segments)
+
+    def stats(self):
+        """Return per-endpoint request stats and the current budget."""
+        with self._lock:
+            endpoints = {name: dict(values) for name, values in self._stats.items()}
+        return {
+            'requests_per_second': self.bucket.rate,
+            'tokens_available': round(self.bucket.available(), 2),
+            'concurrency_limit': self.limiter.limit,
+            'max_concurrency': self.limiter.max_concurrency,
+            'in_flight': self.limiter.in_flight,
+            'blocked_for': max(0.0, self._blocked_until - time.time()),
+            'endpoints': endpoints,
+        }
+
+# Process-wide scheduler shared by all SpotifyClient objects
+scheduler = RequestScheduler()
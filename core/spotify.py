@@ -1,8 +1,14 @@
+from collections import deque
 from django.conf import settings
-import requests
 import base64
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, urlencode
+from .cache import metadata_cache as default_metadata_cache, response_cache as default_response_cache
+from .http import get_session
+from .ratelimit import scheduler as default_scheduler
+from .tokens import app_token_manager
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +51,18 @@ class SpotifyClient:
         Get client credentials access token for server-to-server API requests.
         This flow doesn't require user authorization and is suitable for
         accessing public data or data that doesn't require user permissions.
+        The token is cached and shared, see core.tokens.AppTokenManager.
         """
+        return app_token_manager.get_token()
+
+    @classmethod
+    def for_app(cls):
+        """Create a client authorized with the shared app-level token."""
+        return cls(access_token=app_token_manager.get_token())
+
+    @classmethod
+    def request_client_credentials(cls):
+        """Request a new client credentials token from Spotify."""
         try:
             # Create authorization header
             auth_header = base64.b64encode(
@@ -62,12 +79,12 @@ class SpotifyClient:
             }
 
             logger.debug("Requesting client credentials token from Spotify")
-            response = requests.post(cls.TOKEN_URL, headers=headers, data=data)
+            response = get_session().post(cls.TOKEN_URL, headers=headers, data=data)
             response.raise_for_status()
             
             token_info = response.json()
             logger.debug("Successfully received client credentials token")
-            return token_info['access_token']
+            return token_info
             
         except Exception as e:
             logger.error(f"Error getting client credentials: {str(e)}")
@@ -95,7 +112,7 @@ class SpotifyClient:
             }
 
             logger.debug("Requesting tokens from Spotify")
-            response = requests.post(cls.TOKEN_URL, headers=headers, data=data)
+            response = get_session().post(cls.TOKEN_URL, headers=headers, data=data)
             response.raise_for_status()
             
             tokens = response.json()
@@ -106,22 +123,112 @@ class SpotifyClient:
             logger.error(f"Error getting Spotify tokens: {str(e)}")
             raise
 
-    def __init__(self, access_token=None, refresh_token=None):
-        """Initialize the client with optional access and refresh tokens."""
+    @classmethod
+    def refresh_user_token(cls, refresh_token):
+        """Exchange a user's refresh token for a new access token."""
+        try:
+            auth_header = base64.b64encode(
+                f"{settings.SPOTIFY_CLIENT_ID}:{settings.SPOTIFY_CLIENT_SECRET}".encode()
+            ).decode()
+
+            headers = {
+                'Authorization': f'Basic {auth_header}',
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+
+            data = {
+                'grant_type': 'refresh_token',
+                'refresh_token': refresh_token
+            }
+
+            logger.debug("Refreshing user access token")
+            response = get_session().post(cls.TOKEN_URL, headers=headers, data=data)
+            response.raise_for_status()
+            return response.json()
+
+        except Exception as e:
+            logger.error(f"Error refreshing user token: {str(e)}")
+            raise
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Create a client for a user outside the request cycle.
+        An expired access token is refreshed first and saved on the user.
+        """
+        expires_at = user.spotify_token_expires_at or 0
+        if user.spotify_refresh_token and expires_at - 60 <= time.time():
+            token_info = cls.refresh_user_token(user.spotify_refresh_token)
+            user.spotify_access_token = token_info['access_token']
+            if token_info.get('refresh_token'):
+                user.spotify_refresh_token = token_info['refresh_token']
+            user.spotify_token_expires_at = int(time.time()) + token_info.get('expires_in', 3600)
+            user.save(update_fields=[
+                'spotify_access_token', 'spotify_refresh_token', 'spotify_token_expires_at'
+            ])
+        return cls(user.spotify_access_token, user.spotify_refresh_token)
+
+    def __init__(self, access_token=None, refresh_token=None, metadata_cache=None, scheduler=None,
+                 http_cache=None):
+        """
+        Initialize the client with optional access and refresh tokens.
+        Pass http_cache=False to disable ETag revalidation for this client.
+        """
         self.access_token = access_token
         self.refresh_token = refresh_token
-        self.session = requests.Session()
-        if access_token:
-            self.session.headers.update({
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            })
+        self.metadata_cache = metadata_cache or default_metadata_cache
+        self.scheduler = scheduler or default_scheduler
+        if http_cache is None:
+            http_cache = default_response_cache if getattr(settings, 'SPOTIFY_HTTP_CACHE_ENABLED', True) else False
+        self.http_cache = http_cache or None
+        # Shared pooled session, auth is sent per request
+        self.session = get_session()
+
+    def _auth_headers(self):
+        """Build the per-request headers for the current access token."""
+        headers = {'Content-Type': 'application/json'}
+        if self.access_token:
+            headers['Authorization'] = f'Bearer {self.access_token}'
+        return headers
+
+    def _get(self, url, params=None, headers=None):
+        """Send a GET request through the rate-limit aware scheduler."""
+        return self.scheduler.request(
+            self.session, 'GET', url, params=params, headers={**self._auth_headers(), **(headers or {})}
+        )
+
+    def _get_revalidated(self, url, params=None):
+        """
+        GET a JSON resource, revalidating a stored copy with If-None-Match.
+        On 304 Not Modified the stored body is returned without a download.
+        """
+        if not self.http_cache:
+            response = self._get(url, params=params)
+            response.raise_for_status()
+            return response.json()
+
+        key = self.http_cache.key(url, params)
+        entry = self.http_cache.get(key)
+        headers = {'If-None-Match': entry['etag']} if entry else None
+
+        response = self._get(url, params=params, headers=headers)
+        if response.status_code == 304 and entry:
+            self.http_cache.record('revalidated')
+            return entry['body']
+
+        response.raise_for_status()
+        body = response.json()
+        self.http_cache.record('misses')
+        etag = response.headers.get('ETag')
+        if etag:
+            self.http_cache.set(key, etag, body)
+        return body
 
     def get_user_profile(self):
         """Get the current user's Spotify profile."""
         try:
             logger.debug("Fetching user profile from Spotify")
-            response = self.session.get(f'{self.API_BASE_URL}/me')
+            response = self._get(f'{self.API_BASE_URL}/me')
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -132,7 +239,7 @@ class SpotifyClient:
         """Get the current user's playlists."""
         try:
             logger.debug(f"Fetching user playlists (limit={limit}, offset={offset})")
-            response = self.session.get(
+            response = self._get(
                 f'{self.API_BASE_URL}/me/playlists',
                 params={'limit': limit, 'offset': offset}
             )
@@ -142,13 +249,29 @@ class SpotifyClient:
             logger.error(f"Error getting user playlists: {str(e)}")
             raise
 
-    def get_recently_played(self, limit=20):
-        """Get user's recently played tracks."""
+    def iter_user_playlists(self, limit=50):
+        """Yield every playlist of the current user, following all pages."""
+        offset = 0
+        while True:
+            page = self.get_user_playlists(limit=limit, offset=offset)
+            yield from page.get('items', [])
+            offset += limit
+            if not page.get('next') or offset >= (page.get('total') or 0):
+                return
+
+    def get_recently_played(self, limit=20, after=None):
+        """
+        Get user's recently played tracks.
+        `after` is a Unix timestamp in milliseconds, only plays after it are returned.
+        """
         try:
-            logger.debug(f"Fetching recently played tracks (limit={limit})")
-            response = self.session.get(
+            logger.debug(f"Fetching recently played tracks (limit={limit}, after={after})")
+            params = {'limit': limit}
+            if after is not None:
+                params['after'] = after
+            response = self._get(
                 f'{self.API_BASE_URL}/me/player/recently-played',
-                params={'limit': limit}
+                params=params
             )
             response.raise_for_status()
             return response.json()
@@ -160,7 +283,7 @@ class SpotifyClient:
         """Get user's top artists."""
         try:
             logger.debug(f"Fetching top artists (limit={limit}, offset={offset}, time_range={time_range})")
-            response = self.session.get(
+            response = self._get(
                 f'{self.API_BASE_URL}/me/top/artists',
                 params={
                     'limit': limit,
@@ -174,28 +297,164 @@ class SpotifyClient:
             logger.error(f"Error getting top artists: {str(e)}")
             raise
 
-    def get_playlist(self, playlist_id):
-        """Get a playlist by ID."""
+    def get_playlist(self, playlist_id, fields=None):
+        """
+        Get a playlist by ID.
+        `fields` is an optional Spotify field projection that limits the
+        response to the listed fields.
+        """
         try:
             logger.debug(f"Fetching playlist {playlist_id}")
-            response = self.session.get(f'{self.API_BASE_URL}/playlists/{playlist_id}')
-            response.raise_for_status()
-            return response.json()
+            params = {'fields': fields} if fields else None
+            return self._get_revalidated(f'{self.API_BASE_URL}/playlists/{playlist_id}', params=params)
         except Exception as e:
             logger.error(f"Error getting playlist: {str(e)}")
             raise
 
+    def get_playlist_tracks(self, playlist_id, offset=0, limit=100, fields=None):
+        """Get one page of a playlist's tracks, optionally field-projected."""
+        try:
+            logger.debug(f"Fetching tracks for playlist {playlist_id} (offset={offset}, limit={limit})")
+            params = {'offset': offset, 'limit': limit}
+            if fields:
+                params['fields'] = fields
+            return self._get_revalidated(
+                f'{self.API_BASE_URL}/playlists/{playlist_id}/tracks',
+                params=params
+            )
+        except Exception as e:
+            logger.error(f"Error getting playlist tracks: {str(e)}")
+            raise
+
+    def iter_playlist_track_pages(self, playlist_id, first_page=None, max_workers=None, fields=None):
+        """
+        Yield every page of a playlist's tracks in order.
+        The first page reports the total, so the remaining offsets are
+        fetched concurrently with a bounded thread pool. At most
+        `max_workers` pages are fetched ahead of the consumer. A `fields`
+        projection must keep total, limit, offset and next.
+        """
+        if first_page is None:
+            first_page = self.get_playlist_tracks(playlist_id, fields=fields)
+        yield first_page
+
+        limit = first_page.get('limit') or 100
+        start = (first_page.get('offset') or 0) + limit
+        offsets = iter(range(start, first_page.get('total') or 0, limit))
+        if not first_page.get('next'):
+            return
+
+        max_workers = max_workers or getattr(settings, 'SPOTIFY_MAX_WORKERS', 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for offset in offsets:
+                pending.append(executor.submit(
+                    self.get_playlist_tracks, playlist_id, offset=offset, limit=limit, fields=fields
+                ))
+                if len(pending) >= max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     def get_artist(self, artist_id):
         """Get an artist by ID."""
         try:
+            cached = self.metadata_cache.get('artist', artist_id)
+            if cached is not None:
+                return cached
+
             logger.debug(f"Fetching artist {artist_id}")
-            response = self.session.get(f'{self.API_BASE_URL}/artists/{artist_id}')
+            response = self._get(f'{self.API_BASE_URL}/artists/{artist_id}')
             response.raise_for_status()
-            return response.json()
+            artist = response.json()
+            self.metadata_cache.set('artist', artist_id, artist)
+            return artist
         except Exception as e:
             logger.error(f"Error getting artist: {str(e)}")
             raise
 
+    def get_artists(self, artist_ids):
+        """
+        Get several artists by ID using the multi-artist endpoint.
+        IDs are deduplicated and fetched in batches of 50 (Spotify API limit).
+        Returns a dict mapping artist ID to artist object.
+        """
+        try:
+            unique_ids = list(dict.fromkeys(a for a in artist_ids if a))
+            if not unique_ids:
+                return {}
+
+            artists = self.metadata_cache.get_many('artist', unique_ids)
+            missing_ids = [a for a in unique_ids if a not in artists]
+            if not missing_ids:
+                return artists
+
+            logger.debug(f"Fetching {len(missing_ids)} artists in batches "
+                         f"({len(artists)} served from cache)")
+
+            chunk_size = 50
+            fetched = {}
+
+            for i in range(0, len(missing_ids), chunk_size):
+                chunk = missing_ids[i:i + chunk_size]
+                response = self._get(
+                    f'{self.API_BASE_URL}/artists',
+                    params={'ids': ','.join(chunk)}
+                )
+                response.raise_for_status()
+                for artist in response.json().get('artists', []):
+                    # Unknown IDs come back as null entries
+                    if artist:
+                        fetched[artist['id']] = artist
+
+            self.metadata_cache.set_many('artist', fetched)
+            artists.update(fetched)
+            return artists
+        except Exception as e:
+            logger.error(f"Error getting artists: {str(e)}")
+            raise
+
+    def get_tracks(self, track_ids):
+        """
+        Get several tracks by ID using the multi-track endpoint.
+        IDs are deduplicated and fetched in batches of 50 (Spotify API limit).
+        Returns a dict mapping track ID to track object.
+        """
+        try:
+            unique_ids = list(dict.fromkeys(t for t in track_ids if t))
+            if not unique_ids:
+                return {}
+
+            tracks = self.metadata_cache.get_many('track', unique_ids)
+            missing_ids = [t for t in unique_ids if t not in tracks]
+            if not missing_ids:
+                return tracks
+
+            logger.debug(f"Fetching {len(missing_ids)} tracks in batches "
+                         f"({len(tracks)} served from cache)")
+
+            chunk_size = 50
+            fetched = {}
+
+            for i in range(0, len(missing_ids), chunk_size):
+                chunk = missing_ids[i:i + chunk_size]
+                response = self._get(
+                    f'{self.API_BASE_URL}/tracks',
+                    params={'ids': ','.join(chunk)}
+                )
+                response.raise_for_status()
+                for track in response.json().get('tracks', []):
+                    # Unknown IDs come back as null entries
+                    if track:
+                        fetched[track['id']] = track
+
+            self.metadata_cache.set_many('track', fetched)
+            tracks.update(fetched)
+            return tracks
+        except Exception as e:
+            logger.error(f"Error getting tracks: {str(e)}")
+            raise
+
     def _handle_auth_error(self, response):
         """Handle 401 Unauthorized responses by refreshing the access token."""
         if response.status_code == 401:
@@ -208,65 +467,85 @@ class SpotifyClient:
         return False
 
     def get_tracks_features(self, track_ids):
-        """Get audio features for multiple tracks."""
+        """
+        Get audio features for multiple tracks.
+        The returned list is aligned with track_ids, with None for tracks
+        that have no features.
+        """
         try:
             if not track_ids:
                 return {'audio_features': []}
-            
-            logger.debug(f"Fetching audio features for {len(track_ids)} tracks")
-            
-            # Split track IDs into chunks of 100 (Spotify API limit)
-            chunk_size = 100
-            audio_features = []
-            
-            for i in range(0, len(track_ids), chunk_size):
-                chunk = track_ids[i:i + chunk_size]
-                max_retries = 2
-                retry_count = 0
-                
-                while retry_count < max_retries:
-                    try:
-                        response = self.session.get(
-                            f'{self.API_BASE_URL}/audio-features',
-                            params={'ids': ','.join(chunk)}
-                        )
-                        
-                        # Handle auth errors
-                        if response.status_code in (401, 403):
-                            logger.debug(f"Received {response.status_code}, attempting token refresh")
-                            # Call the refresh_token method, not treating it as an attribute
-                            new_token_data = self.refresh_token()
-                            if new_token_data:
-                                # Retry with new token
-                                retry_count += 1
-                                continue
-                            else:
-                                raise Exception("Token refresh failed")
-                        
-                        response.raise_for_status()
-                        chunk_features = response.json()
-                        
-                        # Handle both response formats
-                        features = chunk_features.get('audio_features', chunk_features)
-                        valid_features = [f for f in features if f is not None]
-                        audio_features.extend(valid_features)
-                        break  # Success, exit retry loop
-                        
-                    except Exception as e:
-                        retry_count += 1
-                        if retry_count >= max_retries:
-                            logger.error(f"Error getting features for chunk {i}-{i+chunk_size} after {max_retries} retries: {str(e)}")
-                            # Add empty placeholders for failed chunks
-                            audio_features.extend([None] * len(chunk))
-                        else:
-                            logger.warning(f"Retry {retry_count}/{max_retries} for chunk {i}-{i+chunk_size}: {str(e)}")
-                            continue
-
-            return {'audio_features': audio_features}
-            
+
+            features_by_id = self.get_tracks_features_map(track_ids)
+            return {'audio_features': [features_by_id.get(track_id) for track_id in track_ids]}
+
         except Exception as e:
             logger.error(f"Error getting track features: {str(e)}")
             return {'audio_features': []}
+
+    def get_tracks_features_map(self, track_ids, max_workers=None):
+        """
+        Get audio features for multiple tracks as a dict keyed by track ID.
+        Chunks of 100 IDs (Spotify API limit) are fetched concurrently.
+        """
+        unique_ids = list(dict.fromkeys(t for t in track_ids if t))
+        if not unique_ids:
+            return {}
+
+        logger.debug(f"Fetching audio features for {len(unique_ids)} tracks")
+
+        chunk_size = 100
+        chunks = [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+        max_workers = max_workers or getattr(settings, 'SPOTIFY_MAX_WORKERS', 4)
+
+        features_by_id = {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            for chunk_features in executor.map(self._fetch_features_chunk, chunks):
+                features_by_id.update(chunk_features)
+
+        return features_by_id
+
+    def _fetch_features_chunk(self, chunk):
+        """Fetch audio features for up to 100 track IDs, keyed by track ID."""
+        max_retries = 2
+        retry_count = 0
+
+        while retry_count < max_retries:
+            try:
+                response = self._get(
+                    f'{self.API_BASE_URL}/audio-features',
+                    params={'ids': ','.join(chunk)}
+                )
+
+                # Handle auth errors
+                if response.status_code in (401, 403):
+                    logger.debug(f"Received {response.status_code}, attempting token refresh")
+                    # Call the refresh_token method, not treating it as an attribute
+                    new_token_data = self.refresh_token()
+                    if new_token_data:
+                        # Retry with new token
+                        retry_count += 1
+                        continue
+                    else:
+                        raise Exception("Token refresh failed")
+
+                response.raise_for_status()
+                chunk_features = response.json()
+
+                # Handle both response formats
+                features = chunk_features.get('audio_features', chunk_features)
+                return {f['id']: f for f in features if f and f.get('id')}
+
+            except Exception as e:
+                retry_count += 1
+                if retry_count >= max_retries:
+                    logger.error(f"Error getting features for chunk of {len(chunk)} tracks after {max_retries} retries: {str(e)}")
+                else:
+                    logger.warning(f"Retry {retry_count}/{max_retries} for chunk of {len(chunk)} tracks: {str(e)}")
+
+        # Failed chunks are simply missing from the result
+        return {}
+
     def get_recommendations(self, seed_artists=None, seed_genres=None, seed_tracks=None, limit=20, **kwargs):
         """Get track recommendations based on seeds and parameters."""
         try:
@@ -283,7 +562,7 @@ class SpotifyClient:
             params.update(kwargs)
             
             logger.debug(f"Fetching recommendations with parameters: {params}")
-            response = self.session.get(f'{self.API_BASE_URL}/recommendations', params=params)
+            response = self._get(f'{self.API_BASE_URL}/recommendations', params=params)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -298,9 +577,7 @@ class SpotifyClient:
                 params['country'] = country
                 
             logger.debug(f"Fetching new releases with parameters: {params}")
-            response = self.session.get(f'{self.API_BASE_URL}/browse/new-releases', params=params)
-            response.raise_for_status()
-            return response.json()
+            return self._get_revalidated(f'{self.API_BASE_URL}/browse/new-releases', params=params)
         except Exception as e:
             logger.error(f"Error getting new releases: {str(e)}")
             raise
@@ -317,9 +594,7 @@ class SpotifyClient:
                 params['timestamp'] = timestamp
                 
             logger.debug(f"Fetching featured playlists with parameters: {params}")
-            response = self.session.get(f'{self.API_BASE_URL}/browse/featured-playlists', params=params)
-            response.raise_for_status()
-            return response.json()
+            return self._get_revalidated(f'{self.API_BASE_URL}/browse/featured-playlists', params=params)
         except Exception as e:
             logger.error(f"Error getting featured playlists: {str(e)}")
             raise
@@ -327,18 +602,15 @@ class SpotifyClient:
     def make_request(self, url, params=None):
         """Make a generic request to the given URL using the session's auth token."""
         try:
-            response = self.session.get(url, params=params)
+            response = self._get(url, params=params)
             if response.status_code == 403:
                 # Try to refresh the token if we have one
                 if hasattr(self, 'refresh_token'):
                     logger.debug("Got 403, attempting to refresh token")
                     new_tokens = self.refresh_token(self.refresh_token)
                     self.access_token = new_tokens['access_token']
-                    self.session.headers.update({
-                        'Authorization': f'Bearer {self.access_token}'
-                    })
                     # Retry the request
-                    response = self.session.get(url, params=params)
+                    response = self._get(url, params=params)
             
             response.raise_for_status()
             return response.json()
@@ -370,20 +642,16 @@ class SpotifyClient:
                 'refresh_token': self.refresh_token
             }
             
-            response = requests.post(self.TOKEN_URL, headers=headers, data=data)
+            response = self.session.post(self.TOKEN_URL, headers=headers, data=data)
             
             if response.status_code != 200:
                 logger.error(f"Token refresh failed with status {response.status_code}: {response.text}")
                 raise Exception(f"Failed to refresh token: {response.text}")
                 
             data = response.json()
+            # Subsequent requests pick up the new token from _auth_headers()
             self.access_token = data['access_token']
             
-            # Update the session headers with new token
-            self.session.headers.update({
-                'Authorization': f'Bearer {self.access_token}'
-            })
-            
             # Store new refresh token if provided
             if 'refresh_token' in data:
                 self.refresh_token = data['refresh_token']
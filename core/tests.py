@@ -1,3 +1,388 @@
-from django.test import TestCase
+from email.utils import formatdate
+from unittest import mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from core.cache import ConditionalResponseCache, MetadataCache
+from core.http import get_session
+from core.ratelimit import RequestScheduler, SharedTokenBucket
+from core.spotify import SpotifyClient
+from core.tokens import AppTokenManager
+import threading
+import time
 
-# Create your tests here.
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self._body = body
+        self.headers = headers or {}
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f'HTTP {self.status_code}')
+
+class FakeSession:
+    """Returns queued responses and records the requests made."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        return self.responses.pop(0)
+
+class FakeScheduler:
+    """Answers requests with `handler(url, params)` and records them."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def request(self, session, method, url, params=None, headers=None):
+        with self._lock:
+            self.requests.append((url, params))
+        return self.handler(url, params)
+
+def artists_endpoint(url, params):
+    ids = params['ids'].split(',')
+    return FakeResponse(200, {'artists': [
+        None if artist_id.startswith('unknown') else {'id': artist_id, 'name': artist_id.title()}
+        for artist_id in ids
+    ]})
+
+class BatchedArtistTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.scheduler = FakeScheduler(artists_endpoint)
+        self.client = SpotifyClient('token', metadata_cache=MetadataCache(), scheduler=self.scheduler,
+                                    http_cache=False)
+
+    def test_fetches_unique_ids_in_batches_of_50(self):
+        ids = [f'artist{i}' for i in range(120)]
+        artists = self.client.get_artists(ids + ids[:30] + [None, ''])
+
+        self.assertEqual(set(artists), set(ids))
+        self.assertEqual([len(params['ids'].split(',')) for _, params in self.scheduler.requests], [50, 50, 20])
+        self.assertTrue(all(url.endswith('/artists') for url, _ in self.scheduler.requests))
+
+    def test_unknown_ids_are_left_out(self):
+        artists = self.client.get_artists(['artist1', 'unknown1'])
+        self.assertEqual(artists, {'artist1': {'id': 'artist1', 'name': 'Artist1'}})
+
+    def test_no_request_without_ids(self):
+        self.assertEqual(self.client.get_artists([None, '']), {})
+        self.assertEqual(self.scheduler.requests, [])
+
+class MetadataCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shared_tier_serves_other_processes(self):
+        MetadataCache().set_many('artist', {'a1': {'id': 'a1'}, 'a2': {'id': 'a2'}})
+        # A fresh instance has an empty local tier, like another worker
+        other = MetadataCache()
+        self.assertEqual(other.get_many('artist', ['a1', 'a2', 'a3']), {'a1': {'id': 'a1'}, 'a2': {'id': 'a2'}})
+        # Shared hits are kept locally
+        self.assertEqual(other.get('artist', 'a1'), {'id': 'a1'})
+        self.assertEqual(other.stats()['entities']['artist'], {'local_hits': 1, 'shared_hits': 2, 'misses': 1})
+
+    def test_lru_evicts_least_recently_used(self):
+        metadata = MetadataCache(max_size=2)
+        metadata.set('track', 't1', 1)
+        metadata.set('track', 't2', 2)
+        metadata.get('track', 't1')
+        metadata.set('track', 't3', 3)
+        cache.clear()
+
+        self.assertEqual(metadata.get_many('track', ['t1', 't2', 't3']), {'t1': 1, 't3': 3})
+        self.assertEqual(metadata.stats()['size'], 2)
+
+    def test_local_entries_expire(self):
+        with mock.patch('core.cache.time.monotonic', return_value=1000.0):
+            metadata = MetadataCache(ttls={'artist': 60})
+            metadata.set('artist', 'a1', {'id': 'a1'})
+        cache.clear()
+        with mock.patch('core.cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(metadata.get('artist', 'a1'))
+
+    def test_client_lookups_skip_cached_artists(self):
+        scheduler = FakeScheduler(artists_endpoint)
+        client = SpotifyClient('token', metadata_cache=MetadataCache(), scheduler=scheduler, http_cache=False)
+        client.get_artists(['artist1', 'artist2'])
+        self.assertEqual(client.get_artists(['artist2', 'artist3'])['artist2']['name'], 'Artist2')
+        self.assertEqual(scheduler.requests[-1][1]['ids'], 'artist3')
+        self.assertEqual(len(scheduler.requests), 2)
+
+class TrackPageTests(SimpleTestCase):
+    TOTAL = 950
+
+    def setUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.scheduler = FakeScheduler(self.tracks_endpoint)
+        self.client = SpotifyClient('token', metadata_cache=MetadataCache(), scheduler=self.scheduler,
+                                    http_cache=False)
+
+    def tracks_endpoint(self, url, params):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        offset, limit = params['offset'], params['limit']
+        # Later pages answer first
+        time.sleep(0.002 * (self.TOTAL - offset) / limit)
+        with self.lock:
+            self.in_flight -= 1
+        end = min(offset + limit, self.TOTAL)
+        return FakeResponse(200, {
+            'items': [{'track': {'id': f't{n}'}} for n in range(offset, end)],
+            'total': self.TOTAL, 'limit': limit, 'offset': offset,
+            'next': 'next' if end < self.TOTAL else None,
+        })
+
+    def test_pages_are_yielded_in_order(self):
+        pages = list(self.client.iter_playlist_track_pages('p1', max_workers=3, fields='items,total'))
+        self.assertEqual(len(pages), 10)
+        ids = [item['track']['id'] for page in pages for item in page['items']]
+        self.assertEqual(ids, [f't{n}' for n in range(self.TOTAL)])
+        self.assertEqual(len(self.scheduler.requests), 10)
+        self.assertTrue(all(params['fields'] == 'items,total' for _, params in self.scheduler.requests))
+        self.assertLessEqual(self.max_in_flight, 3)
+
+    def test_single_page_needs_no_pool(self):
+        first_page = {'items': [], 'total': 0, 'limit': 100, 'offset': 0, 'next': None}
+        self.assertEqual(list(self.client.iter_playlist_track_pages('p1', first_page=first_page)), [first_page])
+        self.assertEqual(self.scheduler.requests, [])
+
+class AudioFeatureChunkTests(SimpleTestCase):
+    def setUp(self):
+        self.failing = set()
+        self.scheduler = FakeScheduler(self.features_endpoint)
+        self.client = SpotifyClient('token', metadata_cache=MetadataCache(), scheduler=self.scheduler,
+                                    http_cache=False)
+
+    def features_endpoint(self, url, params):
+        ids = params['ids'].split(',')
+        if ids[0] in self.failing:
+            return FakeResponse(500)
+        # Tracks without features come back as null entries
+        return FakeResponse(200, {'audio_features': [
+            None if track_id.endswith('7') else {'id': track_id, 'energy': 0.5} for track_id in ids
+        ]})
+
+    def test_chunks_of_100_keyed_by_id(self):
+        ids = [f't{n:03d}' for n in range(250)]
+        features = self.client.get_tracks_features_map(ids + ids[:10])
+
+        self.assertEqual(sorted(len(params['ids'].split(',')) for _, params in self.scheduler.requests), [50, 100, 100])
+        self.assertEqual(set(features), {track_id for track_id in ids if not track_id.endswith('7')})
+
+    def test_failed_chunk_is_missing(self):
+        self.failing.add('t100')
+        with self.assertLogs('core.spotify', 'ERROR'):
+            features = self.client.get_tracks_features_map([f't{n:03d}' for n in range(250)])
+        self.assertEqual({track_id[1] for track_id in features}, {'0', '2'})
+
+    def test_list_is_aligned_with_requested_ids(self):
+        result = self.client.get_tracks_features(['t001', 't007', 't001', 't002'])
+        self.assertEqual(
+            [features and features['id'] for features in result['audio_features']],
+            ['t001', None, 't001', 't002']
+        )
+
+class PooledSessionTests(SimpleTestCase):
+    def test_clients_share_one_session(self):
+        self.assertIs(SpotifyClient('a').session, SpotifyClient('b').session)
+        self.assertIs(SpotifyClient('a').session, get_session())
+
+    def test_new_session_after_fork(self):
+        session = get_session()
+        with mock.patch('core.http.os.getpid', return_value=-1), \
+                override_settings(SPOTIFY_HTTP_POOL_SIZE=7):
+            forked = get_session()
+            self.assertIsNot(forked, session)
+            self.assertIs(get_session(), forked)
+            self.assertEqual(forked.get_adapter('https://api.spotify.com')._pool_maxsize, 7)
+
+class AppTokenTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = AppTokenManager()
+        request = mock.patch('core.spotify.SpotifyClient.request_client_credentials')
+        self.request = request.start()
+        self.addCleanup(request.stop)
+
+    def test_concurrent_callers_share_one_refresh(self):
+        def slow_request():
+            time.sleep(0.05)
+            return {'access_token': 'app-token', 'expires_in': 3600}
+        self.request.side_effect = slow_request
+
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.manager.get_token())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['app-token'] * 8)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertIsNone(cache.get(AppTokenManager.LOCK_KEY))
+
+    def test_token_expires_before_spotify_expires_it(self):
+        self.request.return_value = {'access_token': 'app-token', 'expires_in': 3600}
+        with mock.patch('core.tokens.cache.set') as cache_set:
+            self.manager.get_token()
+        self.assertEqual(cache_set.call_args.kwargs['timeout'], 3600 - AppTokenManager.EXPIRY_MARGIN)
+
+    def test_waits_for_token_refreshed_by_another_process(self):
+        cache.add(AppTokenManager.LOCK_KEY, True)
+
+        def other_process_refreshes(seconds):
+            cache.set(AppTokenManager.CACHE_KEY, 'other-token')
+        with mock.patch('core.tokens.time.sleep', side_effect=other_process_refreshes):
+            self.assertEqual(self.manager.get_token(), 'other-token')
+        self.request.assert_not_called()
+
+    def test_invalidate_forces_refresh(self):
+        self.request.side_effect = [{'access_token': 'first'}, {'access_token': 'second'}]
+        self.assertEqual(self.manager.get_token(), 'first')
+        self.assertEqual(self.manager.get_token(), 'first')
+        self.manager.invalidate()
+        self.assertEqual(self.manager.get_token(), 'second')
+
+class FieldProjectionTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = FakeScheduler(lambda url, params: FakeResponse(200, {'id': 'p1'}))
+        self.client = SpotifyClient('token', metadata_cache=MetadataCache(), scheduler=self.scheduler,
+                                    http_cache=False)
+
+    def test_projection_is_sent_as_fields(self):
+        self.client.get_playlist('p1', fields='id,name')
+        self.client.get_playlist_tracks('p1', offset=100, fields='items(track(id))')
+        self.assertEqual(self.scheduler.requests[0][1], {'fields': 'id,name'})
+        self.assertEqual(self.scheduler.requests[1][1], {'offset': 100, 'limit': 100, 'fields': 'items(track(id))'})
+
+    def test_no_projection_requests_full_objects(self):
+        self.client.get_playlist('p1')
+        self.client.get_playlist_tracks('p1')
+        self.assertIsNone(self.scheduler.requests[0][1])
+        self.assertNotIn('fields', self.scheduler.requests[1][1])
+
+class RetryAfterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.scheduler = RequestScheduler(rate=1000, max_concurrency=4, max_retries=2, max_retry_after=30)
+        sleep = mock.patch('core.ratelimit.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def slept(self):
+        return sum(call.args[0] for call in self.sleep.call_args_list)
+
+    def test_retries_after_announced_delay(self):
+        session = FakeSession(
+            FakeResponse(429, headers={'Retry-After': '3'}),
+            FakeResponse(200, {'ok': True}),
+        )
+        response = self.scheduler.request(session, 'GET', 'https://api.spotify.com/v1/artists')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(session.requests), 2)
+        self.assertAlmostEqual(self.slept(), 3, delta=0.1)
+        stats = self.scheduler.stats()['endpoints']['artists']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['throttled'], 1)
+        # Throttling halves the concurrency cap
+        self.assertEqual(self.scheduler.limiter.limit, 2)
+
+    def test_pause_is_shared_with_other_schedulers(self):
+        session = FakeSession(FakeResponse(429, headers={'Retry-After': '5'}), FakeResponse(200, {}))
+        self.scheduler.request(session, 'GET', 'https://api.spotify.com/v1/artists')
+        self.assertGreater(cache.get(RequestScheduler.BLOCKED_KEY), time.time())
+
+    def test_http_date_and_cap(self):
+        in_ten_seconds = FakeResponse(429, headers={'Retry-After': formatdate(time.time() + 10, usegmt=True)})
+        self.assertAlmostEqual(self.scheduler._retry_after(in_ten_seconds), 10, delta=1.5)
+        self.assertEqual(self.scheduler._retry_after(FakeResponse(429, headers={'Retry-After': '600'})), 30)
+        self.assertEqual(self.scheduler._retry_after(FakeResponse(429)), 1.0)
+
+    def test_gives_up_after_max_retries(self):
+        session = FakeSession(*[FakeResponse(429, headers={'Retry-After': str(n)}) for n in (1, 2, 9)])
+        response = self.scheduler.request(session, 'GET', 'https://api.spotify.com/v1/artists')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(self.scheduler.stats()['endpoints']['artists']['throttled'], 3)
+        # The final 429 isn't retried, so it doesn't pause other requests either
+        self.assertLess(cache.get(RequestScheduler.BLOCKED_KEY), time.time() + 5)
+
+    def test_shorter_pause_does_not_cut_a_longer_one_short(self):
+        self.scheduler._block_for(20)
+        until = cache.get(RequestScheduler.BLOCKED_KEY)
+        RequestScheduler(rate=1000)._block_for(2)
+        self.assertEqual(cache.get(RequestScheduler.BLOCKED_KEY), until)
+
+class TokenBucketTests(SimpleTestCase):
+    def test_refills_continuously(self):
+        with mock.patch('core.ratelimit.time.monotonic') as monotonic:
+            monotonic.return_value = 100.0
+            bucket = SharedTokenBucket(rate=5)
+            # A full bucket lets one second's worth through at once
+            self.assertEqual([bucket._take() for _ in range(5)], [0.0] * 5)
+            self.assertAlmostEqual(bucket._take(), 0.2)
+            # Refilled at the rate, not reset at a window boundary
+            monotonic.return_value = 100.4
+            self.assertEqual(bucket._take(), 0.0)
+            self.assertEqual(bucket._take(), 0.0)
+            self.assertAlmostEqual(bucket._take(), 0.2)
+
+@override_settings(SPOTIFY_HTTP_CACHE_ENABLED=True)
+class RevalidationTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.http_cache = ConditionalResponseCache()
+        self.scheduler = mock.Mock()
+        self.client = SpotifyClient('token', metadata_cache=MetadataCache(), scheduler=self.scheduler,
+                                    http_cache=self.http_cache)
+
+    def sent_headers(self, call):
+        return self.scheduler.request.call_args_list[call].kwargs['headers']
+
+    def test_not_modified_returns_stored_body(self):
+        body = {'id': 'p1', 'name': 'Playlist', 'snapshot_id': 's1'}
+        self.scheduler.request.side_effect = [
+            FakeResponse(200, body, headers={'ETag': '"v1"'}),
+            FakeResponse(304),
+        ]
+        self.assertEqual(self.client.get_playlist('p1'), body)
+        self.assertNotIn('If-None-Match', self.sent_headers(0))
+
+        self.assertEqual(self.client.get_playlist('p1'), body)
+        self.assertEqual(self.sent_headers(1)['If-None-Match'], '"v1"')
+        self.assertEqual(self.http_cache.stats(), {'revalidated': 1, 'stored': 1, 'misses': 1})
+
+    def test_modified_response_replaces_stored_copy(self):
+        old = {'id': 'p1', 'snapshot_id': 's1'}
+        new = {'id': 'p1', 'snapshot_id': 's2'}
+        self.scheduler.request.side_effect = [
+            FakeResponse(200, old, headers={'ETag': '"v1"'}),
+            FakeResponse(200, new, headers={'ETag': '"v2"'}),
+            FakeResponse(304),
+        ]
+        self.client.get_playlist('p1')
+        self.assertEqual(self.client.get_playlist('p1'), new)
+        self.assertEqual(self.client.get_playlist('p1'), new)
+        self.assertEqual(self.sent_headers(2)['If-None-Match'], '"v2"')
+
+    def test_projections_are_cached_separately(self):
+        self.scheduler.request.side_effect = [
+            FakeResponse(200, {'id': 'p1'}, headers={'ETag': '"a"'}),
+            FakeResponse(200, {'id': 'p1', 'name': 'Playlist'}, headers={'ETag': '"b"'}),
+        ]
+        self.client.get_playlist('p1', fields='id')
+        self.client.get_playlist('p1', fields='id,name')
+        self.assertNotIn('If-None-Match', self.sent_headers(1))
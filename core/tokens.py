@@ -0,0 +1,72 @@
+from django.core.cache import cache
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class AppTokenManager:
+    """
+    Caches the app-level client-credentials token in the shared cache.
+
+    The token is kept until shortly before it expires. Refreshes are
+    single-flight: one caller takes a cache lock and hits /api/token while
+    everyone else waits for the new token to appear.
+    """
+
+    CACHE_KEY = 'spotify:app_token'
+    LOCK_KEY = 'spotify:app_token:lock'
+
+    # Refresh this many seconds before Spotify expires the token
+    EXPIRY_MARGIN = 60
+    LOCK_TIMEOUT = 30
+    WAIT_INTERVAL = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        """Return a valid app token, refreshing it if needed."""
+        token = cache.get(self.CACHE_KEY)
+        if token:
+            return token
+
+        # Only one thread per process competes for the shared lock
+        with self._lock:
+            token = cache.get(self.CACHE_KEY)
+            if token:
+                return token
+
+            if cache.add(self.LOCK_KEY, True, timeout=self.LOCK_TIMEOUT):
+                try:
+                    return self._refresh()
+                finally:
+                    cache.delete(self.LOCK_KEY)
+
+            # Another process is refreshing, wait for its token
+            deadline = time.monotonic() + self.LOCK_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(self.WAIT_INTERVAL)
+                token = cache.get(self.CACHE_KEY)
+                if token:
+                    return token
+
+            logger.warning("Timed out waiting for app token refresh, refreshing directly")
+            return self._refresh()
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after Spotify rejected it."""
+        cache.delete(self.CACHE_KEY)
+
+    def _refresh(self):
+        # Imported here to avoid a circular import with core.spotify
+        from .spotify import SpotifyClient
+
+        token_info = SpotifyClient.request_client_credentials()
+        timeout = max(token_info.get('expires_in', 3600) - self.EXPIRY_MARGIN, 1)
+        cache.set(self.CACHE_KEY, token_info['access_token'], timeout=timeout)
+        logger.info(f"Refreshed app access token (valid for {timeout}s)")
+        return token_info['access_token']
+
+# Process-wide manager for the app-level token
+app_token_manager = AppTokenManager()
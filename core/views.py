@@ -10,7 +10,7 @@ from django.http import HttpResponseBadRequest, JsonResponse
 import logging
 import time
 from .spotify import SpotifyClient
-from analytics.services import AnalyticsService
+from analytics.jobs import enqueue_analysis
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +49,9 @@ class PlaylistsView(LoginRequiredMixin, TemplateView):
             from analytics.models import PlaylistAnalysis
             analyzed_playlists = {
                 p.playlist_id: p 
-                for p in PlaylistAnalysis.objects.filter(user=self.request.user)
+                for p in PlaylistAnalysis.objects.filter(user=self.request.user).defer(
+                    'track_ids', 'track_index', 'aggregate_state'
+                )
             }
             
             # Extract playlist info and add to context
@@ -101,42 +103,30 @@ class PlaylistDetailView(LoginRequiredMixin, TemplateView):
             # Get playlist details
             playlist_data = spotify_client.get_playlist(playlist_id)
             
-            # Get playlist analysis from database if it exists and we're not refreshing
+            # Get playlist analysis from database if it exists
             from analytics.models import PlaylistAnalysis
-            analysis = None if refresh else PlaylistAnalysis.objects.filter(
+            analysis = PlaylistAnalysis.objects.filter(
                 playlist_id=playlist_id,
                 user=self.request.user
             ).first()
             
-            # If no analysis exists or we're refreshing, create one
-            # If no analysis exists or we're refreshing, create one
-            if not analysis:
-                analytics_service = AnalyticsService(spotify_client=spotify_client)
-                analysis_data = analytics_service.analyze_playlist(playlist_id, user=self.request.user)
-                # Try to get the analysis after creation, handle if not found
-                try:
-                    analysis = PlaylistAnalysis.objects.get(playlist_id=playlist_id, user=self.request.user)
-                except PlaylistAnalysis.DoesNotExist:
-                    # Create the analysis if it doesn't exist
-                    from analytics.models import PlaylistAnalysis
-                    analysis = PlaylistAnalysis.objects.create(
-                        playlist_id=playlist_id,
-                        user=self.request.user,
-                        analysis_data=analysis_data,
-                        total_duration_ms=0  # Set a default or calculate this
-                    )
+            # Analysis runs in the background worker, the page polls the job
+            analysis_job = None
+            if not analysis or refresh:
+                analysis_job, created = enqueue_analysis(self.request.user, playlist_id)
             context.update({
                 'playlist': {
                     'id': playlist_data['id'],
                     'name': playlist_data['name'],
                     'tracks_total': playlist_data['tracks']['total'],
-                    'total_duration_ms': analysis.total_duration_ms,
+                    'total_duration_ms': analysis.total_duration_ms if analysis else 0,
                     'image_url': playlist_data['images'][0]['url'] if playlist_data.get('images') else None,
                     'spotify_url': playlist_data['external_urls']['spotify'],
                     'owner': self.request.user if playlist_data['owner']['id'] == self.request.user.spotify_id else None,
-                    'is_public': analysis.is_public,
+                    'is_public': analysis.is_public if analysis else False,
                 },
-                'analysis': analysis.analysis_data,
+                'analysis': analysis.analysis_data if analysis else None,
+                'analysis_job': analysis_job,
             })
             
         except Exception as e:
@@ -117,6 +117,26 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache configuration
+# Use Redis when REDIS_URL is set so cached data is shared between workers
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Spotify API Configuration
 SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID', '')
 SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET', '')
@@ -128,6 +148,63 @@ if 'core/spotify' in SPOTIFY_REDIRECT_URI:
 
 SPOTIFY_SCOPE = 'user-read-private user-read-email playlist-read-private user-top-read user-read-recently-played'
 
+# Maximum concurrent requests per Spotify fetch (track pages, feature chunks)
+SPOTIFY_MAX_WORKERS = int(os.getenv('SPOTIFY_MAX_WORKERS', 4))
+
+# Pooled connections per process: one per request thread per concurrent fetch
+SPOTIFY_HTTP_POOL_SIZE = int(os.getenv(
+    'SPOTIFY_HTTP_POOL_SIZE',
+    int(os.getenv('GUNICORN_THREADS', 1)) * SPOTIFY_MAX_WORKERS + 2
+))
+
+# Spotify request scheduling: shared request budget and 429 handling
+SPOTIFY_RATE_LIMIT = {
+    'REQUESTS_PER_SECOND': int(os.getenv('SPOTIFY_REQUESTS_PER_SECOND', 10)),
+    'MAX_CONCURRENCY': int(os.getenv('SPOTIFY_MAX_CONCURRENCY', 8)),
+    'MAX_RETRIES': 3,
+    'MAX_RETRY_AFTER': 60,  # seconds
+}
+
+# ETag revalidation of playlist and browse responses
+SPOTIFY_HTTP_CACHE_ENABLED = os.getenv('SPOTIFY_HTTP_CACHE_ENABLED', 'True') == 'True'
+SPOTIFY_HTTP_CACHE_TTL = 60 * 60 * 24  # 1 day
+
+# Artist/track metadata cache (in-process LRU in front of the shared cache)
+SPOTIFY_METADATA_CACHE = {
+    'LRU_SIZE': int(os.getenv('SPOTIFY_METADATA_LRU_SIZE', 10000)),
+    'TTLS': {
+        'artist': 60 * 60 * 24,  # 1 day
+        'track': 60 * 60 * 24 * 7,  # 7 days
+    },
+}
+
+# Background analysis jobs running longer than this are requeued (seconds)
+ANALYSIS_JOB_TIMEOUT = int(os.getenv('ANALYSIS_JOB_TIMEOUT', 30 * 60))
+
+# Lifetime of published public trends and how long before expiry the
+# refresh_trends command regenerates them (seconds)
+PUBLIC_TRENDS_TTL = int(os.getenv('PUBLIC_TRENDS_TTL', 60 * 60 * 24))
+PUBLIC_TRENDS_REFRESH_MARGIN = int(os.getenv('PUBLIC_TRENDS_REFRESH_MARGIN', 60 * 60))
+
+# Trends are built from public playlist analyses once they cover this many
+# tracks; the refresh_trends command merges corpora of more analyses than
+# the threshold in this many worker processes (capped at the CPU count)
+PUBLIC_TRENDS_MIN_CORPUS_TRACKS = int(os.getenv('PUBLIC_TRENDS_MIN_CORPUS_TRACKS', 1000))
+CORPUS_PARALLEL_THRESHOLD = int(os.getenv('CORPUS_PARALLEL_THRESHOLD', 5000))
+CORPUS_TREND_PROCESSES = int(os.getenv('CORPUS_TREND_PROCESSES', 1))
+
+# Nearest-neighbour index over track audio features, built by the
+# build_track_index command; clusters scanned per query
+TRACK_INDEX_DIR = os.getenv('TRACK_INDEX_DIR', os.path.join(BASE_DIR, 'var', 'track_index'))
+TRACK_INDEX_NPROBE = int(os.getenv('TRACK_INDEX_NPROBE', 8))
+
+# Listening history: sync_listening_history runs every interval with at
+# most this many users at a time, each fetching one page of plays at a time
+# (so at most this many Spotify requests); the dashboard covers the last N days
+LISTENING_SYNC_INTERVAL = int(os.getenv('LISTENING_SYNC_INTERVAL', 30 * 60))
+LISTENING_SYNC_WORKERS = int(os.getenv('LISTENING_SYNC_WORKERS', 4))
+LISTENING_HISTORY_DAYS = int(os.getenv('LISTENING_HISTORY_DAYS', 180))
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [